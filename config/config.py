@@ -17,7 +17,117 @@ THUMBNAIL_GENERATE_HANDLER = os.getenv('THUMBNAIL_GENERATE_HANDLER', 'lambda_gen
 UPLOAD_PART = 'upload'
 DOWNLOAD_PART ='download'
 DOWNLOAD_THUMBNAIL_PART = 'download-thumbnail'
+UPLOAD_BATCH_PART = 'upload-batch'
 API_GATEWAY_NAME = os.getenv('API_GATEWAY_NAME', 'ImageUploadAPI')
+# Rendition ladder as 'name:longest-side' pairs; the default size keeps the plain -thumbnail key
+THUMBNAIL_SIZES = {
+    name: int(max_size) for name, max_size in
+    (entry.split(':') for entry in os.getenv('THUMBNAIL_SIZES', 'tile:128,preview:256,retina:512').split(','))
+}
+DEFAULT_THUMBNAIL_SIZE = os.getenv('DEFAULT_THUMBNAIL_SIZE', 'preview')
+THUMBNAIL_JPEG_QUALITY = int(os.getenv('THUMBNAIL_JPEG_QUALITY', '85'))
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', '25000000'))
+# Records of an SQS batch rendered at the same time; each one holds its decoded image in memory
+THUMBNAIL_CONCURRENCY = int(os.getenv('THUMBNAIL_CONCURRENCY', '4'))
+THUMBNAIL_RECORD_TIMEOUT = float(os.getenv('THUMBNAIL_RECORD_TIMEOUT', '10'))
+# Seconds kept free at the end of an invocation to report the batch result
+THUMBNAIL_TIMEOUT_MARGIN = float(os.getenv('THUMBNAIL_TIMEOUT_MARGIN', '1'))
+# Presigned uploads: seconds the POST policy stays valid and the largest object it accepts
+UPLOAD_URL_EXPIRY = int(os.getenv('UPLOAD_URL_EXPIRY', '300'))
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(20 * 1024 * 1024)))
+# How downloads are served: 'json' (base64 in a JSON body), 'redirect' (302 to a presigned URL) or 'binary'
+DOWNLOAD_RESPONSE_MODE = os.getenv('DOWNLOAD_RESPONSE_MODE', 'json')
+DOWNLOAD_URL_EXPIRY = int(os.getenv('DOWNLOAD_URL_EXPIRY', '300'))
+# Originals can be replaced under the same name and must be revalidated. Renditions keep their key when their
+# original is replaced and are re-rendered in place, so they are only cached for a few minutes before the
+# ETag is checked again
+IMAGE_CACHE_CONTROL = os.getenv('IMAGE_CACHE_CONTROL', 'public, max-age=0, must-revalidate')
+THUMBNAIL_CACHE_CONTROL = os.getenv('THUMBNAIL_CACHE_CONTROL', 'public, max-age=300, must-revalidate')
+# Warm-container thumbnail cache: total body bytes (0 disables it), seconds before revalidation, largest entry
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv('THUMBNAIL_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+THUMBNAIL_CACHE_TTL = float(os.getenv('THUMBNAIL_CACHE_TTL', '60'))
+THUMBNAIL_CACHE_MAX_ENTRY_BYTES = int(os.getenv('THUMBNAIL_CACHE_MAX_ENTRY_BYTES', str(1024 * 1024)))
+# Render missing thumbnails on download; concurrent requests wait LAZY_RENDER_WAIT seconds for one render
+LAZY_THUMBNAILS = os.getenv('LAZY_THUMBNAILS', 'true').lower() == 'true'
+LAZY_RENDER_WAIT = float(os.getenv('LAZY_RENDER_WAIT', '5'))
+LAZY_RENDER_LOCK_TTL = float(os.getenv('LAZY_RENDER_LOCK_TTL', '30'))
+# Inline uploads: base64 characters decoded at a time, multipart part size (5 MiB minimum) and parallel parts
+BASE64_CHUNK_SIZE = int(os.getenv('BASE64_CHUNK_SIZE', str(256 * 1024)))
+UPLOAD_PART_SIZE = int(os.getenv('UPLOAD_PART_SIZE', str(8 * 1024 * 1024)))
+UPLOAD_MAX_CONCURRENCY = int(os.getenv('UPLOAD_MAX_CONCURRENCY', '2'))
+# /upload-batch: most files per request and S3 writes in flight at once
+UPLOAD_BATCH_MAX_FILES = int(os.getenv('UPLOAD_BATCH_MAX_FILES', '50'))
+UPLOAD_BATCH_CONCURRENCY = int(os.getenv('UPLOAD_BATCH_CONCURRENCY', '8'))
+# 'sqs': the upload lambda queues thumbnail jobs itself. 's3-events': the bucket's ObjectCreated notifications
+# queue every original, and the upload lambda only writes to S3
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'sqs')
+# Content-addressed storage: inline uploads are stored once per sha256 digest under CONTENT_PREFIX, and the
+# file name becomes a ref object pointing at it
+CONTENT_ADDRESSED_STORAGE = os.getenv('CONTENT_ADDRESSED_STORAGE', 'false').lower() == 'true'
+CONTENT_PREFIX = os.getenv('CONTENT_PREFIX', 'content/')
+# Object key layout: 'flat' keeps files at the bucket root, 'hashed' spreads originals and renditions over
+# KEY_SHARD_CHARS hex characters of hash prefix, in separate prefix trees
+KEY_LAYOUT = os.getenv('KEY_LAYOUT', 'flat')
+KEY_SHARD_CHARS = int(os.getenv('KEY_SHARD_CHARS', '2'))
+ORIGINALS_PREFIX = os.getenv('ORIGINALS_PREFIX', 'originals/')
+RENDITIONS_PREFIX = os.getenv('RENDITIONS_PREFIX', 'renditions/')
+# Extra encodings of every rendition; the order they are tried in for renditions that don't list their variants
+THUMBNAIL_VARIANT_FORMATS = [name.strip() for name in os.getenv('THUMBNAIL_VARIANT_FORMATS', 'webp').split(',')
+                             if name.strip()]
+THUMBNAIL_WEBP_QUALITY = int(os.getenv('THUMBNAIL_WEBP_QUALITY', '80'))
+THUMBNAIL_AVIF_QUALITY = int(os.getenv('THUMBNAIL_AVIF_QUALITY', '60'))
+# AWS clients: connection pool per client, retry mode and attempts, and services built during init rather
+# than on first use (init runs at full CPU whatever the memory size)
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '32'))
+AWS_RETRY_MODE = os.getenv('AWS_RETRY_MODE', 'adaptive')
+AWS_MAX_ATTEMPTS = int(os.getenv('AWS_MAX_ATTEMPTS', '5'))
+AWS_CONNECT_TIMEOUT = float(os.getenv('AWS_CONNECT_TIMEOUT', '2'))
+AWS_CLIENT_PRELOAD = [name.strip() for name in os.getenv('AWS_CLIENT_PRELOAD', '').split(',') if name.strip()]
+# Log import and init timings on the first invocation of each container
+COLD_START_REPORT = os.getenv('COLD_START_REPORT', 'true').lower() == 'true'
+# One CloudWatch embedded metric format line per invocation, with the time spent in each stage
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'ThumbnailService')
+# Lambda MemorySize (MB) and Timeout (seconds) per handler as 'handler:value' pairs, from
+# tests/profile_lambda_handlers.py; handlers not listed get 128 MB and 15 seconds
+LAMBDA_MEMORY_SIZES = {
+    name: int(value) for name, value in
+    (entry.split(':') for entry in os.getenv('LAMBDA_MEMORY_SIZES', 'lambda_upload:256,lambda_generate_thumbnail:1769,'
+                                                                  'lambda_download_image:128,'
+                                                                  'lambda_download_thumbnail:1024').split(','))
+}
+LAMBDA_TIMEOUTS = {
+    name: int(value) for name, value in
+    (entry.split(':') for entry in os.getenv('LAMBDA_TIMEOUTS', 'lambda_upload:10,lambda_generate_thumbnail:30,'
+                                                              'lambda_download_image:5,'
+                                                              'lambda_download_thumbnail:10').split(','))
+}
+# PNGs and GIFs have no draft mode and are decoded at full size, up to 8 bytes per pixel at peak (the RGBA buffer and
+# the premultiplied copy Image.reduce makes). By default their pixel limit is what fits in the functions rendering
+# them after 64 MB for the runtime: THUMBNAIL_CONCURRENCY decodes in the thumbnail function, one lazy render in the
+# download-thumbnail function
+FULL_DECODE_BYTES_PER_PIXEL = 8
+MAX_FULL_DECODE_PIXELS = int(os.getenv('MAX_FULL_DECODE_PIXELS', str(min(
+    MAX_IMAGE_PIXELS,
+    (LAMBDA_MEMORY_SIZES.get('lambda_generate_thumbnail', 128) - 64) * 2 ** 20 // THUMBNAIL_CONCURRENCY
+    // FULL_DECODE_BYTES_PER_PIXEL,
+    (LAMBDA_MEMORY_SIZES.get('lambda_download_thumbnail', 128) - 64) * 2 ** 20 // FULL_DECODE_BYTES_PER_PIXEL,
+))))
+# Thumbnail queue consumer: records per invocation (over 10 needs a batching window), seconds SQS may wait to
+# fill a batch, and most concurrent invocations (2 to 1000, 0 leaves it to the account's concurrency)
+THUMBNAIL_QUEUE_BATCH_SIZE = int(os.getenv('THUMBNAIL_QUEUE_BATCH_SIZE', '10'))
+THUMBNAIL_QUEUE_BATCHING_WINDOW = int(os.getenv('THUMBNAIL_QUEUE_BATCHING_WINDOW', '0'))
+THUMBNAIL_QUEUE_MAX_CONCURRENCY = int(os.getenv('THUMBNAIL_QUEUE_MAX_CONCURRENCY', '10'))
+# Messages received this many times without succeeding are moved to the dead-letter queue
+THUMBNAIL_QUEUE_MAX_RECEIVE_COUNT = int(os.getenv('THUMBNAIL_QUEUE_MAX_RECEIVE_COUNT', '3'))
+SQS_DEAD_LETTER_QUEUE_NAME = os.getenv('SQS_DEAD_LETTER_QUEUE_NAME', f'{SQS_QUEUE_NAME}-dlq')
+# Deployment steps of scripts/main.py run at the same time
+DEPLOY_CONCURRENCY = int(os.getenv('DEPLOY_CONCURRENCY', '8'))
+# Layer built from requirements.txt by the deploy script when PILLOW_LAYER_ARN is not set
+LAMBDA_LAYER_NAME = os.getenv('LAMBDA_LAYER_NAME', 'thumbnail-service-dependencies')
+PILLOW_LAYER_ARN = os.getenv('PILLOW_LAYER_ARN', '')
+LAMBDA_SHARED_MODULES = ['thumbnail_engine', 'renditions', 'download_responses', 'byte_cache', 'image_sniff', 'content_store', 'key_layout',
+                         'aws_clients', 'cold_start', 'metrics']
 
 
 
@@ -0,0 +1,56 @@
+import threading
+import time
+import cold_start
+from config import *
+
+_session = None
+_lock = threading.Lock()
+
+
+def client_config():
+    # Kept-alive pooled connections, sized for the handlers' thread pools, with client-side rate limiting
+    from botocore.config import Config
+    return Config(
+        region_name=AWS_REGION,
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=AWS_CONNECT_TIMEOUT,
+        retries={'mode': AWS_RETRY_MODE, 'max_attempts': AWS_MAX_ATTEMPTS}
+    )
+
+
+class LazyClient:
+    """
+    Stands in for a boto3 client that is only built when it is first used.
+
+    Handlers keep a module-level client as before, but one they never call (the SQS client of an upload
+    in the s3-events pipeline, say) costs nothing at cold start. Building is thread safe, so handlers can
+    share the client between their worker threads.
+    """
+
+    def __init__(self, service_name):
+        self._service_name = service_name
+        self._client = None
+
+    def _get(self):
+        global _session
+        if self._client is None:
+            with _lock:
+                if self._client is None:
+                    started = time.perf_counter()
+                    import boto3
+                    # Sessions aren't thread safe, all clients are built from one under the lock
+                    _session = _session or boto3.session.Session()
+                    self._client = _session.client(self._service_name, config=client_config())
+                    cold_start.record(f'client:{self._service_name}', time.perf_counter() - started)
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+
+def client(service_name):
+    lazy_client = LazyClient(service_name)
+    if service_name in AWS_CLIENT_PRELOAD:
+        lazy_client._get()
+    return lazy_client
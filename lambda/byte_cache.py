@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass
+class CachedObject:
+    """An S3 object held in a ByteCache, with the headers needed to serve and revalidate it."""
+    data: bytes
+    content_type: str
+    etag: str
+    last_modified: object
+    expires_at: float
+    metadata: dict = field(default_factory=dict)
+
+
+class ByteCache:
+    """
+    Least-recently-used cache of S3 objects bounded by the total size of their bodies.
+
+    Lives at module scope, so it survives across warm invocations of the same container. Entries older
+    than `ttl` seconds are still returned by `get`, flagged as expired, so the caller can revalidate them
+    with a conditional request instead of downloading them again.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, max_entry_bytes: int):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: str) -> Optional[CachedObject]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def is_fresh(self, entry: CachedObject) -> bool:
+        return time.monotonic() < entry.expires_at
+
+    def refresh(self, entry: CachedObject) -> None:
+        entry.expires_at = time.monotonic() + self.ttl
+
+    def put(self, key: str, data: bytes, content_type: str, etag: str, last_modified,
+            metadata: Optional[dict] = None) -> CachedObject:
+        entry = CachedObject(data, content_type, etag, last_modified, time.monotonic() + self.ttl, metadata or {})
+        self.discard(key)
+        if len(data) > self.max_entry_bytes:
+            return entry
+
+        self._entries[key] = entry
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.data)
+        return entry
+
+    def discard(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.data)
+
+    def stats(self) -> str:
+        return (f"hits={self.hits} misses={self.misses} revalidations={self.revalidations} "
+                f"entries={len(self._entries)} bytes={self.size}")
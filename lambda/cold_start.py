@@ -0,0 +1,105 @@
+import json
+import logging
+import sys
+import time
+from config import COLD_START_REPORT
+
+# Imported first by every handler, so this is as close to the start of the init phase as Python code gets
+INIT_STARTED = time.perf_counter()
+
+logger = logging.getLogger()
+
+
+class _TimedLoader:
+    """Wraps a module's loader for the duration of its execution, to time it."""
+
+    def __init__(self, loader, timer):
+        self._loader = loader
+        self._timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._timer.started(module.__name__)
+        try:
+            self._loader.exec_module(module)
+        finally:
+            self._timer.finished(module.__name__)
+            # Hand the module its real loader back, nothing after the import sees the wrapper
+            module.__loader__ = self._loader
+            if module.__spec__ is not None:
+                module.__spec__.loader = self._loader
+
+
+class ImportTimer:
+    """
+    Meta path finder recording how long each module takes to import, nested imports included.
+
+    It doesn't find anything itself: it asks the finders after it, and wraps the loader of the spec they
+    return. Only installed until the first invocation has been reported.
+    """
+
+    def __init__(self):
+        self.durations = {}
+        self._stack = []
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    def started(self, name):
+        self._stack.append((name, time.perf_counter()))
+
+    def finished(self, name):
+        _, started = self._stack.pop()
+        # Only top-level imports are kept, their time includes everything they import
+        if not self._stack:
+            self.durations[name] = self.durations.get(name, 0.0) + time.perf_counter() - started
+
+
+import_timer = ImportTimer()
+init_durations = {}
+_reported = False
+
+if COLD_START_REPORT:
+    sys.meta_path.insert(0, import_timer)
+
+
+def record(name, seconds):
+    # Init work done outside of imports, e.g. building a client
+    init_durations[name] = init_durations.get(name, 0.0) + seconds
+
+
+def report(function_name=None):
+    """
+    Logs the cold start breakdown once per container, on its first invocation.
+
+    The report is one JSON line: the time from the first handler import to the first invocation, the
+    slowest top-level imports and the clients built so far.
+    """
+    global _reported
+    if _reported or not COLD_START_REPORT:
+        return
+    _reported = True
+    init_ms = (time.perf_counter() - INIT_STARTED) * 1000
+    if import_timer in sys.meta_path:
+        sys.meta_path.remove(import_timer)
+    slowest = sorted(import_timer.durations.items(), key=lambda item: item[1], reverse=True)[:10]
+    logger.info(json.dumps({
+        'cold_start': True,
+        'function': function_name,
+        'init_ms': round(init_ms, 1),
+        'imports_ms': {name: round(seconds * 1000, 1) for name, seconds in slowest},
+        'init_steps_ms': {name: round(seconds * 1000, 1) for name, seconds in init_durations.items()},
+    }))
@@ -0,0 +1,35 @@
+from config import *
+from key_layout import original_key
+
+# Metadata of a ref object naming the content-addressed original it stands for
+CONTENT_KEY_METADATA = 'content-key'
+
+# Extension of a content-addressed original, per format found in its header
+FORMAT_EXTENSIONS = {'PNG': 'png', 'JPEG': 'jpg', 'GIF': 'gif'}
+
+
+def content_key(digest, image_format):
+    # Identical bytes always land on the same key, whatever file name they were uploaded under
+    return original_key(f'{CONTENT_PREFIX}{digest}.{FORMAT_EXTENSIONS[image_format]}')
+
+
+def is_ref(metadata):
+    return CONTENT_KEY_METADATA in metadata
+
+
+def resolve_key(s3, bucket_name, file_name):
+    """
+    Returns the key holding the bytes of a file name, in the configured KEY_LAYOUT.
+
+    In content-addressed mode an inline upload's file name is an empty ref object whose metadata names
+    the digest key. Presigned uploads never pass through the upload lambda, so they are stored under
+    their file name and resolve to it.
+
+    Raises:
+        ClientError: If the file name doesn't exist.
+    """
+    s3_key = original_key(file_name)
+    if not CONTENT_ADDRESSED_STORAGE:
+        return s3_key
+    head = s3.head_object(Bucket=bucket_name, Key=s3_key)
+    return head.get('Metadata', {}).get(CONTENT_KEY_METADATA, s3_key)
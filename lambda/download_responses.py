@@ -0,0 +1,279 @@
+import base64
+import json
+import logging
+import metrics
+from email.utils import format_datetime, parsedate_to_datetime
+from botocore.exceptions import ClientError
+from config import *
+
+DOWNLOAD_RESPONSE_MODES = ('json', 'redirect', 'binary')
+
+logger = logging.getLogger()
+
+
+def request_headers(event: dict) -> dict:
+    # API Gateway keeps the client's header casing, HTTP header names are case-insensitive
+    return {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+
+
+def accepted_media_types(headers: dict) -> set:
+    """
+    Returns the media types the client's Accept header lists explicitly with a non-zero quality.
+
+    Wildcards such as image/* are left out: browsers send them whatever formats they decode, so only an
+    explicit image/webp or image/avif opts a client in to those encodings.
+    """
+    media_types = set()
+    for entry in headers.get('accept', '').split(','):
+        media_type, *params = [part.strip() for part in entry.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type and '*' not in media_type and quality > 0:
+            media_types.add(media_type.lower())
+    return media_types
+
+
+def conditional_get_params(headers: dict, allow_range: bool) -> dict:
+    """
+    Translates the client's conditional and Range headers into get_object parameters.
+
+    If-Modified-Since is ignored when If-None-Match is present, as RFC 9110 requires.
+    """
+    params = {}
+    if 'if-none-match' in headers:
+        params['IfNoneMatch'] = headers['if-none-match']
+    elif 'if-modified-since' in headers:
+        try:
+            params['IfModifiedSince'] = parsedate_to_datetime(headers['if-modified-since'])
+        except (TypeError, ValueError):
+            pass
+    if allow_range and 'range' in headers:
+        params['Range'] = headers['range']
+    return params
+
+
+def is_not_modified(error: ClientError) -> bool:
+    return (error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304
+            or error.response['Error']['Code'] in ('304', 'NotModified'))
+
+
+def cache_headers(etag: str, last_modified, cache_control: str) -> dict:
+    headers = {'Cache-Control': cache_control}
+    if etag:
+        headers['ETag'] = etag
+    if last_modified:
+        headers['Last-Modified'] = last_modified if isinstance(last_modified, str) else format_datetime(
+            last_modified, usegmt=True)
+    return headers
+
+
+def not_modified_response(etag: str, last_modified, cache_control: str) -> dict:
+    return {
+        'statusCode': 304,
+        'headers': cache_headers(etag, last_modified, cache_control),
+        'body': ''
+    }
+
+
+def range_not_satisfiable_response(size: int = None) -> dict:
+    headers = {'Accept-Ranges': 'bytes'}
+    if size is not None:
+        headers['Content-Range'] = f'bytes */{size}'
+    return {
+        'statusCode': 416,
+        'headers': headers,
+        'body': ''
+    }
+
+
+def object_response(image_data: bytes, content_type: str, headers: dict, mode: str, content_range: str = None) -> dict:
+    metrics.add_bytes('download', len(image_data))
+    # Encode the image as base64
+    with metrics.timer('encode'):
+        image_base64 = base64.b64encode(image_data).decode('utf-8')
+
+    if mode == 'binary':
+        headers['Content-Type'] = content_type or 'application/octet-stream'
+        headers['Accept-Ranges'] = 'bytes'
+        if content_range:
+            headers['Content-Range'] = content_range
+        return {
+            'statusCode': 206 if content_range else 200,
+            'headers': headers,
+            'body': image_base64,
+            'isBase64Encoded': True
+        }
+
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': json.dumps({'image_data': image_base64, 'content_type': content_type})
+    }
+
+
+def is_unchanged_for_client(headers: dict, etag: str, last_modified) -> bool:
+    # Local equivalent of the IfNoneMatch / IfModifiedSince checks S3 performs in conditional_get_params
+    if 'if-none-match' in headers:
+        client_etags = [tag.strip().removeprefix('W/') for tag in headers['if-none-match'].split(',')]
+        return '*' in client_etags or etag in client_etags
+    if 'if-modified-since' in headers and last_modified is not None:
+        try:
+            return last_modified.replace(microsecond=0) <= parsedate_to_datetime(headers['if-modified-since'])
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def byte_range(range_header: str, size: int):
+    """
+    Resolves a single 'bytes=' range against an object of the given size.
+
+    Returns:
+        The inclusive (start, end) tuple, None when the header should be ignored (malformed or multiple
+        ranges, served as a plain 200), or False when the range can't be satisfied.
+    """
+    unit, _, spec = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    start, _, end = spec.strip().partition('-')
+    try:
+        if not start:
+            start, end = max(0, size - int(end)), size - 1
+        else:
+            start, end = int(start), min(int(end) if end else size - 1, size - 1)
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def cached_object(s3, cache, bucket_name: str, s3_key: str):
+    """
+    Returns the whole object from the warm-container cache, fetching or revalidating it as needed.
+
+    A fresh entry is served without touching S3. An expired entry is revalidated with a get_object
+    conditioned on its ETag, which costs a 304 instead of the body when the object hasn't changed.
+    """
+    entry = cache.get(s3_key)
+    if entry is not None and cache.is_fresh(entry):
+        cache.hits += 1
+        metrics.count('cache_hit')
+        logger.info(f"Cache hit for {s3_key}: {cache.stats()}")
+        return entry
+
+    params = {'IfNoneMatch': entry.etag} if entry is not None else {}
+    try:
+        with metrics.timer('s3_get'):
+            s3_object = s3.get_object(Bucket=bucket_name, Key=s3_key, **params)
+    except ClientError as e:
+        if entry is not None and is_not_modified(e):
+            cache.refresh(entry)
+            cache.revalidations += 1
+            metrics.count('cache_revalidated')
+            logger.info(f"Cache revalidated {s3_key}: {cache.stats()}")
+            return entry
+        raise
+
+    cache.misses += 1
+    metrics.count('cache_miss')
+    with metrics.timer('s3_get'):
+        image_data = s3_object['Body'].read()
+    entry = cache.put(s3_key, image_data, s3_object.get('ContentType'), s3_object.get('ETag'),
+                      s3_object.get('LastModified'), s3_object.get('Metadata'))
+    logger.info(f"Cache miss for {s3_key}: {cache.stats()}")
+    return entry
+
+
+def download_response(s3, bucket_name: str, s3_key: str, event: dict = None, mode: str = DOWNLOAD_RESPONSE_MODE,
+                      cache_control: str = IMAGE_CACHE_CONTROL, cache=None) -> dict:
+    """
+    Builds the API Gateway proxy response that serves an S3 object.
+
+    ETag and Last-Modified are passed through from S3. If-None-Match and If-Modified-Since are forwarded to
+    get_object, so an unchanged object is answered with a 304 without its body being read. In binary mode
+    a Range header is forwarded as a ranged get_object and answered with a 206. In redirect mode S3
+    answers conditional and Range requests itself. When a ByteCache is given, the whole object is served
+    from it and the client's conditional and Range headers are evaluated locally.
+
+    Three modes are supported:
+        - 'json': the object is base64 encoded inside a JSON body, {'image_data': ..., 'content_type': ...}.
+        - 'redirect': a 302 to a presigned GET URL valid for DOWNLOAD_URL_EXPIRY seconds. The bytes never
+          pass through the lambda.
+        - 'binary': the raw bytes with `isBase64Encoded` and the object's Content-Type. API Gateway decodes
+          them for clients whose Accept header matches the API's binary media types.
+
+    Args:
+        s3: The boto3 S3 client.
+        bucket_name (str): The bucket holding the object.
+        s3_key (str): The key of the object to serve.
+        event (dict, optional): The API Gateway proxy event, used for its request headers.
+        mode (str): One of DOWNLOAD_RESPONSE_MODES.
+        cache_control (str): The Cache-Control header of successful responses.
+        cache (ByteCache, optional): Warm-container cache to serve the object from.
+
+    Returns:
+        dict: The proxy integration response.
+    """
+    if mode not in DOWNLOAD_RESPONSE_MODES:
+        raise ValueError(f"Unknown download response mode '{mode}'")
+    metrics.set_property('response_mode', mode)
+
+    if mode == 'redirect':
+        presigned_url = s3.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket_name, 'Key': s3_key},
+            ExpiresIn=DOWNLOAD_URL_EXPIRY
+        )
+        return {
+            'statusCode': 302,
+            'headers': {'Location': presigned_url},
+            'body': ''
+        }
+
+    headers = request_headers(event or {})
+
+    if cache is not None:
+        entry = cached_object(s3, cache, bucket_name, s3_key)
+        if is_unchanged_for_client(headers, entry.etag, entry.last_modified):
+            metrics.count('not_modified')
+            return not_modified_response(entry.etag, entry.last_modified, cache_control)
+
+        image_data, content_range = entry.data, None
+        if mode == 'binary' and 'range' in headers:
+            requested_range = byte_range(headers['range'], len(entry.data))
+            if requested_range is False:
+                return range_not_satisfiable_response(len(entry.data))
+            if requested_range is not None:
+                start, end = requested_range
+                image_data = entry.data[start:end + 1]
+                content_range = f'bytes {start}-{end}/{len(entry.data)}'
+        return object_response(image_data, entry.content_type,
+                               cache_headers(entry.etag, entry.last_modified, cache_control), mode, content_range)
+
+    params = conditional_get_params(headers, allow_range=mode == 'binary')
+    try:
+        with metrics.timer('s3_get'):
+            s3_object = s3.get_object(Bucket=bucket_name, Key=s3_key, **params)
+    except ClientError as e:
+        if is_not_modified(e):
+            metrics.count('not_modified')
+            response_headers = e.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+            return not_modified_response(response_headers.get('etag'), response_headers.get('last-modified'),
+                                         cache_control)
+        if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 416 or \
+                e.response['Error']['Code'] == 'InvalidRange':
+            return range_not_satisfiable_response()
+        raise
+
+    with metrics.timer('s3_get'):
+        image_data = s3_object['Body'].read()
+    return object_response(image_data, s3_object.get('ContentType'),
+                           cache_headers(s3_object.get('ETag'), s3_object.get('LastModified'), cache_control),
+                           mode, s3_object.get('ContentRange'))
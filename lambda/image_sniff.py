@@ -0,0 +1,164 @@
+import io
+import struct
+from typing import Optional
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# JPEG markers that stand alone, without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+
+# Start-of-frame markers carry the image size; C4, C8 and CC share the range but are not frames
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# Bytes every complete file of the format ends with
+TRAILERS = {
+    'PNG': b'IEND\xaeB`\x82',
+    'JPEG': b'\xff\xd9',
+    'GIF': b';',
+}
+
+# Formats cameras and phones append data to after the end marker: padding, Samsung SEFT trailers, the video
+# of a motion photo. A missing marker can't tell those from a truncated file.
+TRAILING_DATA_FORMATS = {'JPEG'}
+
+# Formats decoded at full size, JPEGs are decoded at a reduced scale (draft mode)
+FULL_DECODE_FORMATS = {'PNG', 'GIF'}
+
+# Bytes of a skipped JPEG segment read at a time
+SKIP_CHUNK_SIZE = 64 * 1024
+
+
+class ImageInfo:
+    """Format and pixel dimensions read from an image header."""
+
+    def __init__(self, image_format: str, width: int, height: int):
+        self.format = image_format
+        self.width = width
+        self.height = height
+
+    def __repr__(self):
+        return f'ImageInfo({self.format!r}, {self.width}, {self.height})'
+
+
+def _read_exactly(stream, size: int) -> bytes:
+    # Raw streams may return fewer bytes than asked for before the end of the file
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _skip(stream, size: int) -> bool:
+    # Reads past a segment a chunk at a time, so its content is never held whole
+    while size > 0:
+        chunk = stream.read(min(size, SKIP_CHUNK_SIZE))
+        if not chunk:
+            return False
+        size -= len(chunk)
+    return True
+
+
+def _jpeg_size(stream, pending: bytes = b'') -> Optional[tuple]:
+    # Walks the segments following SOI by their length, however much metadata sits before the frame header.
+    # `pending` holds the bytes of the first marker already read from the stream.
+    while True:
+        marker_bytes = pending + _read_exactly(stream, 2 - len(pending))
+        pending = b''
+        if len(marker_bytes) < 2:
+            return None
+        if marker_bytes[0] != 0xFF:
+            raise ValueError('Corrupt JPEG marker')
+        marker = marker_bytes[1]
+        while marker == 0xFF:
+            # Fill bytes before the actual marker
+            next_byte = _read_exactly(stream, 1)
+            if not next_byte:
+                return None
+            marker = next_byte[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker == 0xDA:
+            raise ValueError('JPEG has no frame header before its scan data')
+
+        length_bytes = _read_exactly(stream, 2)
+        if len(length_bytes) < 2:
+            return None
+        segment_length, = struct.unpack('>H', length_bytes)
+        if segment_length < 2:
+            raise ValueError('Corrupt JPEG segment length')
+        if marker in JPEG_SOF_MARKERS:
+            frame_header = _read_exactly(stream, 5)
+            if len(frame_header) < 5:
+                return None
+            height, width = struct.unpack('>HH', frame_header[1:5])
+            return width, height
+        if not _skip(stream, segment_length - 2):
+            return None
+
+
+def sniff_stream(stream) -> Optional[ImageInfo]:
+    """
+    Reads the format and dimensions of a PNG, JPEG or GIF from the start of a file object.
+
+    Nothing is decoded. PNG and GIF store their size in the first 24 bytes. A JPEG's size is in its first
+    start-of-frame segment, which sits after the metadata segments (EXIF, ICC profiles, XMP with an embedded
+    preview). Those are skipped by their length, a chunk at a time, so only the segments before the frame
+    header are read, whatever their size.
+
+    Args:
+        stream: A binary file object positioned at the start of the file.
+
+    Returns:
+        Optional[ImageInfo]: The image info, or None if the file ends before its size.
+
+    Raises:
+        ValueError: If the bytes are not a PNG, JPEG or GIF, or their header is corrupt.
+    """
+    header = _read_exactly(stream, 3)
+    if header == b'\xff\xd8\xff':
+        size = _jpeg_size(stream, pending=b'\xff')
+        return ImageInfo('JPEG', *size) if size else None
+
+    header += _read_exactly(stream, 21)
+    if header.startswith(PNG_SIGNATURE):
+        if len(header) < 24:
+            return None
+        if header[12:16] != b'IHDR':
+            raise ValueError('PNG does not start with an IHDR chunk')
+        width, height = struct.unpack('>II', header[16:24])
+        return ImageInfo('PNG', width, height)
+
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        if len(header) < 10:
+            return None
+        width, height = struct.unpack('<HH', header[6:10])
+        return ImageInfo('GIF', width, height)
+
+    raise ValueError('File content is not a png, jpg or gif image')
+
+
+def sniff_image(header: bytes) -> Optional[ImageInfo]:
+    """
+    Reads the format and dimensions of a PNG, JPEG or GIF from the first bytes of the file.
+
+    Returns:
+        Optional[ImageInfo]: The image info, or None if the header is too short to find the size.
+
+    Raises:
+        ValueError: If the bytes are not a PNG, JPEG or GIF, or their header is corrupt.
+    """
+    return sniff_stream(io.BytesIO(header))
+
+
+def is_complete(image_format: str, trailer: bytes) -> bool:
+    """
+    Checks that the last bytes of a file contain the marker a complete file of its format ends with.
+
+    The marker only has to appear somewhere in `trailer`, since some encoders pad or append bytes after it.
+    Formats in TRAILING_DATA_FORMATS can carry any amount of data after it, callers should only warn about
+    those when the marker is missing.
+    """
+    return TRAILERS[image_format] in trailer
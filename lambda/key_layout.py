@@ -0,0 +1,112 @@
+import hashlib
+from typing import Optional
+from config import *
+
+KEY_LAYOUTS = ('flat', 'hashed')
+
+# Content-Type of each extra encoding a rendition can be stored in, by its THUMBNAIL_VARIANT_FORMATS name
+VARIANT_CONTENT_TYPES = {'webp': 'image/webp', 'avif': 'image/avif'}
+
+
+def shard(file_name: str) -> str:
+    # Evenly spread, stable prefix of a file name, S3 scales request rate per prefix
+    return hashlib.md5(file_name.encode('utf-8')).hexdigest()[:KEY_SHARD_CHARS]
+
+
+def _split_extension(s3_key: str) -> tuple:
+    dot = s3_key.rfind('.')
+    return (s3_key[:dot], s3_key[dot:]) if dot > s3_key.rfind('/') else (s3_key, '')
+
+
+def original_key(file_name: str, layout: str = KEY_LAYOUT) -> str:
+    """
+    Returns the key an original is stored under.
+
+    'flat' keeps the file name at the bucket root. 'hashed' puts it under ORIGINALS_PREFIX and a shard of
+    its hash, e.g. 'originals/3f/img.png'.
+    """
+    if layout == 'flat':
+        return file_name
+    if layout == 'hashed':
+        return f'{ORIGINALS_PREFIX}{shard(file_name)}/{file_name}'
+    raise ValueError(f"Unknown key layout '{layout}'")
+
+
+def thumbnail_key(source_key: str, size_name: str, layout: str = KEY_LAYOUT) -> str:
+    """
+    Returns the key of a rendition of the original stored under `source_key`.
+
+    The default size keeps the original '-thumbnail' suffix, other sizes add their name. In the 'hashed'
+    layout renditions live in their own RENDITIONS_PREFIX tree, with the shard of their original.
+    """
+    stem, extension = _split_extension(source_key)
+    suffix = '-thumbnail' if size_name == DEFAULT_THUMBNAIL_SIZE else f'-thumbnail-{size_name}'
+    if layout == 'hashed' and stem.startswith(ORIGINALS_PREFIX):
+        stem = RENDITIONS_PREFIX + stem[len(ORIGINALS_PREFIX):]
+    return stem + suffix + extension
+
+
+def variant_key(rendition_key: str, variant_format: str) -> str:
+    # Appended rather than swapped, so the renditions of a.png and a.jpg keep distinct variants
+    return f'{rendition_key}.{variant_format}'
+
+
+def _split_variant(s3_key: str) -> tuple:
+    base, _, variant_format = s3_key.rpartition('.')
+    return (base, f'.{variant_format}') if variant_format in VARIANT_CONTENT_TYPES and base else (s3_key, '')
+
+
+def _rendition_size(s3_key: str) -> Optional[str]:
+    stem, _ = _split_extension(_split_variant(s3_key)[0])
+    if stem.endswith('-thumbnail'):
+        return DEFAULT_THUMBNAIL_SIZE
+    return next((size_name for size_name in THUMBNAIL_SIZES if stem.endswith(f'-thumbnail-{size_name}')), None)
+
+
+def is_reserved_name(file_name: str) -> bool:
+    # Names a flat-layout rendition could have, refused in every layout so originals can be migrated between them
+    return _rendition_size(file_name) is not None
+
+
+def is_rendition_key(s3_key: str, layout: str = KEY_LAYOUT) -> bool:
+    if layout == 'hashed':
+        return s3_key.startswith(RENDITIONS_PREFIX)
+    return _rendition_size(s3_key) is not None
+
+
+def parse_key(s3_key: str, layout: str) -> tuple:
+    """
+    Splits a key of the given layout into the file name of its original and its rendition size.
+
+    Returns:
+        tuple: (file name, size name), the size is None for originals.
+
+    Raises:
+        ValueError: If the key doesn't belong to the layout.
+    """
+    size_name = _rendition_size(s3_key)
+    if layout == 'hashed':
+        for prefix in (ORIGINALS_PREFIX, RENDITIONS_PREFIX):
+            if s3_key.startswith(prefix):
+                shard_name, _, file_name = s3_key[len(prefix):].partition('/')
+                if not shard_name or not file_name:
+                    raise ValueError(f"{s3_key} has no shard segment")
+                s3_key = file_name
+                break
+        else:
+            raise ValueError(f"{s3_key} is not a key of the hashed layout")
+    if size_name is not None:
+        stem, extension = _split_extension(s3_key)
+        suffix = '-thumbnail' if size_name == DEFAULT_THUMBNAIL_SIZE else f'-thumbnail-{size_name}'
+        s3_key = stem[:-len(suffix)] + extension
+    return s3_key, size_name
+
+
+def remap_key(s3_key: str, from_layout: str, to_layout: str) -> str:
+    # The key of the same object in another layout
+    s3_key, variant_extension = _split_variant(s3_key)
+    file_name, size_name = parse_key(s3_key, from_layout)
+    source_key = original_key(file_name, to_layout)
+    if size_name is None:
+        return source_key + variant_extension
+    return thumbnail_key(source_key, size_name, to_layout) + variant_extension
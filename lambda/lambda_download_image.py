@@ -1,28 +1,26 @@
-import boto3
-import base64
+import cold_start
+import metrics
+from aws_clients import client
 from config import *
+from content_store import resolve_key
+from download_responses import download_response
 import json
 
-s3 = boto3.client('s3')
+s3 = client('s3')
 bucket_name = S3_BUCKET_NAME
 
 
+@metrics.instrument
 def lambda_handler(event, context):
+    cold_start.report(getattr(context, 'function_name', None))
     try:
         # Get the file name from the API path parameters
         file_name = event['queryStringParameters']['file_name']
 
-        s3_key = f'{file_name}'
-        s3_object = s3.get_object(Bucket=bucket_name, Key=s3_key)
-        image_data = s3_object['Body'].read()
-
-        # Encode the image as base64
-        image_base64 = base64.b64encode(image_data).decode('utf-8')
-
-        return {
-            'statusCode': 200,
-            'body': json.dumps({'image_data': image_base64})
-        }
+        # The key of the file name in KEY_LAYOUT, or the digest key its ref points at in content-addressed mode
+        with metrics.timer('resolve'):
+            s3_key = resolve_key(s3, bucket_name, file_name)
+        return download_response(s3, bucket_name, s3_key, event)
     except Exception as e:
         return {
             'statusCode': 500,
@@ -1,28 +1,250 @@
-import boto3
-import base64
+import cold_start
+import metrics
+from aws_clients import client
 from config import *
+from botocore.exceptions import ClientError
+from byte_cache import ByteCache
+from content_store import resolve_key
+from datetime import datetime, timezone
+from download_responses import accepted_media_types, cached_object, download_response, request_headers
+from key_layout import VARIANT_CONTENT_TYPES, thumbnail_key, variant_key
+from renditions import is_missing, store_renditions, stored_variants
 import json
+import logging
+import time
+import uuid
 
-s3 = boto3.client('s3')
+s3 = client('s3')
 bucket_name = S3_BUCKET_NAME
 
+# Set up logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
+# Hot thumbnails stay in memory across warm invocations of this container
+thumbnail_cache = ByteCache(THUMBNAIL_CACHE_MAX_BYTES, THUMBNAIL_CACHE_TTL,
+                            THUMBNAIL_CACHE_MAX_ENTRY_BYTES) if THUMBNAIL_CACHE_MAX_BYTES > 0 else None
+
+# Variant keys found missing, with the time they are tried again, for renditions that don't list their variants
+missing_variants = {}
+MISSING_VARIANTS_MAX_ENTRIES = 10000
+
+
+def serve_object(s3_key, event):
+    # A redirect never reads the object, so check it exists before sending the client to it
+    if DOWNLOAD_RESPONSE_MODE == 'redirect' and (LAZY_THUMBNAILS or THUMBNAIL_VARIANT_FORMATS):
+        s3.head_object(Bucket=bucket_name, Key=s3_key)
+    return download_response(s3, bucket_name, s3_key, event, cache_control=THUMBNAIL_CACHE_CONTROL,
+                             cache=thumbnail_cache)
+
+
+def rendition_variants(s3_key):
+    """
+    Returns the variants a rendition lists in its metadata, or None when they aren't known.
+
+    The rendition is read through the thumbnail cache, where it is usually served from anyway. Without the
+    cache, or in redirect mode where the cache isn't used, reading it would cost a request of its own.
+
+    Raises:
+        ClientError: If the rendition itself doesn't exist.
+    """
+    if thumbnail_cache is None or DOWNLOAD_RESPONSE_MODE == 'redirect':
+        return None
+    return stored_variants(cached_object(s3, thumbnail_cache, bucket_name, s3_key).metadata)
+
+
+def is_known_missing(s3_key):
+    expires_at = missing_variants.get(s3_key)
+    return expires_at is not None and time.monotonic() < expires_at
+
+
+def remember_missing(s3_key):
+    if len(missing_variants) >= MISSING_VARIANTS_MAX_ENTRIES:
+        missing_variants.clear()
+    missing_variants[s3_key] = time.monotonic() + THUMBNAIL_CACHE_TTL
+
+
+def serve_thumbnail(s3_key, event):
+    """
+    Serves a rendition in the smallest of its variants the client's Accept header lists.
+
+    Only variants smaller than the rendition are stored, and the rendition's metadata lists them smallest
+    first, so only those are requested. For renditions whose variants aren't known, they are tried in
+    THUMBNAIL_VARIANT_FORMATS order: a missing variant falls through to the next format and finally to the
+    rendition itself, and is not requested again for THUMBNAIL_CACHE_TTL seconds. Responses vary on Accept
+    whenever variants are enabled.
+
+    Raises:
+        ClientError: If the rendition itself doesn't exist.
+    """
+    accepted = accepted_media_types(request_headers(event or {}))
+    candidates = [variant_format for variant_format in THUMBNAIL_VARIANT_FORMATS
+                  if VARIANT_CONTENT_TYPES.get(variant_format) in accepted]
+    kept = rendition_variants(s3_key) if candidates else None
+    if kept is not None:
+        candidates = [variant_format for variant_format in kept if variant_format in candidates]
+
+    response = None
+    for variant_format in candidates:
+        key = variant_key(s3_key, variant_format)
+        if kept is None and is_known_missing(key):
+            continue
+        try:
+            response = serve_object(key, event)
+            metrics.set_property('variant', variant_format)
+            break
+        except ClientError as e:
+            if not is_missing(e):
+                raise
+            remember_missing(key)
+    if response is None:
+        response = serve_object(s3_key, event)
+
+    if THUMBNAIL_VARIANT_FORMATS:
+        response.setdefault('headers', {})['Vary'] = 'Accept'
+    return response
+
+
+def acquire_render_lock(lock_key, take_over_stale=True):
+    """
+    Claims the right to render an original's thumbnails, across all containers of the function.
+
+    The lock is an object holding a random token, written with If-None-Match: *, which S3 only accepts when
+    the key doesn't exist yet. A lock older than LAZY_RENDER_LOCK_TTL seconds was left by a render that
+    crashed, and is taken over once by overwriting it with If-Match on its ETag: the token makes every
+    lock's ETag unique, so when several invocations find the same stale lock only one overwrite succeeds.
+
+    Returns:
+        The ETag of the lock to release it with, or None when another invocation holds it.
+    """
+    try:
+        return s3.put_object(Bucket=bucket_name, Key=lock_key, Body=uuid.uuid4().hex.encode(),
+                             IfNoneMatch='*')['ETag']
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise
+
+    try:
+        lock = s3.head_object(Bucket=bucket_name, Key=lock_key)
+    except ClientError as e:
+        if is_missing(e):
+            return None
+        raise
+    lock_age = (datetime.now(timezone.utc) - lock['LastModified']).total_seconds()
+    if not (take_over_stale and lock_age > LAZY_RENDER_LOCK_TTL):
+        return None
+
+    logger.info(f"Taking over render lock {lock_key}, {lock_age:.0f}s old.")
+    try:
+        return s3.put_object(Bucket=bucket_name, Key=lock_key, Body=uuid.uuid4().hex.encode(),
+                             IfMatch=lock['ETag'])['ETag']
+    except ClientError as e:
+        # Another invocation took it over or released it first
+        if is_missing(e) or e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return None
+        raise
+
+
+def release_render_lock(lock_key, lock_etag):
+    # Only deletes the lock if it is still ours, a render that outlived the TTL may have lost it
+    try:
+        s3.delete_object(Bucket=bucket_name, Key=lock_key, IfMatch=lock_etag)
+    except ClientError as e:
+        if not (is_missing(e) or e.response['Error']['Code'] == 'PreconditionFailed'):
+            raise
+        logger.warning(f"Render lock {lock_key} was taken over before it was released.")
+
+
+def render_missing_thumbnail(file_name, s3_key, event):
+    """
+    Renders the thumbnails of an original whose renditions the SQS consumer hasn't written yet.
+
+    `file_name` is the key of the original, its digest key in content-addressed mode.
+
+    Only the invocation holding the render lock decodes the original. Concurrent requests for the same
+    image wait up to LAZY_RENDER_WAIT seconds for its result, then get a 503 with Retry-After.
+    """
+    lock_key = f'{file_name}.rendering'
+    lock_etag = acquire_render_lock(lock_key)
+    if lock_etag is not None:
+        try:
+            try:
+                with metrics.timer('s3_get'):
+                    s3_object = s3.get_object(Bucket=bucket_name, Key=file_name)
+            except ClientError as e:
+                if is_missing(e):
+                    return {
+                        'statusCode': 404,
+                        'body': json.dumps({'message': f'Image {file_name} not found'})
+                    }
+                raise
+            with metrics.timer('s3_get'):
+                image_data = s3_object['Body'].read()
+            metrics.add_bytes('source', len(image_data))
+            with metrics.timer('render'):
+                store_renditions(s3, bucket_name, file_name, image_data, s3_object['ETag'])
+            metrics.count('lazy_render')
+            logger.info(f"Thumbnails of {file_name} rendered on demand.")
+        finally:
+            release_render_lock(lock_key, lock_etag)
+        return serve_thumbnail(s3_key, event)
+
+    # Another invocation is rendering this image, wait for its result instead of rendering it again
+    metrics.count('render_wait')
+    deadline = time.monotonic() + LAZY_RENDER_WAIT
+    delay = 0.1
+    while time.monotonic() + delay < deadline:
+        with metrics.timer('render_wait'):
+            time.sleep(delay)
+        delay = min(delay * 2, 1.0)
+        try:
+            return serve_thumbnail(s3_key, event)
+        except ClientError as e:
+            if not is_missing(e):
+                raise
+
+    return {
+        'statusCode': 503,
+        'headers': {'Retry-After': str(max(1, round(LAZY_RENDER_WAIT)))},
+        'body': json.dumps({'message': f'Thumbnail of {file_name} is being generated, retry later'})
+    }
+
+
+@metrics.instrument
 def lambda_handler(event, context):
+    cold_start.report(getattr(context, 'function_name', None))
     try:
         # Get the file name from the API path parameters
         file_name = event['queryStringParameters']['file_name']
+        size_name = event['queryStringParameters'].get('size') or DEFAULT_THUMBNAIL_SIZE
 
-        s3_key = file_name.rsplit('.', 1)[0] + '-thumbnail' + file_name[file_name.rfind('.'):]
-        s3_object = s3.get_object(Bucket=bucket_name, Key=s3_key)
-        image_data = s3_object['Body'].read()
+        if size_name not in THUMBNAIL_SIZES:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({'message': f"Unknown thumbnail size '{size_name}'. "
+                                               f"Available sizes are: {', '.join(THUMBNAIL_SIZES)}"})
+            }
 
-        # Encode the image as base64
-        image_base64 = base64.b64encode(image_data).decode('utf-8')
+        # Thumbnails belong to the digest key in content-addressed mode, shared by every copy of the bytes
+        try:
+            with metrics.timer('resolve'):
+                original_key = resolve_key(s3, bucket_name, file_name)
+        except ClientError as e:
+            if not is_missing(e):
+                raise
+            return {
+                'statusCode': 404,
+                'body': json.dumps({'message': f'Image {file_name} not found'})
+            }
 
-        return {
-            'statusCode': 200,
-            'body': json.dumps({'image_data': image_base64})
-        }
+        s3_key = thumbnail_key(original_key, size_name)
+        metrics.set_property('size', size_name)
+        try:
+            return serve_thumbnail(s3_key, event)
+        except ClientError as e:
+            if not (LAZY_THUMBNAILS and is_missing(e)):
+                raise
+        return render_missing_thumbnail(original_key, s3_key, event)
     except Exception as e:
         return {
             'statusCode': 500,
@@ -1,34 +1,144 @@
-import boto3
+import cold_start
+import metrics
+from aws_clients import client
 import json
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import unquote_plus
+from config import *
+from content_store import CONTENT_KEY_METADATA, is_ref
+from key_layout import is_rendition_key
+from renditions import rendition_metadata, renditions_up_to_date, store_renditions
 
 
-s3 = boto3.client('s3')
+s3 = client('s3')
 
-def lambda_handler(event, context):
-    """"""
+# Set up logging
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def source_objects(message_body):
+    # Messages from lambda_upload name the object directly, S3 event notifications wrap it in Records
+    if message_body.get('Event') == 's3:TestEvent':
+        return []
+    if 'Records' in message_body:
+        # Our own rendition writes raise ObjectCreated events too, only originals are rendered
+        s3_objects = [(s3_record['s3']['bucket']['name'], unquote_plus(s3_record['s3']['object']['key']))
+                      for s3_record in message_body['Records'] if s3_record.get('eventSource') == 'aws:s3']
+        return [(bucket_name, s3_key) for bucket_name, s3_key in s3_objects if not is_rendition_key(s3_key)]
+    return [(message_body['bucket'], message_body['key'])]
+
+
+def process_record(record):
+    message_body = json.loads(record['body'])
+    for bucket_name, s3_key in source_objects(message_body):
+        process_object(bucket_name, s3_key)
+
+
+def process_object(bucket_name, s3_key):
+    # Get the object from S3, the body is only read if the renditions are missing or stale
+    with metrics.timer('s3_get'):
+        s3_object = s3.get_object(Bucket=bucket_name, Key=s3_key)
+    source_etag = s3_object['ETag']
+
+    # A content-addressed ref is empty, the original it points at is queued under its own key
+    metadata = s3_object.get('Metadata', {})
+    if is_ref(metadata):
+        s3_object['Body'].close()
+        logger.info(f"{s3_key} is a ref to {metadata[CONTENT_KEY_METADATA]}, skipping.")
+        metrics.count('objects_skipped')
+        return
+
+    # Inline uploads record their dimensions, oversized images fail without their body being read
+    if 'width' in metadata and 'height' in metadata and \
+            int(metadata['width']) * int(metadata['height']) > MAX_IMAGE_PIXELS:
+        s3_object['Body'].close()
+        raise ValueError(f"{s3_key} is {metadata['width']}x{metadata['height']}, limit is {MAX_IMAGE_PIXELS} pixels")
+
+    renditions = rendition_metadata(s3, bucket_name, s3_key)
+    if renditions_up_to_date(renditions, source_etag):
+        s3_object['Body'].close()
+        logger.info(f"Thumbnails of {s3_key} are up to date, skipping.")
+        metrics.count('objects_skipped')
+        return
+
+    with metrics.timer('s3_get'):
+        image_data = s3_object['Body'].read()
+    metrics.add_bytes('source', len(image_data))
+    store_renditions(s3, bucket_name, s3_key, image_data, source_etag, replaced=renditions)
+    metrics.count('objects_rendered')
+    logger.info(f"Thumbnails of {s3_key} generated and uploaded successfully.")
+
+
+def process_batch(records, remaining_seconds):
+    """
+    Processes SQS records on a bounded pool of THUMBNAIL_CONCURRENCY workers.
+
+    Workers overlap the S3 round-trips of some records with the decode and resize of others. A record
+    fails when it runs longer than THUMBNAIL_RECORD_TIMEOUT, or when it hasn't finished
+    THUMBNAIL_TIMEOUT_MARGIN seconds before the invocation runs out of time. Threads can't be interrupted,
+    so a timed-out record is only abandoned and reported for retry.
+
+    Returns:
+        list: The messageIds of the records that failed or timed out.
+    """
+    invocation_deadline = time.monotonic() + remaining_seconds - THUMBNAIL_TIMEOUT_MARGIN
+    started = {}
+
+    def run(record):
+        started[record['messageId']] = time.monotonic()
+        process_record(record)
+
+    failed_message_ids = []
+    pool = ThreadPoolExecutor(max_workers=max(1, min(THUMBNAIL_CONCURRENCY, len(records))))
+    futures = {pool.submit(run, record): record['messageId'] for record in records}
+    pending = set(futures)
     try:
-        for record in event['Records']:
-            message_body = json.loads(record['body'])
-            bucket_name = message_body['bucket']
-            s3_key = message_body['key']
-
-
-            # Get the object from S3
-            s3_object = s3.get_object(Bucket=bucket_name, Key=s3_key)
-            image_data = s3_object['Body'].read()
-
-            # thumbnail generation
-            thumbnail_key = s3_key.rsplit('.', 1)[0] + '-thumbnail' + s3_key[s3_key.rfind('.'): ]
-
-            # Upload the same file with the new name
-            s3.put_object(Bucket=bucket_name, Key=thumbnail_key, Body=image_data)
-
-        return {
-            'statusCode': 200,
-            'body': json.dumps({'message': 'Thumbnail generated and uploaded successfully.'})
-        }
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'body': json.dumps({'message': f'Error generating thumbnail: {str(e)}'})
-        }
+        while pending:
+            now = time.monotonic()
+            # A record that starts right after this check can't expire sooner than a full record timeout
+            next_deadline = min(invocation_deadline, now + THUMBNAIL_RECORD_TIMEOUT)
+            for future in list(pending):
+                if future.done():
+                    continue
+                message_id = futures[future]
+                record_deadline = started.get(message_id, now) + THUMBNAIL_RECORD_TIMEOUT
+                if now >= min(record_deadline, invocation_deadline):
+                    future.cancel()
+                    pending.discard(future)
+                    logger.error(f"Timed out generating thumbnail for message {message_id}")
+                    failed_message_ids.append(message_id)
+                elif message_id in started:
+                    next_deadline = min(next_deadline, record_deadline)
+
+            if not pending:
+                break
+            done, pending = wait(pending, timeout=max(0.0, next_deadline - now), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    logger.error(f"Error generating thumbnail for message {futures[future]}: "
+                                 f"{str(future.exception())}")
+                    failed_message_ids.append(futures[future])
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    return failed_message_ids
+
+
+@metrics.instrument
+def lambda_handler(event, context):
+    """
+    Generates the thumbnail ladder for every record of an SQS batch.
+
+    Records are processed independently, and only the ones that failed are reported back in
+    `batchItemFailures` so SQS retries them without redelivering the rest of the batch.
+    """
+    cold_start.report(getattr(context, 'function_name', None))
+    remaining_seconds = context.get_remaining_time_in_millis() / 1000 if context else float('inf')
+    failed_message_ids = process_batch(event['Records'], remaining_seconds)
+    metrics.count('records', len(event['Records']))
+    metrics.count('records_failed', len(failed_message_ids))
+
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]}
@@ -1,26 +1,71 @@
+import cold_start
+import hashlib
+import io
 import json
-import boto3
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+from aws_clients import client
+from botocore.exceptions import ClientError
 from config import *
+from content_store import CONTENT_KEY_METADATA, content_key
+from image_sniff import FULL_DECODE_FORMATS, TRAILING_DATA_FORMATS, is_complete, sniff_stream
+from key_layout import is_reserved_name, original_key, thumbnail_key
+from renditions import is_missing
 import base64
 import logging
 
-# Initialize S3 and SQS clients
-s3_client = boto3.client('s3', region_name=AWS_REGION)
-sqs_client = boto3.client('sqs', region_name=AWS_REGION)
+# S3 and SQS clients, each built on first use
+s3_client = client('s3')
+sqs_client = client('sqs')
 
 # Set up logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Messages per send_message_batch call, the SQS maximum
+SQS_BATCH_SIZE = 10
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
+# Content-Type a presigned upload must be sent with, per extension
+CONTENT_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'gif': 'image/gif'}
+
+# Content-Type an inline upload is stored with, per format found in its header
+FORMAT_CONTENT_TYPES = {'PNG': 'image/png', 'JPEG': 'image/jpeg', 'GIF': 'image/gif'}
+
+# Decoded bytes per read while looking for the image size, a JPEG's metadata segments are skipped a chunk at a time
+SNIFF_CHUNK_SIZE = 16 * 1024
+
+# Decoded bytes at the end of the content searched for the end marker, encoders may pad or append after it
+TRAILER_BYTES = 64 * 1024
+
+# Characters a base64 string may be broken up with
+BASE64_WHITESPACE = (' ', '\n', '\r', '\t')
+
 
 # Function to check allowed file extensions
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def check_reserved_name(filename):
+    # An original named like a rendition would be skipped by the thumbnail function and overwrite a rendition
+    if is_reserved_name(filename):
+        logger.error(f"Reserved file name: {filename}")
+        raise ValueError(f"File names may not end in -thumbnail or -thumbnail-<size>: {filename}")
+
+
+def transfer_config():
+    # Inline uploads are streamed to S3 in parts of UPLOAD_PART_SIZE, at most UPLOAD_MAX_CONCURRENCY at a time
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=UPLOAD_PART_SIZE,
+        multipart_chunksize=UPLOAD_PART_SIZE,
+        max_concurrency=UPLOAD_MAX_CONCURRENCY
+    )
+
+
 def correct_base64_padding(encoded_str):
     # Add the correct padding to base64 string if it's not padded correctly
     padding = len(encoded_str) % 4
@@ -29,13 +74,353 @@ def correct_base64_padding(encoded_str):
     return encoded_str
 
 
+class Base64Reader(io.RawIOBase):
+    """
+    Read-only file object that decodes a base64 string a chunk at a time.
+
+    Lets upload_fileobj stream the decoded bytes to S3 without ever holding the padded string or the whole
+    decoded file in memory. Whitespace is skipped and missing padding is added at the end, like
+    correct_base64_padding does for the whole string. Any other character outside the base64 alphabet
+    raises binascii.Error (a ValueError) instead of being dropped. Decoded bytes wait in a bytearray that
+    is consumed from the front in place, so a read doesn't copy what is left of the chunk.
+    """
+
+    def __init__(self, encoded: str, chunk_size: int = BASE64_CHUNK_SIZE):
+        self._encoded = encoded
+        self._chunk_chars = chunk_size - chunk_size % 4
+        self._position = 0
+        self._carry = ''
+        self._pending = bytearray()
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def _decode_next_chunk(self):
+        text = self._carry + ''.join(self._encoded[self._position:self._position + self._chunk_chars].split())
+        self._position += self._chunk_chars
+        if self._position >= len(self._encoded):
+            text, self._carry = correct_base64_padding(text), ''
+        else:
+            # Only whole 4 character groups can be decoded, the rest waits for the next chunk
+            usable = len(text) - len(text) % 4
+            text, self._carry = text[:usable], text[usable:]
+        self._pending += base64.b64decode(text, validate=True)
+
+    def readinto(self, buffer):
+        while len(self._pending) < len(buffer) and self._position < len(self._encoded):
+            self._decode_next_chunk()
+        size = min(len(buffer), len(self._pending))
+        with memoryview(self._pending) as pending:
+            buffer[:size] = pending[:size]
+        del self._pending[:size]
+        self.bytes_read += size
+        return size
+
+
+def decode_trailer(encoded, size=TRAILER_BYTES):
+    """
+    Decodes the last `size` bytes (or a little more) of base64 content without decoding the rest.
+
+    Groups of 4 characters can only be aligned from the end once whitespace is left out, so the
+    non-whitespace characters are counted first.
+    """
+    whitespace = sum(encoded.count(character) for character in BASE64_WHITESPACE)
+    content_chars = len(encoded) - whitespace
+    wanted = size * 4 // 3 + 8
+    raw_chars = wanted
+    while True:
+        tail = ''.join(encoded[-raw_chars:].split())
+        if len(tail) >= wanted or raw_chars >= len(encoded):
+            break
+        raw_chars *= 2
+
+    padding = len(tail) - len(tail.rstrip('='))
+    tail = tail.rstrip('=')
+    # Skip the characters of the group the tail starts in the middle of
+    offset = -(content_chars - padding - len(tail)) % 4
+    return base64.b64decode(correct_base64_padding(tail[offset:]))
+
+
+def inspect_content(encoded):
+    """
+    Validates an inline upload by decoding only its header segments and its last bytes.
+
+    Rejects content that isn't a PNG, JPEG or GIF whatever its extension, images declaring more than
+    MAX_IMAGE_PIXELS pixels (MAX_FULL_DECODE_PIXELS for PNGs and GIFs, which are decoded at full size),
+    and files cut short, before anything is written to S3 or SQS. A JPEG without its end marker in the
+    last TRAILER_BYTES is only logged: data after the marker is common, and a truncated file fails in the
+    thumbnail function's decode.
+
+    Returns:
+        ImageInfo: The format and dimensions read from the header.
+    """
+    image_info = sniff_stream(Base64Reader(encoded, chunk_size=SNIFF_CHUNK_SIZE))
+    if image_info is None:
+        raise ValueError('Image header is truncated or has no size')
+
+    max_pixels = min(MAX_IMAGE_PIXELS, MAX_FULL_DECODE_PIXELS) if image_info.format in FULL_DECODE_FORMATS \
+        else MAX_IMAGE_PIXELS
+    if image_info.width * image_info.height > max_pixels:
+        raise ValueError(f'Image is {image_info.width}x{image_info.height}, '
+                         f'limit is {max_pixels} pixels')
+
+    if not is_complete(image_info.format, decode_trailer(encoded)):
+        if image_info.format not in TRAILING_DATA_FORMATS:
+            raise ValueError('Image file is truncated')
+        logger.warning(f"No end marker in the last {TRAILER_BYTES} bytes of the {image_info.format}, "
+                       f"it has trailing data or is truncated.")
+    return image_info
+
+
+def presign_upload(file):
+    """
+    Validates an upload request and creates a presigned POST that lets the client send the bytes straight to S3.
+
+    The policy pins the key and Content-Type and caps the size at UPLOAD_MAX_BYTES. Thumbnail generation
+    is triggered by the bucket's ObjectCreated:Post notification once the object lands, not by this function.
+    """
+    filename = file['filename']
+    if not allowed_file(filename) or '/' in filename or filename.startswith('.'):
+        logger.error(f"Invalid file name: {filename}")
+        raise ValueError('File format not allowed. Allowed formats are: png, jpg, jpeg, gif')
+    check_reserved_name(filename)
+
+    content_type = CONTENT_TYPES[filename.rsplit('.', 1)[1].lower()]
+    if file.get('content_type', content_type) != content_type:
+        logger.error(f"Invalid content type {file['content_type']} for {filename}")
+        raise ValueError(f"Content type of {filename} must be {content_type}")
+
+    presigned_post = s3_client.generate_presigned_post(
+        Bucket=S3_BUCKET_NAME,
+        Key=original_key(filename),
+        Fields={'Content-Type': content_type},
+        Conditions=[{'Content-Type': content_type}, ['content-length-range', 1, UPLOAD_MAX_BYTES]],
+        ExpiresIn=UPLOAD_URL_EXPIRY
+    )
+    logger.info(f"Presigned upload created for file {filename}.")
+    return presigned_post
+
+
+def file_url(file_name):
+    return f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{original_key(file_name)}"
+
+
+def create_presigned_upload(file):
+    presigned_post = presign_upload(file)
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': "Send the file as a multipart/form-data POST to the returned url with the returned fields.",
+            'upload': presigned_post,
+            'expires_in': UPLOAD_URL_EXPIRY,
+            'file_url': file_url(file['filename'])
+        })
+    }
+
+
+def file_digest(encoded):
+    # One pass over the decoded content, a chunk at a time
+    digest = hashlib.sha256()
+    file_content = Base64Reader(encoded)
+    for chunk in iter(lambda: file_content.read(BASE64_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    return digest.hexdigest(), file_content.bytes_read
+
+
+def store_content(file, extra_args):
+    """
+    Stores an inline upload under the sha256 digest of its bytes, with its file name as a ref to it.
+
+    When the default rendition of that digest already exists, the same bytes were uploaded and rendered
+    before: only the ref is written, and nothing has to be queued.
+
+    Returns:
+        tuple: The key thumbnails are rendered from (None for known content) and the file size in bytes.
+    """
+    with metrics.timer('digest'):
+        digest, size = file_digest(file['content'])
+    s3_key = content_key(digest, extra_args['Metadata']['format'])
+    try:
+        with metrics.timer('s3_head'):
+            s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=thumbnail_key(s3_key, DEFAULT_THUMBNAIL_SIZE))
+        is_known = True
+    except ClientError as e:
+        if not is_missing(e):
+            raise
+        is_known = False
+
+    with metrics.timer('s3_put'):
+        if not is_known:
+            s3_client.upload_fileobj(Base64Reader(file['content']), S3_BUCKET_NAME, s3_key, ExtraArgs=extra_args,
+                                     Config=transfer_config())
+
+        s3_client.put_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=original_key(file['filename']),
+            Body=b'',
+            ContentType=extra_args['ContentType'],
+            Metadata={**extra_args['Metadata'], CONTENT_KEY_METADATA: s3_key}
+        )
+    metrics.add_bytes('upload', size)
+    metrics.count('content_known', int(is_known))
+    logger.info(f"File {file['filename']} ({size} bytes) stored as {s3_key}"
+                f"{', content already known' if is_known else ''}.")
+    return (None if is_known else s3_key), size
+
+
+def store_file(file):
+    """
+    Validates an inline upload and streams its decoded content to S3.
+
+    Returns:
+        tuple: The key thumbnails are rendered from, None when its content is already stored and rendered
+        (content-addressed mode only), and the size of the file in bytes.
+    """
+    # Validate file type
+    if not allowed_file(file['filename']):
+        logger.error(f"Invalid file type: {file['filename']}")
+        raise ValueError('File format not allowed. Allowed formats are: png, jpg, jpeg, gif')
+    check_reserved_name(file['filename'])
+
+    # Check the content really is an image of a size we can render, from its header only
+    with metrics.timer('validate'):
+        image_info = inspect_content(file['content'])
+    logger.info(f"File {file['filename']} passed validation: "
+                f"{image_info.format} {image_info.width}x{image_info.height}.")
+
+    # The dimensions are kept as metadata so later stages don't have to read the header again
+    extra_args = {
+        'ContentType': FORMAT_CONTENT_TYPES[image_info.format],
+        'Metadata': {
+            'format': image_info.format,
+            'width': str(image_info.width),
+            'height': str(image_info.height)
+        }
+    }
+    if CONTENT_ADDRESSED_STORAGE:
+        return store_content(file, extra_args)
+
+    # Decode the base64 content chunk by chunk while it is uploaded to S3, in parts for large files
+    s3_key = original_key(file['filename'])
+    file_content = Base64Reader(file['content'])
+    with metrics.timer('s3_put'):
+        s3_client.upload_fileobj(
+            file_content,
+            S3_BUCKET_NAME,
+            s3_key,
+            ExtraArgs=extra_args,
+            Config=transfer_config()
+        )
+    metrics.add_bytes('upload', file_content.bytes_read)
+    logger.info(f"File {file['filename']} ({file_content.bytes_read} bytes) uploaded to S3 successfully.")
+    return s3_key, file_content.bytes_read
+
+
+def thumbnail_job(s3_key):
+    # Message asking lambda_generate_thumbnail to render an original
+    return json.dumps({'bucket': S3_BUCKET_NAME, 'key': s3_key})
+
+
+def enqueue_thumbnail_jobs(s3_keys):
+    """
+    Queues thumbnail jobs with send_message_batch, 10 messages per call (the SQS maximum).
+
+    Returns:
+        set: The keys whose message SQS did not accept.
+    """
+    failed_keys = set()
+    for start in range(0, len(s3_keys), SQS_BATCH_SIZE):
+        group = s3_keys[start:start + SQS_BATCH_SIZE]
+        try:
+            with metrics.timer('sqs_send'):
+                response = sqs_client.send_message_batch(
+                    QueueUrl=SQS_QUEUE_NAME,
+                    Entries=[{'Id': str(index), 'MessageBody': thumbnail_job(s3_key)}
+                             for index, s3_key in enumerate(group)]
+                )
+        except Exception as e:
+            logger.error(f"Error sending thumbnail jobs to SQS: {str(e)}")
+            failed_keys.update(group)
+            continue
+        for failure in response.get('Failed', []):
+            logger.error(f"SQS rejected thumbnail job for {group[int(failure['Id'])]}: {failure.get('Message')}")
+            failed_keys.add(group[int(failure['Id'])])
+    return failed_keys
+
+
+def upload_batch_file(file, mode):
+    # Per-file result of a batch upload, errors are reported instead of failing the whole batch
+    result = {'filename': file.get('filename')}
+    try:
+        if file.get('mode', mode) == 'presigned':
+            result.update(status='presigned', upload=presign_upload(file), expires_in=UPLOAD_URL_EXPIRY)
+        else:
+            source_key, size = store_file(file)
+            result.update(status='uploaded', size=size, source_key=source_key)
+        result['file_url'] = file_url(file['filename'])
+    except Exception as e:
+        logger.error(f"Error uploading {file.get('filename')}: {str(e)}")
+        result.update(status='error', message=f"Error: {str(e)}")
+    return result
+
+
+def upload_batch(body):
+    """
+    Handles /upload-batch: many inline files or presigned upload requests in one call.
+
+    Inline files are written to S3 concurrently, then their thumbnail jobs are queued in batches of 10
+    (in the 'sqs' pipeline mode). Presigned requests are queued by the bucket notification once the
+    client's POST lands.
+    """
+    files = body.get('files')
+    if not files:
+        raise ValueError('No files provided in the request')
+    if len(files) > UPLOAD_BATCH_MAX_FILES:
+        raise ValueError(f'At most {UPLOAD_BATCH_MAX_FILES} files can be uploaded per batch')
+
+    mode = body.get('mode', 'inline')
+    metrics.set_property('mode', 'batch')
+    metrics.count('files', len(files))
+    with ThreadPoolExecutor(max_workers=UPLOAD_BATCH_CONCURRENCY) as pool:
+        results = list(pool.map(lambda file: upload_batch_file(file, mode), files))
+
+    uploaded = [result for result in results if result['status'] == 'uploaded']
+    # Content that is already rendered has no job. In the s3-events pipeline the bucket notification
+    # has already queued the rest.
+    source_keys = list(dict.fromkeys(result['source_key'] for result in uploaded if result['source_key']))
+    failed_keys = enqueue_thumbnail_jobs(source_keys) if PIPELINE_MODE == 'sqs' else set()
+    for result in uploaded:
+        source_key = result.pop('source_key')
+        result['queued'] = source_key is not None and source_key not in failed_keys
+    metrics.count('files_failed', sum(result['status'] == 'error' for result in results))
+    metrics.count('jobs_queued', len(source_keys) - len(failed_keys))
+    logger.info(f"Batch of {len(files)} files: {len(uploaded)} uploaded, "
+                f"{len(source_keys) - len(failed_keys)} queued.")
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'results': results})
+    }
+
+
+@metrics.instrument
 def lambda_handler(event, context):
+    cold_start.report(getattr(context, 'function_name', None))
     try:
         logger.info("Lambda function started.")
 
         # Parse the body of the request
-        body = json.loads(event['body'])
-        logger.info(f"Request body: {body}")
+        with metrics.timer('parse'):
+            body = json.loads(event['body'])
+
+        if event.get('resource') == f'/{UPLOAD_BATCH_PART}':
+            return upload_batch(body)
+
+        # Only the request metadata is logged, never the content
+        logger.info(f"Request mode: {body.get('mode', 'inline')}, "
+                    f"file: {body.get('file', {}).get('filename')}, "
+                    f"content length: {len(body.get('file', {}).get('content', ''))}")
 
         if 'file' not in body:
             logger.error("No file provided in the request")
@@ -43,47 +428,29 @@ def lambda_handler(event, context):
 
         file = body['file']
 
-        # Validate file type
-        if not allowed_file(file['filename']):
-            logger.error(f"Invalid file type: {file['filename']}")
-            raise ValueError('File format not allowed. Allowed formats are: png, jpg, jpeg, gif')
-
-        logger.info(f"File {file['filename']} passed validation.")
+        # Large files skip the lambda entirely and go straight to S3
+        metrics.set_property('mode', body.get('mode', 'inline'))
+        if body.get('mode') == 'presigned':
+            return create_presigned_upload(file)
 
-        # Correct the padding if necessary
-        corrected_content = correct_base64_padding(file['content'])
-        # Decode base64 content
-        file_content = base64.b64decode(corrected_content)
-        logger.info(f"File {file['filename']} decoded successfully.")
+        source_key, _ = store_file(file)
 
-        # Upload to S3
-        s3_response = s3_client.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=file['filename'],
-            Body=file_content,  # The decoded file content
-            ContentType=file['content_type']
-        )
-        logger.info(f"File {file['filename']} uploaded to S3 successfully.")
-        print('uploaded')
-
-        # Send a message to SQS for thumbnail generation
-        sqs_message = {
-            'bucket': S3_BUCKET_NAME,
-            'key': file['filename']
-        }
-
-        sqs_client.send_message(
-            QueueUrl=SQS_QUEUE_NAME,
-            MessageBody=json.dumps(sqs_message)
-        )
-        logger.info(f"Message sent to SQS for file {file['filename']}.")
+        # Send a message to SQS for thumbnail generation, unless the bucket notification does it or the
+        # content is already rendered
+        if PIPELINE_MODE == 'sqs' and source_key is not None:
+            with metrics.timer('sqs_send'):
+                sqs_client.send_message(
+                    QueueUrl=SQS_QUEUE_NAME,
+                    MessageBody=thumbnail_job(source_key)
+                )
+            logger.info(f"Message sent to SQS for file {file['filename']}.")
 
         # Return success response
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'message': f"File {file['filename']} uploaded successfully.",
-                'file_url': f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{file['filename']}"
+                'file_url': file_url(file['filename'])
             })
         }
 
@@ -0,0 +1,120 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from config import METRICS_ENABLED, METRICS_NAMESPACE
+
+# CloudWatch units of the metric name suffixes, every other metric is a count
+UNITS = {'_ms': 'Milliseconds', '_bytes': 'Bytes'}
+
+# Read on every invocation, so the load tests can switch metrics off while running handlers concurrently
+enabled = METRICS_ENABLED
+
+_lock = threading.Lock()
+_values = {}
+_properties = {}
+_invocations = 0
+
+
+def _add(name, value):
+    with _lock:
+        _values[name] = _values.get(name, 0) + value
+
+
+@contextmanager
+def timer(name):
+    """
+    Adds the time spent in the block to the `<name>_ms` metric of the current invocation.
+
+    Blocks run by concurrent threads add up, so a stage of a batch reports the total time spent in it.
+    """
+    if not enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _add(f'{name}_ms', (time.perf_counter() - started) * 1000)
+
+
+def count(name, value=1):
+    if enabled:
+        _add(name, value)
+
+
+def add_bytes(name, size):
+    if enabled:
+        _add(f'{name}_bytes', size)
+
+
+def set_property(name, value):
+    # Logged with the metrics for searching and grouping, without becoming a metric
+    if enabled:
+        with _lock:
+            _properties[name] = value
+
+
+def unit(name):
+    return next((unit_name for suffix, unit_name in UNITS.items() if name.endswith(suffix)), 'Count')
+
+
+def emf_record(function_name, values, properties):
+    """
+    Builds a CloudWatch embedded metric format record: one log line CloudWatch turns into metrics.
+
+    Every value is a metric of the function's FunctionName dimension, properties are only logged.
+    """
+    return {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [['FunctionName']],
+                'Metrics': [{'Name': name, 'Unit': unit(name)} for name in values],
+            }],
+        },
+        'FunctionName': function_name,
+        **properties,
+        **{name: round(value, 3) if isinstance(value, float) else value for name, value in values.items()},
+    }
+
+
+def instrument(handler):
+    """
+    Wraps a Lambda handler to emit one metrics line per invocation.
+
+    The line holds everything the invocation recorded with timer, count and add_bytes, its total duration,
+    whether it was the container's first invocation and the status code of its response. It is written to
+    stdout as bare JSON: the logging module's prefix would keep CloudWatch from reading it as EMF.
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        global _invocations
+        if not enabled:
+            return handler(event, context)
+
+        with _lock:
+            _values.clear()
+            _properties.clear()
+            _invocations += 1
+            cold_start = _invocations == 1
+        started = time.perf_counter()
+        response = None
+        try:
+            response = handler(event, context)
+            return response
+        finally:
+            _add('duration_ms', (time.perf_counter() - started) * 1000)
+            count('cold_start', int(cold_start))
+            if isinstance(response, dict) and 'statusCode' in response:
+                set_property('status_code', response['statusCode'])
+            function_name = getattr(context, 'function_name', None) or os.getenv('AWS_LAMBDA_FUNCTION_NAME')
+            with _lock:
+                record = emf_record(function_name, dict(_values), dict(_properties))
+            sys.stdout.write(json.dumps(record) + '\n')
+            sys.stdout.flush()
+    return wrapper
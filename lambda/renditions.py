@@ -0,0 +1,91 @@
+import metrics
+from botocore.exceptions import ClientError
+from config import *
+from key_layout import VARIANT_CONTENT_TYPES, thumbnail_key, variant_key
+
+
+def is_missing(error: ClientError) -> bool:
+    # get_object reports NoSuchKey, head_object only has the status code
+    return error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound')
+
+
+# Rendition metadata listing the variants stored next to it, smallest first
+VARIANTS_METADATA = 'variants'
+
+
+def stored_variants(metadata: dict):
+    """
+    Returns the variant formats a rendition's metadata lists, or None for renditions stored before variants
+    were recorded.
+    """
+    if VARIANTS_METADATA not in metadata:
+        return None
+    return [name for name in metadata[VARIANTS_METADATA].split(',') if name]
+
+
+def rendition_metadata(s3, bucket_name, s3_key):
+    """
+    Reads the metadata of every rendition of an original.
+
+    Returns:
+        dict: Mapping of rendition name to its S3 metadata, None for the renditions that don't exist.
+    """
+    renditions = {}
+    for size_name in THUMBNAIL_SIZES:
+        try:
+            with metrics.timer('s3_head'):
+                head = s3.head_object(Bucket=bucket_name, Key=thumbnail_key(s3_key, size_name))
+            renditions[size_name] = head.get('Metadata', {})
+        except ClientError as e:
+            if not is_missing(e):
+                raise
+            renditions[size_name] = None
+    return renditions
+
+
+def renditions_up_to_date(renditions, source_etag):
+    # Every rendition records the ETag of the original it was rendered from
+    return all(metadata is not None and metadata.get('source-etag') == source_etag
+               for metadata in renditions.values())
+
+
+def store_renditions(s3, bucket_name, s3_key, image_data, source_etag, replaced=None):
+    """
+    Renders the whole THUMBNAIL_SIZES ladder of an original and uploads every rendition.
+
+    Shared by the SQS thumbnail generator and the read-through path of the thumbnail download, so both
+    produce identical renditions.
+
+    Variants in THUMBNAIL_VARIANT_FORMATS are stored next to each rendition, before it, so they are in
+    place once the rendition can be served. The rendition's metadata lists the variants kept, smallest
+    first, and only those are served. Variants listed by the renditions being `replaced` (from
+    rendition_metadata) that didn't pay off this time are deleted once the new rendition, which no longer
+    lists them, is written.
+
+    Returns:
+        dict: Mapping of rendition name to a (encoded bytes, Content-Type, variants) tuple.
+    """
+    # Pillow is only loaded by the functions that actually render
+    from thumbnail_engine import render_renditions
+
+    # thumbnail generation, every size of the ladder comes from one decode
+    renditions = render_renditions(image_data, THUMBNAIL_SIZES, THUMBNAIL_VARIANT_FORMATS)
+
+    # Upload each rendition under its own key
+    with metrics.timer('s3_put'):
+        for size_name, (thumbnail_data, content_type, variants) in renditions.items():
+            rendition_key = thumbnail_key(s3_key, size_name)
+            kept = list(variants)
+            for variant_format in kept:
+                s3.put_object(Bucket=bucket_name, Key=variant_key(rendition_key, variant_format),
+                              Body=variants[variant_format], ContentType=VARIANT_CONTENT_TYPES[variant_format],
+                              Metadata={'source-etag': source_etag})
+                metrics.add_bytes('variant', len(variants[variant_format]))
+            s3.put_object(Bucket=bucket_name, Key=rendition_key, Body=thumbnail_data, ContentType=content_type,
+                          Metadata={'source-etag': source_etag, VARIANTS_METADATA: ','.join(kept)})
+            metrics.add_bytes('thumbnail', len(thumbnail_data))
+            previous = (replaced or {}).get(size_name)
+            for variant_format in stored_variants(previous or {}) or []:
+                if variant_format not in kept:
+                    s3.delete_object(Bucket=bucket_name, Key=variant_key(rendition_key, variant_format))
+    return renditions
@@ -0,0 +1,222 @@
+import io
+import metrics
+from PIL import Image, ImageOps, features
+from config import *
+from image_sniff import FULL_DECODE_FORMATS
+
+# open_image enforces MAX_IMAGE_PIXELS itself, so Pillow's warning-then-error check is switched off
+Image.MAX_IMAGE_PIXELS = None
+
+# Decode at least this many times the target size before the final resample, as Image.thumbnail does
+REDUCING_GAP = 2.0
+
+# Content-Type of the thumbnail for each source format we accept
+CONTENT_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+}
+
+
+# Pillow format of each extra encoding a rendition can be stored in, and its quality setting
+VARIANT_ENCODERS = {'webp': 'WEBP', 'avif': 'AVIF'}
+VARIANT_QUALITY = {'WEBP': THUMBNAIL_WEBP_QUALITY, 'AVIF': THUMBNAIL_AVIF_QUALITY}
+
+
+class ImageTooLargeError(ValueError):
+    """Raised when an image header declares more pixels than its format may be decoded with."""
+
+
+def fit_size(size: tuple, max_size: int) -> tuple:
+    """
+    Computes the size of an image scaled to fit inside a max_size x max_size box, preserving aspect ratio.
+
+    Images that already fit are never upscaled.
+
+    Args:
+        size (tuple): The (width, height) of the source image.
+        max_size (int): The length of the longest side of the bounding box.
+
+    Returns:
+        tuple: The (width, height) of the scaled image.
+    """
+    width, height = size
+    scale = min(max_size / width, max_size / height, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def open_image(image_data: bytes, max_size: int) -> Image.Image:
+    """
+    Decodes an image at the smallest scale that still has enough pixels for a max_size thumbnail.
+
+    Only the header is parsed before the pixel count is checked, so decompression bombs are rejected
+    without allocating their pixel buffer. JPEGs are decoded by libjpeg at 1/2, 1/4 or 1/8 scale (draft
+    mode); other formats are decoded in full and then box-reduced by an integer factor, which keeps the
+    working set of the final resample small. Their whole pixel buffer is held at once, so they are
+    limited to MAX_FULL_DECODE_PIXELS, which is sized to the memory of the functions rendering them.
+
+    Args:
+        image_data (bytes): The encoded source image.
+        max_size (int): The longest side of the largest thumbnail that will be rendered from the image.
+
+    Returns:
+        Image.Image: The decoded, reduced image with its original format recorded in `format`.
+
+    Raises:
+        ImageTooLargeError: If the image declares more than MAX_IMAGE_PIXELS pixels, or more than
+            MAX_FULL_DECODE_PIXELS for a format decoded at full size.
+        ValueError: If the image format is not one we generate thumbnails for.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    source_format = image.format
+    if source_format not in CONTENT_TYPES:
+        raise ValueError(f'Unsupported image format: {source_format}')
+
+    width, height = image.size
+    max_pixels = min(MAX_IMAGE_PIXELS, MAX_FULL_DECODE_PIXELS) if source_format in FULL_DECODE_FORMATS \
+        else MAX_IMAGE_PIXELS
+    if width * height > max_pixels:
+        raise ImageTooLargeError(f'{source_format} is {width}x{height}, limit is {max_pixels} pixels')
+
+    target_width, target_height = fit_size(image.size, max_size)
+    gap_size = (int(target_width * REDUCING_GAP), int(target_height * REDUCING_GAP))
+
+    if source_format == 'JPEG':
+        image.draft(None, gap_size)
+
+    # 16-bit greyscale (I;16, I) would be clipped at 255 by convert, so scale it down to 8 bits first
+    if image.mode.startswith('I'):
+        image = image.point(lambda value: value / 256).convert('L')
+
+    # Palette images can neither be reduced nor resampled with a real filter, so expand them first
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        has_alpha = image.mode in ('PA', 'RGBa') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    factor = min(image.width // gap_size[0], image.height // gap_size[1])
+    if factor > 1:
+        image = image.reduce(factor)
+
+    image.format = source_format
+    return image
+
+
+def resize_image(image: Image.Image, max_size: int) -> Image.Image:
+    """
+    Resamples an already decoded image to fit inside a max_size x max_size box.
+
+    Args:
+        image (Image.Image): The decoded image, as returned by open_image.
+        max_size (int): The length of the longest side of the thumbnail.
+
+    Returns:
+        Image.Image: The resized image, with `format` carried over from the source.
+    """
+    size = fit_size(image.size, max_size)
+    resized = image if size == image.size else image.resize(size, Image.LANCZOS)
+    resized.format = image.format
+    return resized
+
+
+def encode_image(image: Image.Image, image_format: str) -> bytes:
+    """
+    Encodes a thumbnail in the given Pillow format.
+
+    Args:
+        image (Image.Image): The thumbnail to encode.
+        image_format (str): The Pillow format name, e.g. 'JPEG'.
+
+    Returns:
+        bytes: The encoded thumbnail.
+    """
+    buffer = io.BytesIO()
+    if image_format == 'JPEG':
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(buffer, 'JPEG', quality=THUMBNAIL_JPEG_QUALITY, optimize=True)
+    elif image_format in ('WEBP', 'AVIF'):
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.mode else 'RGB')
+        image.save(buffer, image_format, quality=VARIANT_QUALITY[image_format])
+    else:
+        image.save(buffer, image_format, optimize=True)
+    return buffer.getvalue()
+
+
+def available_variant_formats(variant_formats: list) -> list:
+    # AVIF needs Pillow 11.2 or a plugin, formats the installed Pillow can't encode are left out
+    return [name for name in variant_formats if name in VARIANT_ENCODERS and features.check(name)]
+
+
+def encode_variants(image: Image.Image, primary_size: int, variant_formats: list) -> dict:
+    """
+    Encodes a rendition in its extra formats, keeping the encodings that are smaller than the rendition.
+
+    Variants aren't compared with each other: a client may accept only one of them, and should still get
+    it whenever it beats the rendition. A client accepting several gets the smallest, so the kept variants
+    are returned smallest first.
+
+    Returns:
+        dict: Mapping of variant format name to its encoded bytes, smallest first.
+    """
+    variants = {}
+    for name in variant_formats:
+        variant_data = encode_image(image, VARIANT_ENCODERS[name])
+        if len(variant_data) < primary_size:
+            variants[name] = variant_data
+    return dict(sorted(variants.items(), key=lambda item: len(item[1])))
+
+
+def render_renditions(image_data: bytes, sizes: dict, variant_formats: list = ()) -> dict:
+    """
+    Renders every size of a rendition ladder from a single decode of the source image.
+
+    The image is decoded once at the scale needed by the largest size, and each smaller size is
+    downscaled from the previous step rather than from the original. EXIF orientation is applied once to
+    the largest rendition, and only the first frame of an animated GIF is used.
+
+    Args:
+        image_data (bytes): The encoded source image.
+        sizes (dict): Mapping of rendition name to the length of its longest side, e.g. {'tile': 128}.
+        variant_formats (list): Extra formats of every rendition, e.g. ['avif', 'webp'].
+
+    Returns:
+        dict: Mapping of rendition name to a (encoded bytes, Content-Type, variants) tuple, where variants
+        maps the kept extra formats to their encoded bytes (see encode_variants).
+    """
+    ladder = sorted(sizes.items(), key=lambda item: item[1], reverse=True)
+    with metrics.timer('decode'):
+        image = open_image(image_data, ladder[0][1])
+    source_format = image.format
+    content_type = CONTENT_TYPES[source_format]
+
+    variant_formats = available_variant_formats(variant_formats)
+    renditions = {}
+    current = None
+    for name, max_size in ladder:
+        with metrics.timer('resize'):
+            if current is None:
+                current = ImageOps.exif_transpose(resize_image(image, max_size))
+                current.format = source_format
+            else:
+                current = resize_image(current, max_size)
+        with metrics.timer('encode'):
+            rendition_data = encode_image(current, source_format)
+        with metrics.timer('encode_variants'):
+            variants = encode_variants(current, len(rendition_data), variant_formats)
+        renditions[name] = (rendition_data, content_type, variants)
+    return renditions
+
+
+def render_thumbnail(image_data: bytes, max_size: int = THUMBNAIL_SIZES[DEFAULT_THUMBNAIL_SIZE]) -> tuple[bytes, str]:
+    """
+    Renders a single thumbnail of an encoded image in the same format as the source.
+
+    Args:
+        image_data (bytes): The encoded source image.
+        max_size (int): The length of the longest side of the thumbnail.
+
+    Returns:
+        tuple[bytes, str]: The encoded thumbnail and its Content-Type.
+    """
+    return render_renditions(image_data, {'thumbnail': max_size})['thumbnail'][:2]
@@ -1,99 +1,201 @@
 import boto3
+import hashlib
+import json
 import logging
 from botocore.exceptions import ClientError
-from typing import List, Tuple, Optional, Any
+from typing import Dict, List, Tuple, Optional, Any
 
 apigateway_client = boto3.client('apigateway')
 lambda_client = boto3.client('lambda')
 
+# Resources that receive uploads, every other resource is a GET
+POST_PATH_PARTS = {'upload', 'upload-batch'}
+
+STAGE_NAME = 'dev'
+
+# Lets the download lambdas return raw image bytes (isBase64Encoded) to clients accepting image/*
+BINARY_MEDIA_TYPES = ['image/*']
+
+# Tag of the REST API holding the hash of the definition it was last deployed with
+DEFINITION_TAG = 'definition-sha256'
+
+
+def api_definition(lambda_function_names: List[Tuple[str, str, Optional[str]]], aws_region: str,
+                   aws_account_id: str) -> Dict[str, Tuple[str, str]]:
+    """
+    Describes the resources the API should have.
+
+    Returns:
+        Dict[str, Tuple[str, str]]: Mapping of path part to its HTTP method and Lambda integration URI.
+    """
+    definition = {}
+    for function_name, _, path_part in lambda_function_names:
+        # Functions without a path, like the thumbnail generator, are not exposed
+        if path_part is None:
+            continue
+        # Determine HTTP method (POST for upload, GET for download)
+        method = 'POST' if path_part in POST_PATH_PARTS else 'GET'
+        uri = (f'arn:aws:apigateway:{aws_region}:lambda:path/2015-03-31/functions/arn:aws:lambda:{aws_region}:'
+               f'{aws_account_id}:function:{function_name}/invocations')
+        definition[path_part] = (method, uri)
+    return definition
+
+
+def definition_hash(api_gateway_name: str, definition: Dict[str, Tuple[str, str]]) -> str:
+    return hashlib.sha256(json.dumps([api_gateway_name, STAGE_NAME, BINARY_MEDIA_TYPES, sorted(definition.items())])
+                          .encode()).hexdigest()
+
+
+def find_rest_api(api_gateway_name: str) -> Optional[dict]:
+    # REST API names are not unique, the oldest API of that name is the one deployments keep reconciling
+    apis = [api for page in apigateway_client.get_paginator('get_rest_apis').paginate() for api in page['items']
+            if api['name'] == api_gateway_name]
+    return min(apis, key=lambda api: api['createdDate']) if apis else None
+
+
+def deployed_resources(api_id: str) -> Dict[str, dict]:
+    # Mapping of path part to the resource, with its methods and their integrations
+    resources = {}
+    for page in apigateway_client.get_paginator('get_resources').paginate(restApiId=api_id, embed=['methods']):
+        for resource in page['items']:
+            resources[resource.get('pathPart')] = resource
+    return resources
+
+
+def resource_changes(resources: Dict[str, dict], definition: Dict[str, Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """
+    Compares the deployed resources of the API with its definition.
+
+    Returns:
+        List[Tuple[str, str]]: (action, path part) pairs, the action being 'create', 'update' or 'delete'.
+    """
+    changes = []
+    for path_part, (method, uri) in definition.items():
+        resource = resources.get(path_part)
+        if resource is None:
+            changes.append(('create', path_part))
+            continue
+        methods = resource.get('resourceMethods', {})
+        integration = methods.get(method, {}).get('methodIntegration', {})
+        if set(methods) != {method} or integration.get('uri') != uri or integration.get('type') != 'AWS_PROXY':
+            changes.append(('update', path_part))
+    for path_part in resources:
+        # The root resource has no path part
+        if path_part is not None and path_part not in definition:
+            changes.append(('delete', path_part))
+    return changes
+
+
+def plan_api_gateway(api_gateway_name: str, lambda_function_names: List[Tuple[str, str, Optional[str]]],
+                     aws_region: str, aws_account_id: str) -> Optional[List[str]]:
+    """
+    Lists what create_api_gateway would change, without changing anything.
+
+    Returns:
+        Optional[List[str]]: The changes, empty when the API is up to date, or None if an error occurs.
+    """
+    definition = api_definition(lambda_function_names, aws_region, aws_account_id)
+    try:
+        api = find_rest_api(api_gateway_name)
+        if api is None:
+            return [f'create REST API with /{", /".join(definition)}']
+        if api.get('tags', {}).get(DEFINITION_TAG) == definition_hash(api_gateway_name, definition):
+            return []
+        changes = [f'{action} /{path_part}' for action, path_part in resource_changes(deployed_resources(api['id']),
+                                                                                      definition)]
+        return changes + [f"deploy stage '{STAGE_NAME}'"]
+    except ClientError as e:
+        logging.error(f"Error reading API Gateway '{api_gateway_name}': {e.response['Error']['Message']}",
+                      exc_info=True)
+        return None
+
 
 def create_api_gateway(
         api_gateway_name: str,
-        lambda_function_names: List[Tuple[str, str]],  # List of tuples with (path_part, lambda_function_name)
+        lambda_function_names: List[Tuple[str, str, Optional[str]]],  # (function name, handler, path part) tuples
         aws_region: str,
         aws_account_id: str
 ) -> tuple[str, Any] | None:
     """
     Creates an API Gateway, integrates it with multiple Lambda functions, and deploys the API.
 
+    An existing API of the same name is reconciled in place: its URL stays the same, only resources whose
+    method or integration differ are changed, and resources no longer defined are deleted. The hash of
+    the deployed definition is kept in a tag of the API, so an unchanged API costs a single read and is
+    not deployed again.
+
     Args:
         api_gateway_name (str): The name of the API Gateway to create.
-        lambda_function_names (List[Tuple[str, str]]): A list of tuples containing the path part (e.g., 'upload', 'download')
-                                                      and the corresponding Lambda function name.
+        lambda_function_names (List[Tuple[str, str, Optional[str]]]): (Lambda function name, handler name, path part)
+                                                                       tuples, e.g. ('image-upload', 'lambda_upload',
+                                                                       'upload').
         aws_region (str): The AWS region where the API Gateway and Lambda functions are located.
         aws_account_id (str): The AWS account ID.
 
     Returns:
-        Optional[str]: The URL of the deployed API if successful, None otherwise.
+        Optional[tuple]: The URL of the deployed API and its ID if successful, None otherwise.
     """
+    definition = api_definition(lambda_function_names, aws_region, aws_account_id)
+    current_hash = definition_hash(api_gateway_name, definition)
     try:
-        # Create a REST API
-        logging.info(f"Creating API Gateway '{api_gateway_name}'...")
-        api_response = apigateway_client.create_rest_api(
-            name=api_gateway_name,
-            description='API to upload images, download images, and thumbnails',
-        )
-        api_id = api_response['id']
-        logging.info(f"API Gateway '{api_gateway_name}' created with ID: {api_id}")
+        api = find_rest_api(api_gateway_name)
+        if api is None:
+            # Create a REST API
+            logging.info(f"Creating API Gateway '{api_gateway_name}'...")
+            api = apigateway_client.create_rest_api(
+                name=api_gateway_name,
+                description='API to upload images, download images, and thumbnails',
+                binaryMediaTypes=BINARY_MEDIA_TYPES,
+            )
+            logging.info(f"API Gateway '{api_gateway_name}' created with ID: {api['id']}")
+        api_id = api['id']
 
-        # Root resource
-        logging.info("Fetching root resources...")
-        resources_response = apigateway_client.get_resources(
-            restApiId=api_id
-        )
-        root_resource_id = resources_response['items'][0]['id']
+        # Get the URL for the API
+        api_url = f'https://{api_id}.execute-api.{aws_region}.amazonaws.com/{STAGE_NAME}/'
+
+        if api.get('tags', {}).get(DEFINITION_TAG) == current_hash:
+            logging.info(f"API Gateway '{api_gateway_name}' is up to date.")
+            return api_url, api_id
+
+        if set(api.get('binaryMediaTypes', [])) != set(BINARY_MEDIA_TYPES):
+            apigateway_client.update_rest_api(restApiId=api_id, patchOperations=[
+                {'op': 'add', 'path': f"/binaryMediaTypes/{media_type.replace('/', '~1')}"}
+                for media_type in BINARY_MEDIA_TYPES if media_type not in api.get('binaryMediaTypes', [])])
 
-        # Iterate over Lambda function names to create resources and methods
-        for function_name, handler_name, path_part in lambda_function_names:
-            if function_name=="image-thumbnail-generate":
+        resources = deployed_resources(api_id)
+        root_resource_id = resources[None]['id']
+        for action, path_part in resource_changes(resources, definition):
+            if action == 'delete':
+                apigateway_client.delete_resource(restApiId=api_id, resourceId=resources[path_part]['id'])
+                logging.info(f"Resource '{path_part}' deleted.")
                 continue
-            logging.info(f"Creating resource and method for path: {path_part} with Lambda function: {function_name}")
 
-            # Create resource (e.g., /upload, /download)
-            resource_response = apigateway_client.create_resource(
-                restApiId=api_id,
-                parentId=root_resource_id,
-                pathPart=path_part
-            )
-            logging.info(f"Resource '{path_part}' created with ID: {resource_response['id']}")
-
-            # Determine HTTP method (POST for upload, GET for download)
-            method = 'POST' if path_part == 'upload' else 'GET'
-            apigateway_client.put_method(
-                restApiId=api_id,
-                resourceId=resource_response['id'],
-                httpMethod=method,
-                authorizationType='NONE'
-            )
-            logging.info(f"Method '{method}' created for resource '{path_part}'.")
-
-            # Integrate the resource with the respective Lambda function
-            apigateway_client.put_integration(
-                restApiId=api_id,
-                resourceId=resource_response['id'],
-                httpMethod=method,
-                integrationHttpMethod='POST',
-                type='AWS_PROXY',
-                uri=f'arn:aws:apigateway:{aws_region}:lambda:path/2015-03-31/functions/arn:aws:lambda:{aws_region}:{aws_account_id}:function:{function_name}/invocations'
-            )
-            logging.info(f"Lambda function '{function_name}' integrated with resource '{path_part}'.")
+            if action == 'create':
+                # Create resource (e.g., /upload, /download)
+                resource_id = apigateway_client.create_resource(restApiId=api_id, parentId=root_resource_id,
+                                                                pathPart=path_part)['id']
+                logging.info(f"Resource '{path_part}' created with ID: {resource_id}")
+            else:
+                resource_id = resources[path_part]['id']
+                for stale_method in list(resources[path_part].get('resourceMethods', {})):
+                    apigateway_client.delete_method(restApiId=api_id, resourceId=resource_id,
+                                                    httpMethod=stale_method)
+            put_lambda_method(api_id, resource_id, path_part, *definition[path_part])
 
-        stage_name = 'dev'
-        logging.info(f"Deploying API Gateway to stage '{stage_name}'...")
+        logging.info(f"Deploying API Gateway to stage '{STAGE_NAME}'...")
         apigateway_client.create_deployment(
             restApiId=api_id,
-            stageName=stage_name
+            stageName=STAGE_NAME
         )
-        logging.info(f"API Gateway deployed successfully to stage '{stage_name}'.")
-
-        # Get the URL for the API
-        api_url = f'https://{api_id}.execute-api.{aws_region}.amazonaws.com/{stage_name}/'
+        logging.info(f"API Gateway deployed successfully to stage '{STAGE_NAME}'.")
+        apigateway_client.tag_resource(resourceArn=f'arn:aws:apigateway:{aws_region}::/restapis/{api_id}',
+                                       tags={DEFINITION_TAG: current_hash})
 
         # Log the API URLs and their associated Lambda functions
         logging.info("API URLs and their associated Lambda functions:")
         for function_name, _, path_part in lambda_function_names:
-            method = 'POST' if path_part == 'upload' else 'GET'
-            logging.info(f"{method} {api_url}{path_part} - {function_name}")
+            if path_part is not None:
+                logging.info(f"{definition[path_part][0]} {api_url}{path_part} - {function_name}")
 
         return api_url, api_id
 
@@ -103,3 +205,25 @@ def create_api_gateway(
     except Exception as e:
         logging.error(f"Unexpected error occurred: {str(e)}", exc_info=True)
         return None
+
+
+def put_lambda_method(api_id: str, resource_id: str, path_part: str, method: str, uri: str) -> None:
+    # The method of a resource and its proxy integration with the Lambda function
+    apigateway_client.put_method(
+        restApiId=api_id,
+        resourceId=resource_id,
+        httpMethod=method,
+        authorizationType='NONE'
+    )
+    logging.info(f"Method '{method}' created for resource '{path_part}'.")
+
+    # Integrate the resource with the respective Lambda function
+    apigateway_client.put_integration(
+        restApiId=api_id,
+        resourceId=resource_id,
+        httpMethod=method,
+        integrationHttpMethod='POST',
+        type='AWS_PROXY',
+        uri=uri
+    )
+    logging.info(f"Lambda function integrated with resource '{path_part}'.")
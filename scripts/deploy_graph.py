@@ -0,0 +1,134 @@
+import logging
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class Step:
+    """
+    A deployment step, run once every step it depends on succeeded.
+
+    `run` is called with a mapping of each dependency's name to its result. Like the *_operations
+    functions, a step fails by returning a falsy value (None, '') or raising.
+    """
+
+    def __init__(self, name: str, run: Callable[[dict], Any], depends_on: Iterable[str] = ()):
+        self.name = name
+        self.run = run
+        self.depends_on = tuple(depends_on)
+
+    def __repr__(self):
+        return f'Step({self.name!r}, depends_on={self.depends_on!r})'
+
+
+def _execute(step: Step, dependencies: dict) -> Tuple[Any, float, float]:
+    started = time.perf_counter()
+    try:
+        result = step.run(dependencies)
+    except Exception as e:
+        logging.error(f"Step '{step.name}' failed: {e}", exc_info=True)
+        result = None
+    return result, started, time.perf_counter()
+
+
+def run_steps(steps: List[Step], max_workers: int = 8) -> Tuple[Dict[str, Any], Dict[str, dict]]:
+    """
+    Runs deployment steps concurrently, each one as soon as all its dependencies succeeded.
+
+    Steps depending on a failed step, directly or not, are skipped. Independent steps still run, so a
+    single run reports every failure.
+
+    Args:
+        steps (List[Step]): The steps to run, in any order.
+        max_workers (int): How many steps run at the same time.
+
+    Returns:
+        Tuple[Dict[str, Any], Dict[str, dict]]: The results of the steps that succeeded, and the timing of every
+                                                step: its 'status' ('ok', 'failed' or 'skipped'), 'start'
+                                                offset and duration in 'seconds'.
+
+    Raises:
+        ValueError: If a step depends on an unknown step, or steps depend on each other in a cycle.
+    """
+    pending = {step.name: step for step in steps}
+    for step in steps:
+        unknown = [name for name in step.depends_on if name not in pending]
+        if unknown:
+            raise ValueError(f"Step '{step.name}' depends on unknown steps: {', '.join(unknown)}")
+
+    results, timings, running = {}, {}, {}
+    run_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            # Skipping a step can make its own dependents skippable, so scan until nothing changes
+            changed = True
+            while changed:
+                changed = False
+                for name, step in list(pending.items()):
+                    if any(timings.get(dependency, {}).get('status') in ('failed', 'skipped')
+                           for dependency in step.depends_on):
+                        timings[name] = {'status': 'skipped', 'start': None, 'seconds': 0.0}
+                        del pending[name]
+                        changed = True
+                    elif all(dependency in results for dependency in step.depends_on):
+                        future = executor.submit(_execute, step, {dependency: results[dependency]
+                                                                  for dependency in step.depends_on})
+                        running[future] = step
+                        del pending[name]
+
+            if not running:
+                if pending:
+                    raise ValueError(f"Steps depend on each other in a cycle: {', '.join(pending)}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                result, started, finished = future.result()
+                timings[step.name] = {'status': 'ok' if result else 'failed', 'start': started - run_started,
+                                      'seconds': finished - started}
+                if result:
+                    results[step.name] = result
+    return results, timings
+
+
+def log_timings(timings: Dict[str, dict], total_seconds: float) -> None:
+    # One line per step in the order they started, then how much running them concurrently saved
+    logging.info(f"{'step':<40} {'status':<8} {'start s':>8} {'seconds':>8}")
+    for name, timing in sorted(timings.items(), key=lambda item: (item[1]['start'] is None, item[1]['start'] or 0)):
+        start = f"{timing['start']:.2f}" if timing['start'] is not None else '-'
+        logging.info(f"{name:<40} {timing['status']:<8} {start:>8} {timing['seconds']:>8.2f}")
+    sequential = sum(timing['seconds'] for timing in timings.values())
+    logging.info(f"Deployment took {total_seconds:.2f}s, {sequential:.2f}s if its steps ran one after another.")
+
+
+def poll(check: Callable[[], Any], description: str, timeout: float = 120.0, delay: float = 1.0,
+         max_delay: float = 15.0) -> Optional[Any]:
+    """
+    Calls `check` until it returns a truthy value, waiting longer after each miss.
+
+    The wait doubles after every attempt, up to `max_delay`, with random jitter so concurrent pollers don't
+    retry in lockstep.
+
+    Args:
+        check (Callable[[], Any]): Returns a falsy value while the condition isn't met yet.
+        description (str): What is waited for, for the logs.
+        timeout (float): Seconds after which polling gives up.
+        delay (float): Seconds waited after the first miss.
+        max_delay (float): Longest wait between two attempts.
+
+    Returns:
+        Optional[Any]: The first truthy result of `check`, or None on timeout.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = check()
+        if result:
+            return result
+        if time.monotonic() + delay > deadline:
+            logging.error(f"Timed out after {timeout:.0f}s waiting for {description}.")
+            return None
+        logging.info(f"Waiting for {description}, next attempt in {delay:.1f}s...")
+        time.sleep(random.uniform(delay / 2, delay))
+        delay = min(delay * 2, max_delay)
@@ -1,7 +1,8 @@
 import boto3
 import logging
 import json
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, WaiterError
+from typing import List, Optional
 
 # Initialize IAM client
 iam_client = boto3.client('iam')
@@ -13,7 +14,9 @@ def create_iam_role(role_name: str, trust_policy_document: dict, permissions_pol
 
     This function creates an IAM role with a given trust policy document and then attaches a specified
     permissions policy to that role. The role allows the specified entities to assume it based on the
-    trust policy and grants the necessary permissions based on the provided permissions policy.
+    trust policy and grants the necessary permissions based on the provided permissions policy. When the
+    role already exists, its permissions policy is updated if it differs from the given one, so permissions
+    added to the policy reach existing stacks.
 
     Args:
         role_name (str): The name of the IAM role to create.
@@ -40,19 +43,86 @@ def create_iam_role(role_name: str, trust_policy_document: dict, permissions_pol
 
         return role_arn
     except ClientError as e:
-        if 'EntityAlreadyExists' in str(e):
-            return f"arn:aws:iam::{account_id}:role/{role_name}"
-        logging.error(f"Error creating IAM role '{role_name}': {e}", exc_info=True)
-        return ""
+        if 'EntityAlreadyExists' not in str(e):
+            logging.error(f"Error creating IAM role '{role_name}': {e}", exc_info=True)
+            return ""
 
+    if get_role_policy(role_name) != permissions_policy_document:
+        logging.info(f"Permissions policy of IAM role '{role_name}' differs from the deployed one, updating it.")
+        if not attach_permissions_policy(role_name, permissions_policy_document):
+            return ""
+    return f"arn:aws:iam::{account_id}:role/{role_name}"
 
-def attach_permissions_policy(role_name: str, permissions_policy_document: dict) -> None:
+
+def policy_name(role_name: str) -> str:
+    return f"{role_name}Policy"
+
+
+def get_role_policy(role_name: str) -> Optional[dict]:
+    """
+    Returns the inline permissions policy of a role as deployed, or None if the role or policy doesn't exist.
+
+    Raises:
+        ClientError: If the policy couldn't be read for another reason.
+    """
+    try:
+        return iam_client.get_role_policy(RoleName=role_name, PolicyName=policy_name(role_name))['PolicyDocument']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchEntity':
+            return None
+        raise
+
+
+def plan_iam_role(role_name: str, permissions_policy_document: dict) -> Optional[List[str]]:
+    """
+    Lists what create_iam_role would change: creating the role, or updating its permissions policy.
+
+    Returns:
+        Optional[List[str]]: The changes, empty when the role is up to date, or None if it couldn't be read.
+    """
+    try:
+        iam_client.get_role(RoleName=role_name)
+        deployed_policy = get_role_policy(role_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchEntity':
+            return ['create role and permissions policy']
+        logging.error(f"Error reading IAM role '{role_name}': {e}", exc_info=True)
+        return None
+    if deployed_policy is None:
+        return ['attach permissions policy']
+    if deployed_policy != permissions_policy_document:
+        return ['update permissions policy']
+    return []
+
+
+def wait_for_role(role_name: str) -> bool:
+    """
+    Waits until a new IAM role is visible to IAM reads.
+
+    IAM is eventually consistent: even then Lambda may not be able to assume the role for a few more
+    seconds, which create_lambda_function handles by retrying.
+
+    Args:
+        role_name (str): The name of the IAM role.
+
+    Returns:
+        bool: True once the role exists, False if it didn't in time.
+    """
+    try:
+        iam_client.get_waiter('role_exists').wait(RoleName=role_name, WaiterConfig={'Delay': 1, 'MaxAttempts': 60})
+        return True
+    except WaiterError as e:
+        logging.error(f"IAM role '{role_name}' did not become available: {e}", exc_info=True)
+        return False
+
+
+def attach_permissions_policy(role_name: str, permissions_policy_document: dict) -> bool:
     """
     Attach a permissions policy to an IAM role.
 
     This function attaches the provided permissions policy document to the specified IAM role. The policy
     grants permissions that are associated with the role. This is done using the IAM API's `put_role_policy`
-    method to directly attach the policy to the role.
+    method to directly attach the policy to the role, replacing any previous version of it.
 
     Args:
         role_name (str): The name of the IAM role to attach the policy to.
@@ -60,15 +130,17 @@ def attach_permissions_policy(role_name: str, permissions_policy_document: dict)
                                             the permissions granted to the role.
 
     Returns:
-        None: If the function completes successfully, it does not return a value.
+        bool: True if the policy was attached, False if an error occurred.
     """
     try:
         iam_client.put_role_policy(
             RoleName=role_name,
-            PolicyName=f"{role_name}Policy",
+            PolicyName=policy_name(role_name),
             PolicyDocument=json.dumps(permissions_policy_document)
         )
 
         logging.info(f"Permissions policy attached to IAM role '{role_name}'.")
+        return True
     except ClientError as e:
         logging.error(f"Error attaching permissions policy to role '{role_name}': {e}", exc_info=True)
+        return False
@@ -1,63 +1,180 @@
 import boto3
 import os
-import zipfile
+import py_compile
 import logging
-from typing import Optional
-from botocore.exceptions import ClientError
+import sys
+from typing import List, Optional, Tuple
+from botocore.exceptions import ClientError, WaiterError
+from config.config import (LAMBDA_LAYER_NAME, LAMBDA_MEMORY_SIZES, LAMBDA_SHARED_MODULES, LAMBDA_TIMEOUTS,
+                           PILLOW_LAYER_ARN)
+from deploy_graph import poll
+from lambda_packaging import (LAMBDA_PYTHON_VERSION, LAMBDA_RUNTIME, archive_entries, build_dependency_layer,
+                              requirements_hash, write_deterministic_zip)
 
 lambda_client = boto3.client('lambda')
 
+# Seconds a new IAM role is given to become assumable by Lambda
+ROLE_PROPAGATION_TIMEOUT = 120
 
-def package_lambda_function(lambda_code_path: str, config_code_path: str, zip_filename: str) -> None:
+# Settings of the handlers without an entry in LAMBDA_MEMORY_SIZES / LAMBDA_TIMEOUTS
+DEFAULT_MEMORY_SIZE = 128
+DEFAULT_TIMEOUT = 15
+
+# Polling of the function state after it is created or updated
+WAITER_CONFIG = {'Delay': 2, 'MaxAttempts': 60}
+
+THUMBNAIL_SERVICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REQUIREMENTS_PATH = os.path.join(THUMBNAIL_SERVICE, 'requirements.txt')
+
+
+def package_lambda_function(lambda_code_path: str, config_code_path: str, zip_filename: str,
+                            shared_code_paths: Optional[List[str]] = None) -> Optional[str]:
     """
     Packages the Lambda function code into a zip file.
 
     This function compresses the source code of the Lambda function (including any dependencies in the
     provided directory) into a zip file, ready to be uploaded to AWS Lambda.
 
+    The zip is reproducible, the same sources always give the same bytes, and every module is shipped with
+    its precompiled bytecode so cold starts don't compile them.
+
     Args:
         lambda_code_path (str): The local directory path containing the Lambda function source code files.
+        config_code_path (str): The path of the config module bundled next to the handler.
         zip_filename (str): The path and name of the zip file to create, which will contain the Lambda code.
+        shared_code_paths (List[str], optional): Paths of shared modules (e.g. the thumbnail engine) to bundle
+                                                 next to the handler.
 
     Returns:
-        None: If the function is successful, it does not return any value.
+        Optional[str]: The base64 sha256 of the zip file, as Lambda reports it in CodeSha256, or None if an
+                       error occurs.
     """
+    files = {os.path.basename(path): path for path in [lambda_code_path, config_code_path, *(shared_code_paths or [])]}
+    if sys.version_info[:2] != LAMBDA_PYTHON_VERSION:
+        logging.warning(f"Packaging '{zip_filename}' without bytecode, it is only compiled by Python "
+                        f"{'.'.join(map(str, LAMBDA_PYTHON_VERSION))} for the {LAMBDA_RUNTIME} runtime.")
     try:
-        with zipfile.ZipFile(zip_filename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            zipf.write(lambda_code_path, os.path.basename(lambda_code_path))
-            zipf.write(config_code_path, os.path.basename(config_code_path))
-        logging.info(f"Packaged Lambda function code into '{zip_filename}'.")
+        code_sha256 = write_deterministic_zip(zip_filename, archive_entries(files))
+        logging.info(f"Packaged Lambda function code into '{zip_filename}' (sha256 {code_sha256}).")
+        return code_sha256
+    except (OSError, py_compile.PyCompileError) as e:
+        logging.error(f"Error packaging Lambda function: {e}", exc_info=True)
+        return None
+
+
+def find_dependency_layer(layer_name: str = LAMBDA_LAYER_NAME) -> Optional[str]:
+    """
+    Looks up the published version of the dependency layer matching the current requirements.txt.
+
+    Args:
+        layer_name (str): The name of the Lambda layer.
+
+    Returns:
+        Optional[str]: The ARN of the layer version, or None if these requirements were never published.
+    """
+    description = f'requirements {requirements_hash(REQUIREMENTS_PATH)}'
+    try:
+        paginator = lambda_client.get_paginator('list_layer_versions')
+        for page in paginator.paginate(LayerName=layer_name, CompatibleRuntime=LAMBDA_RUNTIME):
+            for version in page['LayerVersions']:
+                if version.get('Description') == description:
+                    return version['LayerVersionArn']
     except ClientError as e:
-        logging.error(f"Error packaging Lambda function: {e.response['Error']['Message']}", exc_info=True)
+        logging.error(f"Error listing versions of layer '{layer_name}': {e.response['Error']['Message']}",
+                      exc_info=True)
+    return None
 
 
-def create_lambda_function(function_name: str, handler_name: str, role_arn: str = None) -> Optional[str]:
+def publish_dependency_layer(layer_name: str = LAMBDA_LAYER_NAME) -> Optional[str]:
     """
-    Creates and deploys a new Lambda function.
+    Builds the layer of third-party packages from requirements.txt and publishes it, once per set of pins.
 
-    This function packages the Lambda function code into a zip file, uploads it to AWS Lambda,
-    and creates the function using the provided handler and role information.
+    Each published version records the hash of its pins in its description, so a deploy with unchanged
+    requirements reuses that version without building anything.
 
     Args:
-        function_name (str): The name of the Lambda function to create in AWS.
-        handler_name (str): The name of the handler within the Lambda function code (i.e., 'file_name.lambda_handler').
-        role_arn (str, optional): The ARN of the IAM role to be assigned to the Lambda function.
-                                  If not provided, the role assignment is skipped.
+        layer_name (str): The name of the Lambda layer.
 
     Returns:
-        Optional[str]: The ARN of the created Lambda function if successful, or None if an error occurs.
+        Optional[str]: The ARN of the layer version, or None if an error occurs.
     """
-    # Get the current script's directory
-    script_dir = os.path.dirname(os.path.abspath(__file__))
+    layer_arn = find_dependency_layer(layer_name)
+    if layer_arn:
+        logging.info(f"Layer '{layer_arn}' is up to date.")
+        return layer_arn
 
-    # Go one level up to access the 'lambda' and 'config' directories
-    thumbnail_service = os.path.dirname(script_dir)
-    lambda_code_path = os.path.join(thumbnail_service, 'lambda', f'{handler_name}.py')
-    config_code_path = os.path.join(thumbnail_service, 'config', 'config.py')
+    layer = build_dependency_layer(REQUIREMENTS_PATH, os.path.join(THUMBNAIL_SERVICE, 'build'))
+    if not layer:
+        return None
+    zip_filename, pins_hash = layer
 
-    # Normalize the file paths
-    lambda_code_path = os.path.normpath(lambda_code_path)
-    config_code_path = os.path.normpath(config_code_path)
+    try:
+        with open(zip_filename, 'rb') as f:
+            response = lambda_client.publish_layer_version(
+                LayerName=layer_name,
+                Description=f'requirements {pins_hash}',
+                Content={'ZipFile': f.read()},
+                CompatibleRuntimes=[LAMBDA_RUNTIME],
+                CompatibleArchitectures=['x86_64'],
+            )
+        logging.info(f"Published layer '{layer_name}' version {response['Version']}.")
+        return response['LayerVersionArn']
+
+    except ClientError as e:
+        logging.error(f"Error publishing layer '{layer_name}': {e.response['Error']['Message']}", exc_info=True)
+        return None
+
+
+def function_configuration(handler_name: str, role_arn: Optional[str], layers: List[str]) -> dict:
+    # The settings create_lambda_function deploys, named like the Lambda API names them
+    return {
+        'Runtime': LAMBDA_RUNTIME,
+        'Role': role_arn,
+        'Handler': f'{handler_name}.lambda_handler',
+        'Timeout': LAMBDA_TIMEOUTS.get(handler_name, DEFAULT_TIMEOUT),
+        'MemorySize': LAMBDA_MEMORY_SIZES.get(handler_name, DEFAULT_MEMORY_SIZE),
+        'Layers': list(layers),
+    }
+
+
+def configuration_changes(current: dict, desired: dict) -> dict:
+    """
+    Compares the configuration of a deployed function with the desired one.
+
+    Returns:
+        dict: Mapping of each setting that differs to its (current, desired) values.
+    """
+    changes = {}
+    for setting, value in desired.items():
+        # get_function_configuration describes layers as objects, with their version ARN under 'Arn'
+        current_value = ([layer['Arn'] for layer in current.get('Layers', [])] if setting == 'Layers'
+                         else current.get(setting))
+        if current_value != value:
+            changes[setting] = (current_value, value)
+    return changes
+
+
+def get_function_configuration(function_name: str) -> Optional[dict]:
+    # None when the function doesn't exist yet
+    try:
+        return lambda_client.get_function_configuration(FunctionName=function_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            return None
+        raise
+
+
+def build_function_package(handler_name: str) -> Optional[Tuple[str, str]]:
+    """
+    Packages the code of a handler, with config.py and the LAMBDA_SHARED_MODULES, into lambda/<handler>.zip.
+
+    Returns:
+        Optional[Tuple[str, str]]: The path of the zip file and its CodeSha256, or None if an error occurs.
+    """
+    lambda_code_path = os.path.normpath(os.path.join(THUMBNAIL_SERVICE, 'lambda', f'{handler_name}.py'))
+    config_code_path = os.path.normpath(os.path.join(THUMBNAIL_SERVICE, 'config', 'config.py'))
+    shared_code_paths = [os.path.normpath(os.path.join(THUMBNAIL_SERVICE, 'lambda', f'{module}.py'))
+                         for module in LAMBDA_SHARED_MODULES]
 
     if not os.path.exists(lambda_code_path):
         logging.error(f"Error: Lambda code file {lambda_code_path} does not exist.")
@@ -67,32 +184,112 @@ def create_lambda_function(function_name: str, handler_name: str, role_arn: str
         logging.error(f"Error: Config file {config_code_path} does not exist.")
         return None
 
-    # Build the path for the zip file
-    zip_filename = os.path.join(thumbnail_service, 'lambda', f'{handler_name}.zip')
-    zip_filename = os.path.normpath(zip_filename)
+    zip_filename = os.path.normpath(os.path.join(THUMBNAIL_SERVICE, 'lambda', f'{handler_name}.zip'))
+    code_sha256 = package_lambda_function(lambda_code_path, config_code_path, zip_filename, shared_code_paths)
+    return (zip_filename, code_sha256) if code_sha256 else None
 
-    package_lambda_function(lambda_code_path, config_code_path, zip_filename)
+
+def plan_lambda_function(function_name: str, handler_name: str, role_arn: Optional[str],
+                         layers: List[str]) -> Optional[List[str]]:
+    """
+    Lists what create_lambda_function would change, without changing anything.
+
+    The package is built locally and its hash compared with the CodeSha256 of the deployed function,
+    packages being reproducible the hashes only differ when the code does.
+
+    Returns:
+        Optional[List[str]]: The changes, empty when the function is up to date, or None if an error occurs.
+    """
+    package = build_function_package(handler_name)
+    if not package:
+        return None
+    zip_filename, code_sha256 = package
+    os.remove(zip_filename)
+
+    try:
+        current = get_function_configuration(function_name)
+    except ClientError as e:
+        logging.error(f"Error reading Lambda function '{function_name}': {e.response['Error']['Message']}",
+                      exc_info=True)
+        return None
+    if current is None:
+        return ['create function']
+
+    changes = []
+    if current['CodeSha256'] != code_sha256:
+        changes.append(f"update code {current['CodeSha256']} -> {code_sha256}")
+    for setting, (before, after) in configuration_changes(current, function_configuration(handler_name, role_arn,
+                                                                                          layers)).items():
+        changes.append(f'update {setting} {before} -> {after}')
+    return changes
+
+
+def create_lambda_function(function_name: str, handler_name: str, role_arn: str = None,
+                           layers: Optional[List[str]] = None) -> Optional[str]:
+    """
+    Creates and deploys a new Lambda function, or brings an existing one up to date.
+
+    This function packages the Lambda function code into a zip file, uploads it to AWS Lambda,
+    and creates the function using the provided handler and role information.
+
+    If the function already exists, its code is only uploaded when the package's hash differs from the
+    deployed CodeSha256, and its configuration only updated for the settings that differ, so an unchanged
+    function costs one read.
+
+    Args:
+        function_name (str): The name of the Lambda function to create in AWS.
+        handler_name (str): The name of the handler within the Lambda function code (i.e., 'file_name.lambda_handler').
+        role_arn (str, optional): The ARN of the IAM role to be assigned to the Lambda function.
+                                  If not provided, the role assignment is skipped.
+        layers (List[str], optional): ARNs of the layers attached to the function. Defaults to the
+                                      PILLOW_LAYER_ARN layer if it is set.
+
+    Returns:
+        Optional[str]: The ARN of the Lambda function if successful, or None if an error occurs.
+    """
+    # Pillow is not part of the Lambda runtime, the thumbnail engine loads it from this layer
+    if layers is None:
+        layers = [PILLOW_LAYER_ARN] if PILLOW_LAYER_ARN else []
+    configuration = function_configuration(handler_name, role_arn, layers)
+
+    package = build_function_package(handler_name)
+    if not package:
+        return None
+    zip_filename, code_sha256 = package
 
     with open(zip_filename, 'rb') as f:
         zip_data = f.read()
 
+    def create_function() -> Optional[dict]:
+        try:
+            return lambda_client.create_function(FunctionName=function_name, Code={'ZipFile': zip_data},
+                                                 **configuration)
+        except ClientError as e:
+            # A new IAM role takes a few seconds before Lambda can assume it
+            if 'cannot be assumed' in e.response['Error']['Message']:
+                return None
+            raise
+
     try:
-        response = lambda_client.create_function(
-            FunctionName=function_name,
-            Runtime='python3.12',
-            Role=role_arn,
-            Handler=f'{handler_name}.lambda_handler',
-            Code={'ZipFile': zip_data},
-            Timeout=15,
-            MemorySize=128,
-        )
+        current = get_function_configuration(function_name)
+        if current is not None:
+            return update_lambda_function(function_name, current, zip_data, code_sha256, configuration)
+
+        response = poll(create_function, f"role '{role_arn}' to be assumable by '{function_name}'",
+                        timeout=ROLE_PROPAGATION_TIMEOUT)
+        if not response:
+            return None
+        # Event source mappings and permissions are only reliable once the function left the Pending state
+        lambda_client.get_waiter('function_active_v2').wait(FunctionName=function_name, WaiterConfig=WAITER_CONFIG)
         logging.info(f"Lambda function '{function_name}' created successfully.")
         return response['FunctionArn']
 
+    except WaiterError as e:
+        logging.error(f"Lambda function '{function_name}' did not become active: {e}", exc_info=True)
+        return None
+
     except ClientError as e:
-        if 'Function already exist' in str(e):
-            return "created"
-        logging.error(f"Error creating Lambda function '{function_name}': {e.response['Error']['Message']}",
+        logging.error(f"Error deploying Lambda function '{function_name}': {e.response['Error']['Message']}",
                       exc_info=True)
         return None
 
@@ -100,3 +297,37 @@ def create_lambda_function(function_name: str, handler_name: str, role_arn: str
         if os.path.exists(zip_filename):
             os.remove(zip_filename)
             logging.info(f"Deleted temporary zip file '{zip_filename}'.")
+
+
+def update_lambda_function(function_name: str, current: dict, zip_data: bytes, code_sha256: str,
+                           configuration: dict) -> str:
+    """
+    Applies the code and configuration changes of an existing function, skipping what is already deployed.
+
+    Lambda rejects an update while the previous one is in progress, so each one is awaited.
+
+    Returns:
+        str: The ARN of the Lambda function.
+
+    Raises:
+        ClientError: If an update is rejected.
+        WaiterError: If an update doesn't complete.
+    """
+    updated = False
+    if current['CodeSha256'] != code_sha256:
+        lambda_client.update_function_code(FunctionName=function_name, ZipFile=zip_data)
+        lambda_client.get_waiter('function_updated_v2').wait(FunctionName=function_name, WaiterConfig=WAITER_CONFIG)
+        logging.info(f"Updated code of Lambda function '{function_name}' ({current['CodeSha256']} -> {code_sha256}).")
+        updated = True
+
+    changes = configuration_changes(current, configuration)
+    if changes:
+        lambda_client.update_function_configuration(FunctionName=function_name,
+                                                    **{setting: after for setting, (_, after) in changes.items()})
+        lambda_client.get_waiter('function_updated_v2').wait(FunctionName=function_name, WaiterConfig=WAITER_CONFIG)
+        logging.info(f"Updated {', '.join(changes)} of Lambda function '{function_name}'.")
+        updated = True
+
+    if not updated:
+        logging.info(f"Lambda function '{function_name}' is up to date.")
+    return current['FunctionArn']
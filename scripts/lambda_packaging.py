@@ -0,0 +1,192 @@
+import base64
+import hashlib
+import logging
+import os
+import py_compile
+import re
+import subprocess
+import sys
+import tempfile
+import zipfile
+from typing import Dict, List, Optional, Tuple
+
+LAMBDA_RUNTIME = 'python3.12'
+LAMBDA_PYTHON_VERSION = (3, 12)
+LAMBDA_PLATFORM = 'manylinux2014_x86_64'
+
+# Already part of the Lambda Python runtime, a second copy in the layer would only slow down cold starts
+RUNTIME_PACKAGES = {'boto3', 'botocore', 's3transfer', 'jmespath', 'python-dateutil', 'six', 'urllib3'}
+
+# Only used by the scripts in tests/
+TEST_PACKAGES = {'requests', 'certifi', 'charset-normalizer', 'idna'}
+
+# Left out of the layer: test suites, stale bytecode, type stubs and install metadata
+STRIPPED_DIRECTORIES = {'tests', 'test', '__pycache__'}
+STRIPPED_SUFFIXES = ('.dist-info', '.egg-info', '.pyi', '.pyc')
+
+# Every zip entry gets the same timestamp and permissions, so identical inputs give identical archives
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+ZIP_FILE_MODE = 0o644
+
+
+def read_requirements(requirements_path: str) -> List[str]:
+    """
+    Reads the pinned requirements the Lambda layer is built from.
+
+    requirements.txt is saved as UTF-16 by some editors, the encoding is detected from its BOM. Packages the
+    Lambda runtime already provides and test-only packages are left out.
+
+    Args:
+        requirements_path (str): The path of the requirements file.
+
+    Returns:
+        List[str]: The remaining requirement lines, sorted.
+    """
+    with open(requirements_path, 'rb') as requirements_file:
+        raw = requirements_file.read()
+    text = raw.decode('utf-16') if raw.startswith((b'\xff\xfe', b'\xfe\xff')) else raw.decode('utf-8-sig')
+
+    requirements = []
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        name = re.split(r'[<>=!~\[; ]', line, maxsplit=1)[0].lower().replace('_', '-')
+        if name not in RUNTIME_PACKAGES and name not in TEST_PACKAGES:
+            requirements.append(line)
+    return sorted(requirements)
+
+
+def compile_bytecode(source_path: str, arcname: str) -> Optional[bytes]:
+    """
+    Compiles a module to bytecode for the Lambda runtime.
+
+    The code in /var/task and /opt is read-only, so without bundled .pyc files every cold start compiles
+    every module again. Unchecked-hash .pyc files are used as-is without comparing the source's mtime, and
+    have no timestamp in them. Bytecode is specific to a Python version, so nothing is compiled when the
+    local Python isn't the runtime's.
+
+    Args:
+        source_path (str): The path of the .py file.
+        arcname (str): The path of the module in the archive, recorded as its file name in tracebacks.
+
+    Returns:
+        Optional[bytes]: The .pyc content, or None when the local Python doesn't match the runtime.
+    """
+    if sys.version_info[:2] != LAMBDA_PYTHON_VERSION:
+        return None
+    with tempfile.TemporaryDirectory() as build_dir:
+        pyc_path = os.path.join(build_dir, 'module.pyc')
+        py_compile.compile(source_path, cfile=pyc_path, dfile=arcname, doraise=True,
+                           invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        with open(pyc_path, 'rb') as pyc_file:
+            return pyc_file.read()
+
+
+def pyc_arcname(arcname: str) -> str:
+    directory, file_name = os.path.split(arcname)
+    major, minor = LAMBDA_PYTHON_VERSION
+    return os.path.join(directory, '__pycache__', f'{file_name[:-3]}.cpython-{major}{minor}.pyc').replace(os.sep, '/')
+
+
+def archive_entries(files: Dict[str, str]) -> Dict[str, bytes]:
+    """
+    Reads the files of an archive, adding the precompiled bytecode of every Python module.
+
+    Args:
+        files (Dict[str, str]): Mapping of path in the archive to local path.
+
+    Returns:
+        Dict[str, bytes]: Mapping of path in the archive to content.
+    """
+    entries = {}
+    for arcname, path in files.items():
+        with open(path, 'rb') as source_file:
+            entries[arcname] = source_file.read()
+        if arcname.endswith('.py'):
+            bytecode = compile_bytecode(path, arcname)
+            if bytecode is not None:
+                entries[pyc_arcname(arcname)] = bytecode
+    return entries
+
+
+def write_deterministic_zip(zip_filename: str, entries: Dict[str, bytes]) -> str:
+    """
+    Writes a zip whose bytes only depend on its entries: sorted names, fixed timestamps and permissions.
+
+    Returns:
+        str: The sha256 of the archive, base64 encoded like Lambda's CodeSha256.
+    """
+    with zipfile.ZipFile(zip_filename, 'w') as zipf:
+        for arcname in sorted(entries):
+            info = zipfile.ZipInfo(arcname, ZIP_TIMESTAMP)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.create_system = 3
+            info.external_attr = ZIP_FILE_MODE << 16
+            zipf.writestr(info, entries[arcname], compresslevel=9)
+    return file_sha256(zip_filename)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as archive:
+        for chunk in iter(lambda: archive.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode('ascii')
+
+
+def requirements_hash(requirements_path: str) -> str:
+    # Identifies a layer build: the packaged pins and the platform they are installed for
+    requirements = read_requirements(requirements_path)
+    return hashlib.sha256('\n'.join([LAMBDA_RUNTIME, LAMBDA_PLATFORM, *requirements]).encode()).hexdigest()[:16]
+
+
+def build_dependency_layer(requirements_path: str, build_dir: str) -> Optional[Tuple[str, str]]:
+    """
+    Builds the Lambda layer holding the pinned third-party packages (Pillow), once per set of pins.
+
+    Wheels are installed for the Lambda platform and Python version whatever the local machine is, tests and
+    metadata are stripped, modules are precompiled (see compile_bytecode) and the zip is deterministic. The
+    archive is cached in `build_dir` under the hash of its pins, so later deploys reuse it.
+
+    Args:
+        requirements_path (str): The path of requirements.txt.
+        build_dir (str): The directory the layer archive is written to.
+
+    Returns:
+        Optional[Tuple[str, str]]: The path of the layer zip and the hash of its pins, or None if the build
+                                   failed.
+    """
+    requirements = read_requirements(requirements_path)
+    pins_hash = requirements_hash(requirements_path)
+    zip_filename = os.path.join(build_dir, f'layer-{pins_hash}.zip')
+    if os.path.exists(zip_filename):
+        logging.info(f"Reusing dependency layer '{zip_filename}'.")
+        return zip_filename, pins_hash
+
+    os.makedirs(build_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory() as install_dir:
+        major, minor = LAMBDA_PYTHON_VERSION
+        try:
+            subprocess.run([sys.executable, '-m', 'pip', 'install', '--quiet', '--target', install_dir,
+                            '--platform', LAMBDA_PLATFORM, '--implementation', 'cp',
+                            '--python-version', f'{major}.{minor}', '--only-binary=:all:', *requirements],
+                           check=True)
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Error installing layer requirements {requirements}: {e}", exc_info=True)
+            return None
+
+        files = {}
+        for directory, subdirectories, file_names in os.walk(install_dir):
+            subdirectories[:] = [name for name in subdirectories
+                                 if name not in STRIPPED_DIRECTORIES and not name.endswith(STRIPPED_SUFFIXES)]
+            for file_name in file_names:
+                if file_name.endswith(STRIPPED_SUFFIXES):
+                    continue
+                path = os.path.join(directory, file_name)
+                # Lambda puts /opt/python on sys.path
+                files['python/' + os.path.relpath(path, install_dir).replace(os.sep, '/')] = path
+        write_deterministic_zip(zip_filename, archive_entries(files))
+
+    logging.info(f"Built dependency layer '{zip_filename}' from {', '.join(requirements)}.")
+    return zip_filename, pins_hash
@@ -1,14 +1,57 @@
 import logging
 from config.config import *
-from iam_operations import create_iam_role
-from s3_operations import create_s3_bucket
-from sqs_operations import create_sqs_queue
-from lambda_operations import create_lambda_function
+from deploy_graph import Step, log_timings, run_steps
+from iam_operations import create_iam_role, plan_iam_role, wait_for_role
+from s3_operations import create_s3_bucket, add_bucket_notification, wait_for_bucket
+from sqs_operations import create_sqs_queue, allow_bucket_notifications, create_dead_letter_queue
+from sqs_operations import queue_attributes, visibility_timeout
+from lambda_operations import DEFAULT_TIMEOUT, create_lambda_function, find_dependency_layer, plan_lambda_function
+from lambda_operations import publish_dependency_layer
 from utils import add_api_gateway_permission_to_lambda
 from utils import add_sqs_trigger_to_lambda
-from apigateway_operations import create_api_gateway
+from apigateway_operations import create_api_gateway, plan_api_gateway
+from typing import List, Optional
+import argparse
 import time
 
+# Handlers importing the thumbnail engine, and so Pillow
+RENDERING_HANDLERS = {THUMBNAIL_GENERATE_HANDLER, DOWNLOAD_THUMBNAIL_HANDLER}
+
+# Role of the Lambda functions: assumable by Lambda, with access to the bucket, the queue and their logs
+LAMBDA_TRUST_POLICY = {
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Principal": {"Service": "lambda.amazonaws.com"},
+            "Action": "sts:AssumeRole"
+        }
+    ]
+}
+
+LAMBDA_PERMISSIONS_POLICY = {
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Action": [
+                "s3:PutObject",
+                "s3:GetObject",
+                "s3:DeleteObject",
+                "s3:ListBucket",
+                "sqs:SendMessage",
+                "sqs:ReceiveMessage",
+                "sqs:DeleteMessage",
+                "sqs:GetQueueAttributes",
+                "logs:CreateLogGroup",
+                "logs:CreateLogStream",
+                "logs:PutLogEvents"
+            ],
+            "Resource": "*"
+        }
+    ]
+}
+
 # Set up logging to both console and file
 logging.basicConfig(
     level=logging.INFO,
@@ -20,21 +63,84 @@ logging.basicConfig(
 )
 
 
+def log_plan(resource: str, changes: Optional[List[str]]) -> bool:
+    # Plan steps log their changes, and fail like the other steps when the plan couldn't be computed
+    if changes is None:
+        return False
+    for change in changes or ['up to date']:
+        logging.info(f"PLAN {resource}: {change}")
+    return True
+
+
+def plan_deployment(role_name: str, lambda_functions: list, api_gateway_name: str, aws_region: str,
+                    aws_account_id: str) -> None:
+    """
+    Logs what deploying would change in the IAM role, the Lambda functions, their dependency layer and the API
+    Gateway.
+
+    Only reads are made: function packages are built locally and their hashes compared with the deployed
+    CodeSha256, the API with the definition hash in its tag, and the role's permissions policy with the deployed
+    one. The other resources are created when missing,
+    and the queue settings and SQS trigger are applied on every deploy, they don't have a plan.
+    """
+    role_arn = f"arn:aws:iam::{aws_account_id}:role/{role_name}"
+
+    def plan_layer(_):
+        layer_arn = PILLOW_LAYER_ARN or find_dependency_layer()
+        log_plan('dependency layer', [] if layer_arn else ['publish a new version'])
+        return layer_arn or f'{LAMBDA_LAYER_NAME}:<new version>'
+
+    def plan_function(function_name, handler_name):
+        def run(results):
+            layers = [results['dependency-layer']] if handler_name in RENDERING_HANDLERS else []
+            return log_plan(f'Lambda function {function_name}',
+                            plan_lambda_function(function_name, handler_name, role_arn, layers))
+        return run
+
+    def plan_api(_):
+        return log_plan(f'API Gateway {api_gateway_name}',
+                        plan_api_gateway(api_gateway_name, lambda_functions, aws_region, aws_account_id))
+
+    def plan_role(_):
+        return log_plan(f'IAM role {role_name}', plan_iam_role(role_name, LAMBDA_PERMISSIONS_POLICY))
+
+    steps = [Step('iam-role', plan_role), Step('dependency-layer', plan_layer), Step('api-gateway', plan_api)]
+    handlers = {function_name: handler_name for function_name, handler_name, _ in lambda_functions}
+    for function_name, handler_name in handlers.items():
+        steps.append(Step(f'lambda:{function_name}', plan_function(function_name, handler_name), ['dependency-layer']))
+    _, timings = run_steps(steps, max_workers=DEPLOY_CONCURRENCY)
+
+    failed = [name for name, timing in timings.items() if timing['status'] == 'failed']
+    if failed:
+        logging.error(f"Failed to plan: {', '.join(failed)}.")
+
+
 def main(bucket_name: str,
          queue_name: str,
+         dead_letter_queue_name: str,
          role_name: str,
          lambda_functions: list,
          api_gateway_name: str,
          aws_region: str,
          aws_account_id: str,
          upload_lambda: str,
-         thumbnail_generate_lambda: str):
+         thumbnail_generate_lambda: str,
+         pipeline_mode: str = 'sqs',
+         key_layout: str = 'flat',
+         plan: bool = False):
     """
     Main function to orchestrate the creation of an S3 bucket, IAM role, Lambda functions, SQS queue, and API Gateway.
 
+    The resources are created as a dependency graph: each step starts as soon as the ones it needs are done, up to
+    DEPLOY_CONCURRENCY at a time, and the timing of every step is logged at the end.
+
+    Running it again is an incremental redeploy: functions whose package hash and configuration match the deployed
+    ones are left alone, and the API is reconciled in place.
+
     Args:
         bucket_name (str): The name of the S3 bucket to be created.
         queue_name (str): The name of the SQS queue to be created.
+        dead_letter_queue_name (str): The name of the SQS queue thumbnail jobs that keep failing are moved to.
         role_name (str): The name of the IAM role to be created.
         lambda_functions (list): A list of tuples, where each tuple contains the Lambda function name and handler name.
         api_gateway_name (str): The name of the API Gateway to be created.
@@ -42,96 +148,122 @@ def main(bucket_name: str,
         aws_account_id (str): The AWS account ID.
         upload_lambda (str): The name of the Lambda function to handle image uploads.
         thumbnail_generate_lambda (str): The name of the Lambda function to handle thumbnail generation.
+        pipeline_mode (str): 'sqs' when the upload lambda queues thumbnail jobs itself, or 's3-events' when every
+                             original written to the bucket is queued by its ObjectCreated notification.
+        key_layout (str): The KEY_LAYOUT of the bucket, 'flat' or 'hashed'.
+        plan (bool): Only log what would change in the IAM role, Lambda functions, dependency layer and API,
+                     without deploying anything.
 
     Returns:
         None
     """
 
-    # Step 1: Create S3 bucket
-    logging.info(f"Creating S3 bucket: {bucket_name}...")
-    bucket_url = create_s3_bucket(bucket_name)
-    if not bucket_url:
-        logging.error("Failed to create S3 bucket. Exiting...")
+    if plan:
+        plan_deployment(role_name, lambda_functions, api_gateway_name, aws_region, aws_account_id)
         return
 
-    # Step 2: Create SQS Queue
-    logging.info(f"Creating SQS queue: {queue_name}...")
-    queue_url = create_sqs_queue(queue_name)
-    if not queue_url:
-        logging.error("Failed to create SQS queue. Exiting...")
-        return
+    # Step 1: S3 bucket, SQS queues and IAM role don't depend on each other and are created concurrently
+    def create_bucket(_):
+        logging.info(f"Creating S3 bucket: {bucket_name}...")
+        bucket_url = create_s3_bucket(bucket_name)
+        return bucket_url and wait_for_bucket(bucket_name) and bucket_url
 
-    # Step 3: Create IAM role with Trust and Permissions policy
-    logging.info(f"Creating IAM role: {role_name}...")
-    trust_policy_document = {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Principal": {"Service": "lambda.amazonaws.com"},
-                "Action": "sts:AssumeRole"
-            }
-        ]
-    }
-
-    permissions_policy_document = {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Action": [
-                    "s3:PutObject",
-                    "s3:GetObject",
-                    "s3:ListBucket",
-                    "sqs:SendMessage",
-                    "sqs:ReceiveMessage",
-                    "sqs:DeleteMessage",
-                    "sqs:GetQueueAttributes",
-                    "logs:CreateLogGroup",
-                    "logs:CreateLogStream",
-                    "logs:PutLogEvents"
-                ],
-                "Resource": "*"
-            }
-        ]
-    }
-    role_arn = create_iam_role(role_name, trust_policy_document, permissions_policy_document, aws_account_id)
-    if not role_arn:
-        logging.error("Failed to create IAM role. Exiting...")
-        return
+    # Jobs failing THUMBNAIL_QUEUE_MAX_RECEIVE_COUNT times are set aside in the dead-letter queue instead of
+    # cycling forever, and stay hidden for as long as an invocation of the thumbnail function may hold them
+    dead_letter_queue_arn = f'arn:aws:sqs:{aws_region}:{aws_account_id}:{dead_letter_queue_name}'
+    thumbnail_timeout = LAMBDA_TIMEOUTS.get(THUMBNAIL_GENERATE_HANDLER, DEFAULT_TIMEOUT)
 
-    # Step 4: Create Lambda functions
-    time.sleep(15) #LambdaExecutionRole to be fully available
-
-    logging.info("Creating Lambda functions...")
-    for function_name, handler_name, _ in lambda_functions:
-        lambda_arn = create_lambda_function(function_name, handler_name, role_arn)
-        if not lambda_arn:
-            logging.error(f"Failed to create Lambda function: {function_name}. Exiting...")
-            return
-        logging.info(f"Lambda function '{function_name}' created successfully.")
-
-    # Step 5: Create API Gateway and link it to the Lambda functions
-    logging.info(f"Creating API Gateway: {api_gateway_name}...")
-    api_gateway_url, api_id = create_api_gateway(api_gateway_name, lambda_functions, aws_region, aws_account_id)
-    if not api_gateway_url:
-        logging.error("Failed to create API Gateway. Exiting...")
-        return
+    def create_dead_letters(_):
+        logging.info(f"Creating SQS dead-letter queue: {dead_letter_queue_name}...")
+        return create_dead_letter_queue(dead_letter_queue_name)
 
-    # Step 6: Grant permissions to API Gateway to invoke Lambda functions
-    for function_name, handler_name, path_part in lambda_functions:
-        gateway_permission_response = add_api_gateway_permission_to_lambda(function_name, api_id, aws_region,
-                                                                           aws_account_id)
-        if not gateway_permission_response:
-            logging.error("Failed to add permissions to API Gateway. Exiting...")
-            return
+    def create_queue(_):
+        logging.info(f"Creating SQS queue: {queue_name}...")
+        return create_sqs_queue(queue_name, queue_attributes(
+            visibility_timeout(thumbnail_timeout, THUMBNAIL_QUEUE_BATCHING_WINDOW), dead_letter_queue_arn,
+            THUMBNAIL_QUEUE_MAX_RECEIVE_COUNT))
 
+    def create_role(_):
+        logging.info(f"Creating IAM role: {role_name}...")
+        role_arn = create_iam_role(role_name, LAMBDA_TRUST_POLICY, LAMBDA_PERMISSIONS_POLICY, aws_account_id)
+        return role_arn and wait_for_role(role_name) and role_arn
 
+    # Step 2: Presigned POST uploads never pass through the upload lambda, S3 queues their thumbnail jobs instead.
+    # In the s3-events pipeline every original is queued that way, filtered on the image extensions.
     queue_arn = f'arn:aws:sqs:{aws_region}:{aws_account_id}:{queue_name}'
-    sqs_trigger_response = add_sqs_trigger_to_lambda(thumbnail_generate_lambda, queue_arn)
-    if not sqs_trigger_response:
-        logging.error("Failed to add permissions to SQS queue. Exiting...")
+    if pipeline_mode == 's3-events':
+        notification_events, notification_suffixes = ['s3:ObjectCreated:*'], ['.png', '.jpg', '.jpeg', '.gif']
+        if key_layout == 'flat':
+            # Only a prefix can keep renditions out of the notification, the flat layout has none
+            logging.warning("With the flat key layout every rendition written queues a job the thumbnail function "
+                            "drops. Set KEY_LAYOUT=hashed to only queue the originals.")
+    else:
+        notification_events, notification_suffixes = ['s3:ObjectCreated:Post'], None
+
+    def connect_bucket_to_queue(results):
+        logging.info(f"Sending {', '.join(notification_events)} events of {bucket_name} to {queue_name}...")
+        if not allow_bucket_notifications(results['sqs-queue'], queue_arn, bucket_name):
+            return None
+        # The hashed key layout keeps renditions out of the originals' prefix, so their writes never notify
+        return add_bucket_notification(bucket_name, queue_arn, notification_events, notification_suffixes,
+                                       ORIGINALS_PREFIX if key_layout == 'hashed' else None)
+
+    # Step 3: Lambda functions are packaged and created in parallel, as soon as the role can be assumed.
+    # Only the functions rendering thumbnails need Pillow, the others stay small and start faster.
+    def publish_layer(_):
+        return PILLOW_LAYER_ARN or publish_dependency_layer()
+
+    def create_function(function_name, handler_name):
+        def run(results):
+            layers = [results['dependency-layer']] if handler_name in RENDERING_HANDLERS else []
+            return create_lambda_function(function_name, handler_name, results['iam-role'], layers)
+        return run
+
+    # Step 4: API Gateway only refers to the functions by ARN, it is created while they are
+    def create_api(_):
+        logging.info(f"Creating API Gateway: {api_gateway_name}...")
+        return create_api_gateway(api_gateway_name, lambda_functions, aws_region, aws_account_id)
+
+    # Step 5: Grant API Gateway and SQS permissions to invoke the Lambda functions
+    def allow_api_gateway(function_name):
+        def run(results):
+            _, api_id = results['api-gateway']
+            return add_api_gateway_permission_to_lambda(function_name, api_id, aws_region, aws_account_id)
+        return run
+
+    def add_queue_trigger(_):
+        return add_sqs_trigger_to_lambda(thumbnail_generate_lambda, queue_arn, THUMBNAIL_QUEUE_BATCH_SIZE,
+                                         THUMBNAIL_QUEUE_BATCHING_WINDOW, THUMBNAIL_QUEUE_MAX_CONCURRENCY)
+
+    steps = [
+        Step('s3-bucket', create_bucket),
+        Step('sqs-dead-letter-queue', create_dead_letters),
+        Step('sqs-queue', create_queue, ['sqs-dead-letter-queue']),
+        Step('iam-role', create_role),
+        Step('dependency-layer', publish_layer),
+        Step('bucket-notification', connect_bucket_to_queue, ['s3-bucket', 'sqs-queue']),
+        Step('api-gateway', create_api),
+    ]
+    # A function serving several paths (upload and upload-batch) is only created once
+    handlers = {function_name: handler_name for function_name, handler_name, _ in lambda_functions}
+    for function_name, handler_name in handlers.items():
+        steps.append(Step(f'lambda:{function_name}', create_function(function_name, handler_name),
+                          ['iam-role', 'dependency-layer']))
+        # The thumbnail generator is only triggered by the queue
+        if function_name != thumbnail_generate_lambda:
+            steps.append(Step(f'api-permission:{function_name}', allow_api_gateway(function_name),
+                              [f'lambda:{function_name}', 'api-gateway']))
+    steps.append(Step('sqs-trigger', add_queue_trigger, [f'lambda:{thumbnail_generate_lambda}', 'sqs-queue']))
+
+    deploy_started = time.perf_counter()
+    results, timings = run_steps(steps, max_workers=DEPLOY_CONCURRENCY)
+    log_timings(timings, time.perf_counter() - deploy_started)
+
+    failed = [name for name, timing in timings.items() if timing['status'] == 'failed']
+    if failed:
+        logging.error(f"Failed deployment steps: {', '.join(failed)}. Exiting...")
         return
+    api_gateway_url, _ = results['api-gateway']
 
     # Summary
     logging.info("Setup complete.")
@@ -139,6 +271,7 @@ def main(bucket_name: str,
     # Log the API URLs and their purposes
     logging.info("API URLs and their purposes:")
     logging.info(f"1. Upload Image: {api_gateway_url}upload (POST) - Uploads an image to S3")
+    logging.info(f"   Upload Images: {api_gateway_url}upload-batch (POST) - Uploads many images to S3 at once")
     logging.info(f"2. Download Image: {api_gateway_url}download/{{file_name}} (GET) - Downloads an image from S3")
     logging.info(
         f"3. Download Thumbnail: {api_gateway_url}download-thumbnail/{{file_name}} (GET) - Downloads a thumbnail of "
@@ -146,12 +279,18 @@ def main(bucket_name: str,
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Deploys the thumbnail service, or updates what changed.')
+    parser.add_argument('--plan', action='store_true', help='Only log what would change, without deploying.')
+    args = parser.parse_args()
+
     main(
         bucket_name=S3_BUCKET_NAME,
         queue_name=SQS_QUEUE_NAME,
+        dead_letter_queue_name=SQS_DEAD_LETTER_QUEUE_NAME,
         role_name=LAMBDA_ROLE_NAME,
         lambda_functions=[
             (UPLOAD_LAMBDA_FUNCTION_NAME, UPLOAD_HANDLER, UPLOAD_PART),
+            (UPLOAD_LAMBDA_FUNCTION_NAME, UPLOAD_HANDLER, UPLOAD_BATCH_PART),
             (DOWNLOAD_LAMBDA_FUNCTION_NAME, DOWNLOAD_HANDLER, DOWNLOAD_PART),
             (THUMBNAIL_LAMBDA_FUNCTION_NAME, THUMBNAIL_GENERATE_HANDLER, None),
             (DOWNLOAD_THUMBNAIL_LAMBDA_FUNCTION_NAME, DOWNLOAD_THUMBNAIL_HANDLER,DOWNLOAD_THUMBNAIL_PART)
@@ -160,5 +299,8 @@ if __name__ == "__main__":
         aws_region=AWS_REGION,
         aws_account_id=AWS_ACCOUNT_ID,
         upload_lambda=UPLOAD_LAMBDA_FUNCTION_NAME,
-        thumbnail_generate_lambda=UPLOAD_LAMBDA_FUNCTION_NAME
+        thumbnail_generate_lambda=THUMBNAIL_LAMBDA_FUNCTION_NAME,
+        pipeline_mode=PIPELINE_MODE,
+        key_layout=KEY_LAYOUT,
+        plan=args.plan
     )
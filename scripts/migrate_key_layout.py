@@ -0,0 +1,129 @@
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.exceptions import ClientError
+
+# key_layout is a lambda module, import it the way Lambda sees it: with config.py next to it
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO_ROOT, 'config'), os.path.join(REPO_ROOT, 'lambda')]
+
+from config import ORIGINALS_PREFIX, RENDITIONS_PREFIX, S3_BUCKET_NAME  # noqa: E402
+from content_store import CONTENT_KEY_METADATA  # noqa: E402
+from key_layout import KEY_LAYOUTS, is_rendition_key, remap_key  # noqa: E402
+
+s3_client = boto3.client('s3')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Rendition metadata holding the ETag of the original it was rendered from
+SOURCE_ETAG_METADATA = 'source-etag'
+
+
+def target_key(s3_key: str, from_layout: str, to_layout: str):
+    """
+    Returns the key of an object in the target layout, or None if it should not be migrated.
+
+    Render locks are transient and skipped, as are keys that already belong to the target layout.
+    """
+    if s3_key.endswith('.rendering'):
+        return None
+    if to_layout == 'hashed' and s3_key.startswith((ORIGINALS_PREFIX, RENDITIONS_PREFIX)):
+        return None
+    try:
+        return remap_key(s3_key, from_layout, to_layout)
+    except ValueError:
+        logging.warning(f"Skipping {s3_key}, not a key of the {from_layout} layout.")
+        return None
+
+
+def migrate_object(bucket_name: str, s3_key: str, new_key: str, from_layout: str, to_layout: str,
+                   delete: bool, source_etags: dict) -> None:
+    """
+    Copies one object to its new key, and deletes the old one if asked to.
+
+    Content-addressed refs are copied with their `content-key` metadata remapped as well. Other objects
+    keep their metadata, so renditions still match the ETag of their original. A copy can change the ETag
+    of an original, a multipart upload's for one: the ETags of copied originals are recorded in
+    `source_etags` (old to new), and renditions copied afterwards have their `source-etag` metadata
+    carried over, so the thumbnail function doesn't render every migrated original again.
+    """
+    head = s3_client.head_object(Bucket=bucket_name, Key=s3_key)
+    metadata = head.get('Metadata', {})
+    replaced_metadata = None
+    if CONTENT_KEY_METADATA in metadata:
+        replaced_metadata = {**metadata,
+                             CONTENT_KEY_METADATA: remap_key(metadata[CONTENT_KEY_METADATA], from_layout, to_layout)}
+    elif metadata.get(SOURCE_ETAG_METADATA) in source_etags:
+        replaced_metadata = {**metadata, SOURCE_ETAG_METADATA: source_etags[metadata[SOURCE_ETAG_METADATA]]}
+
+    copy_args = {}
+    if replaced_metadata is not None:
+        copy_args = {
+            'MetadataDirective': 'REPLACE',
+            'ContentType': head.get('ContentType', 'binary/octet-stream'),
+            'Metadata': replaced_metadata
+        }
+    response = s3_client.copy_object(Bucket=bucket_name, Key=new_key,
+                                     CopySource={'Bucket': bucket_name, 'Key': s3_key}, **copy_args)
+    new_etag = response['CopyObjectResult']['ETag']
+    if not is_rendition_key(s3_key, from_layout) and new_etag != head['ETag']:
+        source_etags[head['ETag']] = new_etag
+    if delete:
+        s3_client.delete_object(Bucket=bucket_name, Key=s3_key)
+
+
+def migrate_bucket(bucket_name: str, from_layout: str, to_layout: str, dry_run: bool = False, delete: bool = False,
+                   concurrency: int = 16) -> dict:
+    """
+    Remaps every object of a bucket from one key layout to another.
+
+    Objects are copied concurrently, since the point of the hashed layout is to spread requests over
+    many prefixes. Originals are copied in a first pass and renditions in a second one, so the renditions
+    can take over the new ETags of their originals. Run it before switching KEY_LAYOUT, and again with
+    `delete` once the functions use the new layout. A key that can't be remapped is logged and skipped.
+
+    Returns:
+        dict: Counts of migrated, skipped and failed objects.
+    """
+    counts = {'migrated': 0, 'skipped': 0, 'failed': 0}
+    source_etags = {}
+
+    def migrate(s3_key):
+        new_key = target_key(s3_key, from_layout, to_layout)
+        if new_key is None or new_key == s3_key:
+            return 'skipped'
+        if dry_run:
+            logging.info(f"{s3_key} -> {new_key}")
+            return 'migrated'
+        try:
+            migrate_object(bucket_name, s3_key, new_key, from_layout, to_layout, delete, source_etags)
+            return 'migrated'
+        except (ClientError, ValueError) as e:
+            logging.error(f"Error migrating {s3_key} to {new_key}: {e}")
+            return 'failed'
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for renditions in (False, True):
+            for page in paginator.paginate(Bucket=bucket_name):
+                s3_keys = [s3_object['Key'] for s3_object in page.get('Contents', [])
+                           if is_rendition_key(s3_object['Key'], from_layout) == renditions]
+                for outcome in pool.map(migrate, s3_keys):
+                    counts[outcome] += 1
+    logging.info(f"Migrated {bucket_name} from {from_layout} to {to_layout} layout: {counts}")
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Copies the objects of the bucket to their keys in another layout.')
+    parser.add_argument('--bucket', default=S3_BUCKET_NAME)
+    parser.add_argument('--from-layout', choices=KEY_LAYOUTS, default='flat')
+    parser.add_argument('--to-layout', choices=KEY_LAYOUTS, default='hashed')
+    parser.add_argument('--dry-run', action='store_true', help='Only log the keys that would be copied.')
+    parser.add_argument('--delete', action='store_true', help='Delete every object once it is copied.')
+    parser.add_argument('--concurrency', type=int, default=16)
+    args = parser.parse_args()
+    migrate_bucket(args.bucket, args.from_layout, args.to_layout, args.dry_run, args.delete, args.concurrency)
@@ -0,0 +1,88 @@
+import argparse
+import logging
+import os
+import sys
+from botocore.exceptions import ClientError
+
+# Run from anywhere, config/config.py is imported as config.config like the other deploy scripts do
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from config.config import AWS_ACCOUNT_ID, AWS_REGION, SQS_DEAD_LETTER_QUEUE_NAME  # noqa: E402
+from deploy_graph import poll  # noqa: E402
+from sqs_operations import dead_letter_replay_status, queue_depth, sqs_client, start_dead_letter_replay  # noqa: E402
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Move task states after which no more messages are moved
+FINISHED_STATES = {'COMPLETED', 'CANCELLED', 'FAILED'}
+
+
+def replay_dead_letters(dead_letter_queue_name: str, max_per_second: int = None, dry_run: bool = False,
+                        wait: float = 0) -> bool:
+    """
+    Moves the thumbnail jobs of the dead-letter queue back to the thumbnail queue, once the bug that made
+    them fail is fixed.
+
+    Jobs are idempotent: renditions that are already up to date for their original's ETag are skipped, so a
+    replayed job that had succeeded in the meantime costs one get_object and a few head_object calls.
+
+    Args:
+        dead_letter_queue_name (str): The name of the dead-letter queue.
+        max_per_second (int): The highest rate messages are moved at, SQS picks one when None.
+        dry_run (bool): Only log how many messages would be moved.
+        wait (float): Seconds to wait for the move to finish, 0 to return once it has started.
+
+    Returns:
+        bool: True if the replay was started (and finished, when waiting for it), False otherwise.
+    """
+    dead_letter_queue_arn = f'arn:aws:sqs:{AWS_REGION}:{AWS_ACCOUNT_ID}:{dead_letter_queue_name}'
+    try:
+        queue_url = sqs_client.get_queue_url(QueueName=dead_letter_queue_name)['QueueUrl']
+    except ClientError as e:
+        logging.error(f"Error finding SQS queue '{dead_letter_queue_name}': {e}", exc_info=True)
+        return False
+    depth = queue_depth(queue_url)
+    if depth is None:
+        return False
+    logging.info(f"{depth} messages in {dead_letter_queue_name}.")
+
+    previous = dead_letter_replay_status(dead_letter_queue_arn)
+    if previous and previous['Status'] == 'RUNNING':
+        logging.error(f"A replay of {dead_letter_queue_name} is already running: "
+                      f"{previous.get('ApproximateNumberOfMessagesMoved', 0)} messages moved.")
+        return False
+    if dry_run or depth == 0:
+        return True
+
+    if not start_dead_letter_replay(dead_letter_queue_arn, max_per_second):
+        return False
+    if not wait:
+        return True
+
+    def finished():
+        # Until the new task is listed, the latest one is the previous replay
+        task = dead_letter_replay_status(dead_letter_queue_arn)
+        if task is None or task['Status'] not in FINISHED_STATES or \
+                (previous and task.get('StartedTimestamp') == previous.get('StartedTimestamp')):
+            return None
+        return task
+
+    task = poll(finished, f'the replay of {dead_letter_queue_name}', timeout=wait, delay=2)
+    if task is None:
+        return False
+    logging.info(f"Replay of {dead_letter_queue_name} {task['Status'].lower()}: "
+                 f"{task.get('ApproximateNumberOfMessagesMoved', 0)} messages moved"
+                 f"{', ' + task['FailureReason'] if task.get('FailureReason') else ''}.")
+    return task['Status'] == 'COMPLETED'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Moves the messages of the dead-letter queue back to the '
+                                                 'thumbnail queue.')
+    parser.add_argument('--queue', default=SQS_DEAD_LETTER_QUEUE_NAME, help='Name of the dead-letter queue.')
+    parser.add_argument('--rate', type=int, help='Most messages moved per second, up to 500.')
+    parser.add_argument('--dry-run', action='store_true', help='Only log how many messages would be moved.')
+    parser.add_argument('--wait', type=float, default=0, help='Seconds to wait for the move to finish.')
+    args = parser.parse_args()
+    raise SystemExit(0 if replay_dead_letters(args.queue, args.rate, args.dry_run, args.wait) else 1)
@@ -1,7 +1,7 @@
 import boto3
 import logging
-from typing import Optional
-from botocore.exceptions import ClientError
+from typing import List, Optional
+from botocore.exceptions import ClientError, WaiterError
 
 s3_client = boto3.client('s3')
 
@@ -26,3 +26,67 @@ def create_s3_bucket(bucket_name: str) -> Optional[str]:
     except ClientError as e:
         logging.error(f"Error creating S3 bucket '{bucket_name}': {e}", exc_info=True)
         return None
+
+
+def wait_for_bucket(bucket_name: str) -> bool:
+    """
+    Waits until a new S3 bucket can be used, its notification configuration can't be set before.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+
+    Returns:
+        bool: True once the bucket exists, False if it didn't in time.
+    """
+    try:
+        s3_client.get_waiter('bucket_exists').wait(Bucket=bucket_name, WaiterConfig={'Delay': 1, 'MaxAttempts': 60})
+        return True
+    except WaiterError as e:
+        logging.error(f"S3 bucket '{bucket_name}' did not become available: {e}", exc_info=True)
+        return False
+
+
+def _key_filter(prefix: Optional[str], suffix: Optional[str]) -> dict:
+    rules = [{'Name': name, 'Value': value} for name, value in (('prefix', prefix), ('suffix', suffix)) if value]
+    return {'Filter': {'Key': {'FilterRules': rules}}} if rules else {}
+
+
+def add_bucket_notification(bucket_name: str, queue_arn: str, events: List[str],
+                            suffixes: Optional[List[str]] = None, prefix: Optional[str] = None) -> Optional[dict]:
+    """
+    Sends the bucket's object events to an SQS queue.
+
+    The queue policy must already allow the bucket to send messages, S3 validates it when the
+    configuration is saved. S3 filters can only match a key prefix or suffix, so with `suffixes` one
+    configuration is added per suffix.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket whose events are sent.
+        queue_arn (str): The ARN of the SQS queue that receives the events.
+        events (List[str]): The S3 event types to send, e.g. ['s3:ObjectCreated:Post'].
+        suffixes (List[str], optional): Only send events of keys ending with one of these, e.g. ['.png'].
+        prefix (str, optional): Only send events of keys starting with this, e.g. 'originals/'.
+
+    Returns:
+        Optional[dict]: The response from the S3 `put_bucket_notification_configuration` API call if successful,
+                        or None if an error occurred.
+    """
+    try:
+        response = s3_client.put_bucket_notification_configuration(
+            Bucket=bucket_name,
+            NotificationConfiguration={
+                'QueueConfigurations': [
+                    {
+                        'QueueArn': queue_arn,
+                        'Events': events,
+                        **_key_filter(prefix, suffix)
+                    }
+                    for suffix in (suffixes or [None])
+                ]
+            }
+        )
+        logging.info(f"S3 bucket '{bucket_name}' sends {', '.join(events)} events to '{queue_arn}'.")
+        return response
+    except ClientError as e:
+        logging.error(f"Error adding notification to S3 bucket '{bucket_name}': {e}", exc_info=True)
+        return None
@@ -1,28 +1,169 @@
 import boto3
+import json
 import logging
 from typing import Optional
 from botocore.exceptions import ClientError
 
 sqs_client = boto3.client('sqs')
 
+# Visibility timeout per second of function timeout, as AWS recommends for queues consumed by Lambda
+VISIBILITY_TIMEOUT_FACTOR = 6
+MAX_VISIBILITY_TIMEOUT = 12 * 60 * 60
 
-def create_sqs_queue(queue_name: str) -> Optional[str]:
+# Dead letters are kept as long as SQS allows, to outlive the investigation of why they failed
+DEAD_LETTER_RETENTION_SECONDS = 14 * 24 * 60 * 60
+
+
+def visibility_timeout(function_timeout: int, batching_window: int = 0) -> int:
+    """
+    Derives the visibility timeout of a queue from the timeout of the Lambda function consuming it.
+
+    A message must stay hidden as long as an invocation may hold it, or a second invocation renders it again.
+    Six times the function timeout also covers Lambda retrying throttled invocations, and the batching window
+    is added since a message can wait that long in a batch being filled.
+
+    Args:
+        function_timeout (int): The Timeout of the consuming function, in seconds.
+        batching_window (int): The MaximumBatchingWindowInSeconds of its event source mapping.
+
+    Returns:
+        int: The visibility timeout in seconds, capped at the SQS maximum of 12 hours.
+    """
+    return min(MAX_VISIBILITY_TIMEOUT, function_timeout * VISIBILITY_TIMEOUT_FACTOR + batching_window)
+
+
+def queue_attributes(visibility_timeout_seconds: int, dead_letter_queue_arn: str, max_receive_count: int) -> dict:
+    # A message received max_receive_count times without being deleted is moved to the dead-letter queue
+    return {
+        'VisibilityTimeout': str(visibility_timeout_seconds),
+        'RedrivePolicy': json.dumps({'deadLetterTargetArn': dead_letter_queue_arn,
+                                     'maxReceiveCount': str(max_receive_count)})
+    }
+
+
+def create_sqs_queue(queue_name: str, attributes: Optional[dict] = None) -> Optional[str]:
     """
     Creates an SQS queue with the specified name in AWS.
 
     This function uses the `create_queue` method from the AWS SDK to create a queue. If the queue is successfully
-    created, it returns the URL of the created queue. If the creation fails, it logs the error and returns None.
+    created, it returns the URL of the created queue. A queue that already exists with other attributes is updated
+    to the given ones. If the creation fails, it logs the error and returns None.
 
     Args:
         queue_name (str): The name of the SQS queue to create.
+        attributes (Optional[dict]): The queue attributes, e.g. from queue_attributes.
 
     Returns:
         Optional[str]: The URL of the created SQS queue if successful, or None if creation failed.
     """
+    attributes = attributes or {}
     try:
-        response = sqs_client.create_queue(QueueName=queue_name)
+        response = sqs_client.create_queue(QueueName=queue_name, Attributes=attributes)
         logging.info(f"SQS queue '{queue_name}' created successfully.")
         return response['QueueUrl']
     except ClientError as e:
-        logging.error(f"Error creating SQS queue '{queue_name}': {e}", exc_info=True)
+        if e.response['Error']['Code'] not in ('QueueAlreadyExists', 'QueueNameExists'):
+            logging.error(f"Error creating SQS queue '{queue_name}': {e}", exc_info=True)
+            return None
+
+    try:
+        queue_url = sqs_client.get_queue_url(QueueName=queue_name)['QueueUrl']
+        sqs_client.set_queue_attributes(QueueUrl=queue_url, Attributes=attributes)
+        logging.info(f"SQS queue '{queue_name}' updated to {attributes}.")
+        return queue_url
+    except ClientError as e:
+        logging.error(f"Error updating SQS queue '{queue_name}': {e}", exc_info=True)
+        return None
+
+
+def create_dead_letter_queue(queue_name: str) -> Optional[str]:
+    # The dead-letter queue itself has no redrive policy, its messages stay until they are replayed or expire
+    return create_sqs_queue(queue_name, {'MessageRetentionPeriod': str(DEAD_LETTER_RETENTION_SECONDS)})
+
+
+def queue_depth(queue_url: str) -> Optional[int]:
+    """
+    Returns the approximate number of messages waiting in a queue, or None if it couldn't be read.
+    """
+    try:
+        response = sqs_client.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['ApproximateNumberOfMessages'])
+        return int(response['Attributes']['ApproximateNumberOfMessages'])
+    except ClientError as e:
+        logging.error(f"Error reading the depth of SQS queue '{queue_url}': {e}", exc_info=True)
+        return None
+
+
+def start_dead_letter_replay(dead_letter_queue_arn: str, max_per_second: Optional[int] = None) -> Optional[str]:
+    """
+    Starts moving the messages of a dead-letter queue back to the queues they were dead-lettered from.
+
+    SQS moves them itself, at up to `max_per_second` messages per second when given (at most 500), and each
+    message keeps its body and attributes. Only one move task can run per dead-letter queue.
+
+    Args:
+        dead_letter_queue_arn (str): The ARN of the dead-letter queue.
+        max_per_second (Optional[int]): The highest rate messages are moved at, SQS picks one when None.
+
+    Returns:
+        Optional[str]: The handle of the move task if it was started, or None if an error occurred.
+    """
+    params = {'SourceArn': dead_letter_queue_arn}
+    if max_per_second:
+        params['MaxNumberOfMessagesPerSecond'] = max_per_second
+    try:
+        response = sqs_client.start_message_move_task(**params)
+        logging.info(f"Started moving the messages of '{dead_letter_queue_arn}' back to their source queue.")
+        return response['TaskHandle']
+    except ClientError as e:
+        logging.error(f"Error starting the replay of '{dead_letter_queue_arn}': {e}", exc_info=True)
+        return None
+
+
+def dead_letter_replay_status(dead_letter_queue_arn: str) -> Optional[dict]:
+    """
+    Returns the latest move task of a dead-letter queue, with its Status (RUNNING, COMPLETED, CANCELLED, FAILED,
+    ...), ApproximateNumberOfMessagesMoved and ApproximateNumberOfMessagesToMove, or None if there is none.
+    """
+    try:
+        tasks = sqs_client.list_message_move_tasks(SourceArn=dead_letter_queue_arn, MaxResults=1)['Results']
+    except ClientError as e:
+        logging.error(f"Error reading the replay of '{dead_letter_queue_arn}': {e}", exc_info=True)
+        return None
+    return tasks[0] if tasks else None
+
+
+def allow_bucket_notifications(queue_url: str, queue_arn: str, bucket_name: str) -> Optional[dict]:
+    """
+    Allows an S3 bucket to send its event notifications to the SQS queue.
+
+    Args:
+        queue_url (str): The URL of the SQS queue.
+        queue_arn (str): The ARN of the SQS queue.
+        bucket_name (str): The name of the S3 bucket allowed to send messages.
+
+    Returns:
+        Optional[dict]: The response from the SQS `set_queue_attributes` API call if successful, or None if an
+                        error occurred.
+    """
+    queue_policy = {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Principal": {"Service": "s3.amazonaws.com"},
+                "Action": "sqs:SendMessage",
+                "Resource": queue_arn,
+                "Condition": {"ArnLike": {"aws:SourceArn": f"arn:aws:s3:::{bucket_name}"}}
+            }
+        ]
+    }
+    try:
+        response = sqs_client.set_queue_attributes(
+            QueueUrl=queue_url,
+            Attributes={'Policy': json.dumps(queue_policy)}
+        )
+        logging.info(f"S3 bucket '{bucket_name}' allowed to send messages to SQS queue '{queue_arn}'.")
+        return response
+    except ClientError as e:
+        logging.error(f"Error setting policy of SQS queue '{queue_arn}': {e}", exc_info=True)
         return None
@@ -42,33 +42,73 @@ def add_api_gateway_permission_to_lambda(function_name: str, api_id: str, aws_re
 
 
 
-def add_sqs_trigger_to_lambda(lambda_function_name: str, sqs_queue_arn: str) -> Optional[dict]:
+def event_source_settings(batch_size: int, batching_window: int, max_concurrency: int) -> dict:
+    """
+    Builds the batching and scaling settings of an SQS event source mapping.
+
+    Larger batches and a batching window trade latency for throughput: each invocation renders more images
+    and pays its S3 round-trips and cold start once for all of them. MaximumConcurrency caps how many
+    invocations the queue fans out to, so a burst of uploads waits in the queue instead of starving the other
+    functions of the account's concurrency.
+
+    Raises:
+        ValueError: If the combination is rejected by Lambda.
+    """
+    if batch_size > 10 and batching_window < 1:
+        raise ValueError(f'A batch size of {batch_size} needs a batching window of at least 1 second')
+    if max_concurrency and not 2 <= max_concurrency <= 1000:
+        raise ValueError(f'Maximum concurrency must be between 2 and 1000, not {max_concurrency}')
+    return {
+        'BatchSize': batch_size,
+        'MaximumBatchingWindowInSeconds': batching_window,
+        # An empty ScalingConfig removes a limit set by a previous deployment
+        'ScalingConfig': {'MaximumConcurrency': max_concurrency} if max_concurrency else {},
+        'FunctionResponseTypes': ['ReportBatchItemFailures']
+    }
+
+
+def add_sqs_trigger_to_lambda(lambda_function_name: str, sqs_queue_arn: str, batch_size: int = 10,
+                              batching_window: int = 0, max_concurrency: int = 0) -> Optional[dict]:
     """
     Adds an SQS trigger to the specified Lambda function.
 
     This function creates an event source mapping between an SQS queue and a Lambda function, allowing the
-    Lambda function to be triggered by messages in the specified SQS queue.
+    Lambda function to be triggered by messages in the specified SQS queue. The function reports failed
+    records in `batchItemFailures`, so only those are returned to the queue. An existing mapping is updated
+    to the given settings.
 
     Args:
         lambda_function_name (str): The name of the Lambda function to which the SQS queue will be connected.
         sqs_queue_arn (str): The ARN of the SQS queue that will trigger the Lambda function.
+        batch_size (int): The most records passed to one invocation.
+        batching_window (int): The most seconds SQS waits to fill a batch.
+        max_concurrency (int): The most concurrent invocations, 0 for no limit.
 
     Returns:
-        dict: The response from the Lambda `create_event_source_mapping` API call if successful,
-              or None if an error occurred.
+        dict: The response from the Lambda `create_event_source_mapping` or `update_event_source_mapping` API call
+              if successful, or None if an error occurred.
     """
     try:
+        settings = event_source_settings(batch_size, batching_window, max_concurrency)
+        mappings = lambda_client.list_event_source_mappings(EventSourceArn=sqs_queue_arn,
+                                                            FunctionName=lambda_function_name)['EventSourceMappings']
+        if mappings:
+            response = lambda_client.update_event_source_mapping(UUID=mappings[0]['UUID'], Enabled=True, **settings)
+            logging.info(f"Updated SQS trigger of '{lambda_function_name}' Lambda: batch size {batch_size}, "
+                         f"batching window {batching_window}s, maximum concurrency {max_concurrency or 'unlimited'}.")
+            return response
+
+        if not settings['ScalingConfig']:
+            del settings['ScalingConfig']
         response = lambda_client.create_event_source_mapping(
             EventSourceArn=sqs_queue_arn,
             FunctionName=lambda_function_name,
             Enabled=True,
-            BatchSize=10
+            **settings
         )
         logging.info(f"Successfully added SQS trigger for '{lambda_function_name}' Lambda.")
         return response
 
     except Exception as e:
-        if 'ResourceConflictException' in str(e):
-            return {"already exists":True}
         logging.error(f"Error occurred in adding queue-lambda mapping: {str(e)}", exc_info=True)
         return None
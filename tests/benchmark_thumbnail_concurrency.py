@@ -0,0 +1,66 @@
+import argparse
+import io
+import json
+import os
+import time
+from fakes import FakeS3
+from PIL import Image
+import lambda_generate_thumbnail
+import metrics
+
+# Only the benchmark's own results are printed
+metrics.enabled = False
+
+BUCKET_NAME = 'benchmark-bucket'
+SOURCE_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_resources', 'img.jpg')
+
+
+def build_batch(s3: FakeS3, batch_size: int, width: int) -> list:
+    # Upscale the test image so decode and resize cost about as much as a phone photo
+    source = Image.open(SOURCE_IMAGE).convert('RGB')
+    source = source.resize((width, width * 3 // 4))
+    buffer = io.BytesIO()
+    source.save(buffer, 'JPEG', quality=90)
+
+    records = []
+    for index in range(batch_size):
+        key = f'benchmark-{index}.jpg'
+        s3.put_object(Bucket=BUCKET_NAME, Key=key, Body=buffer.getvalue(), ContentType='image/jpeg')
+        records.append({'messageId': f'message-{index}', 'body': json.dumps({'bucket': BUCKET_NAME, 'key': key})})
+    return records
+
+
+def run(concurrency: int, batch_size: int, width: int, latency: float, rounds: int) -> float:
+    s3 = FakeS3()
+    records = build_batch(s3, batch_size, width)
+    s3.latency = latency
+    lambda_generate_thumbnail.s3 = s3
+    lambda_generate_thumbnail.THUMBNAIL_CONCURRENCY = concurrency
+
+    best = float('inf')
+    for _ in range(rounds):
+        # Drop the renditions so every round renders the whole batch again
+        for key in [key for key in s3.objects if '-thumbnail' in key[1]]:
+            del s3.objects[key]
+        start = time.perf_counter()
+        response = lambda_generate_thumbnail.lambda_handler({'Records': records}, None)
+        best = min(best, time.perf_counter() - start)
+        assert not response['batchItemFailures'], response
+    return batch_size / best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Images/second of one thumbnail batch, serial vs worker pool.')
+    parser.add_argument('--batch-size', type=int, default=10, help='Records per SQS batch.')
+    parser.add_argument('--width', type=int, default=3000, help='Width of the generated source images.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Injected latency of each S3 call in seconds.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8], help='Worker pool sizes.')
+    parser.add_argument('--rounds', type=int, default=3, help='Rounds per setting, the best one is reported.')
+    args = parser.parse_args()
+
+    baseline = None
+    print(f'{"workers":>8} {"images/s":>10} {"speedup":>8}')
+    for concurrency in args.concurrency:
+        images_per_second = run(concurrency, args.batch_size, args.width, args.latency, args.rounds)
+        baseline = baseline or images_per_second
+        print(f'{concurrency:>8} {images_per_second:>10.1f} {images_per_second / baseline:>7.2f}x')
@@ -0,0 +1,166 @@
+import argparse
+import base64
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from fakes import REPO_ROOT
+from PIL import Image, ImageOps
+from config import *
+import thumbnail_engine
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# Relative change of a metric beyond which it is flagged, and the direction that is worse
+REGRESSION_METRICS = {'images_per_s': -1, 'cpu_ms': 1, 'peak_rss_mib': 1, 'output_bytes': 1}
+
+
+def peak_rss_mib() -> float:
+    # Linux keeps ru_maxrss across exec, so a spawned worker would report its parent's peak, VmHWM is its own
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def source_image() -> Image.Image:
+    # tests/img.png is a saved /download response, its image is the same one as test_resources/img.jpg
+    with open(os.path.join(REPO_ROOT, 'tests', 'img.png')) as response_file:
+        image_data = base64.b64decode(json.load(response_file)['image_data'])
+    return Image.open(io.BytesIO(image_data)).convert('RGB')
+
+
+def encode(image: Image.Image, image_format: str, **params) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **params)
+    return buffer.getvalue()
+
+
+def build_corpus() -> dict:
+    """
+    Builds the benchmark images from the test image, covering the formats and resolutions we accept.
+
+    Returns:
+        dict: Mapping of case name to encoded image bytes.
+    """
+    source = source_image()
+    with open(os.path.join(REPO_ROOT, 'tests', 'test_resources', 'img.jpg'), 'rb') as image_file:
+        test_resource = image_file.read()
+
+    # Alpha fades from opaque at the top to transparent at the bottom
+    alpha = Image.linear_gradient('L').resize((2048, 2048)).point(lambda value: 255 - value)
+    png_alpha = source.resize((2048, 2048), Image.BICUBIC).convert('RGBA')
+    png_alpha.putalpha(alpha)
+
+    frames = [ImageOps.posterize(source.rotate(angle).resize((800, 600)), 5).convert('P', palette=Image.ADAPTIVE)
+              for angle in range(0, 360, 30)]
+    animated_gif = io.BytesIO()
+    frames[0].save(animated_gif, 'GIF', save_all=True, append_images=frames[1:], duration=80, loop=0)
+
+    return {
+        'small-jpeg': encode(source, 'JPEG', quality=90),
+        'large-jpeg': encode(source.resize((5472, 3648), Image.BICUBIC), 'JPEG', quality=90),
+        'small-png': test_resource,
+        'png-alpha': encode(png_alpha, 'PNG'),
+        'animated-gif': animated_gif.getvalue(),
+    }
+
+
+def run_case(image_data: bytes, sizes: dict, variant_formats: list, rounds: int) -> dict:
+    """
+    Renders one corpus image `rounds` times, in a fresh process so its peak RSS is its own.
+
+    Returns:
+        dict: images/s (best round), CPU ms per image (best round), peak RSS and output bytes per format.
+    """
+    best_wall, best_cpu = float('inf'), float('inf')
+    for _ in range(rounds):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        renditions = thumbnail_engine.render_renditions(image_data, sizes, variant_formats)
+        best_wall = min(best_wall, time.perf_counter() - wall_start)
+        best_cpu = min(best_cpu, time.process_time() - cpu_start)
+
+    output_bytes = {'primary': sum(len(rendition[0]) for rendition in renditions.values())}
+    for variant_format in variant_formats:
+        output_bytes[variant_format] = sum(len(rendition[2][variant_format])
+                                           for rendition in renditions.values() if variant_format in rendition[2])
+    return {
+        'images_per_s': round(1 / best_wall, 2),
+        'cpu_ms': round(best_cpu * 1000, 1),
+        'peak_rss_mib': peak_rss_mib(),
+        'input_bytes': len(image_data),
+        'output_bytes': sum(output_bytes.values()),
+        'output_bytes_by_format': output_bytes,
+    }
+
+
+def run_suite(targets: dict, variant_formats: list, rounds: int) -> dict:
+    """
+    Benchmarks every corpus image against every target: each single size and the whole ladder.
+
+    Returns:
+        dict: Mapping of 'image/target' case names to their run_case results.
+    """
+    corpus = build_corpus()
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for image_name, image_data in corpus.items():
+        for target_name, sizes in targets.items():
+            with context.Pool(1) as pool:
+                results[f'{image_name}/{target_name}'] = pool.apply(run_case, (image_data, sizes, variant_formats,
+                                                                              rounds))
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, threshold: float) -> list:
+    # Metrics that moved the wrong way by more than `threshold` relative to the baseline run
+    regressions = []
+    for case, metrics in results.items():
+        if case not in baseline:
+            continue
+        for metric, direction in REGRESSION_METRICS.items():
+            before, after = baseline[case][metric], metrics[metric]
+            if before and (after - before) / before * direction > threshold:
+                regressions.append(f'{case} {metric}: {before} -> {after} ({(after - before) / before:+.0%})')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Thumbnail engine benchmark over a generated image corpus.')
+    parser.add_argument('--rounds', type=int, default=5, help='Renders per case, the best one is reported.')
+    parser.add_argument('--variants', nargs='*', default=THUMBNAIL_VARIANT_FORMATS,
+                        help='Variant formats rendered with each rendition.')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='JSON baseline to compare with or save to.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store this run as the baseline.')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='Relative change of a metric flagged as a regression.')
+    args = parser.parse_args()
+
+    targets = {size_name: {size_name: max_size} for size_name, max_size in THUMBNAIL_SIZES.items()}
+    targets['ladder'] = THUMBNAIL_SIZES
+    results = run_suite(targets, args.variants, args.rounds)
+
+    print(f'{"case":>28} {"images/s":>9} {"cpu ms":>8} {"rss MiB":>8} {"in KB":>7} {"out KB":>7}')
+    for case, metrics in results.items():
+        print(f'{case:>28} {metrics["images_per_s"]:>9} {metrics["cpu_ms"]:>8} {metrics["peak_rss_mib"]:>8} '
+              f'{metrics["input_bytes"] // 1024:>7} {metrics["output_bytes"] // 1024:>7}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump({'variant_formats': args.variants, 'thumbnail_sizes': THUMBNAIL_SIZES, 'results': results},
+                      baseline_file, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file)['results'], args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION: {regression}', file=sys.stderr)
+        sys.exit(1 if regressions else 0)
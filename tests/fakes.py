@@ -0,0 +1,210 @@
+import datetime
+import hashlib
+import io
+import os
+import sys
+import threading
+import time
+from botocore.exceptions import ClientError
+
+# Make the handlers importable the way Lambda sees them: config.py and the shared modules next to the handler
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO_ROOT, 'config'), os.path.join(REPO_ROOT, 'lambda')]
+
+
+def client_error(code: str, status: int, operation: str, headers: dict = None) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status, 'HTTPHeaders': headers or {}}}, operation)
+
+
+class Context:
+    """Stand-in for the Lambda context object, only the remaining time is used."""
+
+    def __init__(self, timeout: float):
+        self._deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self._deadline - time.monotonic()) * 1000)
+
+
+class FakeS3:
+    """
+    In-memory stand-in for the subset of the boto3 S3 client used by the handlers.
+
+    Every call sleeps for `latency` seconds first, which stands in for the S3 round-trip. The fake is
+    thread safe, so it can be shared by handlers that process records concurrently. `on_object_created`,
+    when set, is called with the bucket and key of every object written, like a bucket notification.
+    `failures` maps a key to the number of its next get_object calls that fail with a 500 InternalError.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.objects = {}
+        self.calls = []
+        self.on_object_created = None
+        self.failures = {}
+        self._lock = threading.Lock()
+
+    def _call(self, operation: str, key: str) -> None:
+        with self._lock:
+            self.calls.append((operation, key))
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _object(self, bucket: str, key: str, operation: str) -> dict:
+        with self._lock:
+            s3_object = self.objects.get((bucket, key))
+        if s3_object is None:
+            if operation == 'HeadObject':
+                raise client_error('404', 404, operation)
+            raise client_error('NoSuchKey', 404, operation)
+        return s3_object
+
+    def _check_if_match(self, bucket: str, key: str, if_match: str, operation: str) -> None:
+        # Called with the lock held
+        if if_match is None:
+            return
+        s3_object = self.objects.get((bucket, key))
+        if s3_object is None:
+            raise client_error('NoSuchKey', 404, operation)
+        if s3_object['ETag'] != if_match:
+            raise client_error('PreconditionFailed', 412, operation)
+
+    def put_object(self, Bucket, Key, Body=b'', ContentType='binary/octet-stream', Metadata=None, IfNoneMatch=None,
+                   IfMatch=None, **kwargs):
+        self._call('PutObject', Key)
+        data = Body if isinstance(Body, bytes) else Body.read()
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        with self._lock:
+            if IfNoneMatch == '*' and (Bucket, Key) in self.objects:
+                raise client_error('PreconditionFailed', 412, 'PutObject')
+            self._check_if_match(Bucket, Key, IfMatch, 'PutObject')
+            self.objects[(Bucket, Key)] = {
+                'Data': data,
+                'ContentType': ContentType,
+                'Metadata': dict(Metadata or {}),
+                'ETag': etag,
+                'LastModified': datetime.datetime.now(datetime.timezone.utc),
+            }
+        if self.on_object_created is not None:
+            self.on_object_created(Bucket, Key)
+        return {'ETag': etag}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None, **kwargs):
+        # One call stands in for the whole (possibly multipart) transfer
+        extra_args = ExtraArgs or {}
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj.read(), ContentType=extra_args.get('ContentType'),
+                        Metadata=extra_args.get('Metadata'))
+
+    def generate_presigned_post(self, Bucket, Key, Fields=None, Conditions=None, ExpiresIn=3600):
+        return {'url': f'https://{Bucket}.s3.fake/', 'fields': {**(Fields or {}), 'key': Key}}
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, **kwargs):
+        return f"https://{Params['Bucket']}.s3.fake/{Params['Key']}?expires={ExpiresIn}"
+
+    def delete_object(self, Bucket, Key, IfMatch=None, **kwargs):
+        self._call('DeleteObject', Key)
+        with self._lock:
+            self._check_if_match(Bucket, Key, IfMatch, 'DeleteObject')
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    @staticmethod
+    def _headers(s3_object: dict) -> dict:
+        return {
+            'ContentLength': len(s3_object['Data']),
+            'ContentType': s3_object['ContentType'],
+            'Metadata': dict(s3_object['Metadata']),
+            'ETag': s3_object['ETag'],
+            'LastModified': s3_object['LastModified'],
+        }
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._call('HeadObject', Key)
+        return self._headers(self._object(Bucket, Key, 'HeadObject'))
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, IfModifiedSince=None, Range=None, **kwargs):
+        self._call('GetObject', Key)
+        with self._lock:
+            failing = self.failures.get(Key, 0) > 0
+            if failing:
+                self.failures[Key] -= 1
+        if failing:
+            raise client_error('InternalError', 500, 'GetObject')
+        s3_object = self._object(Bucket, Key, 'GetObject')
+        headers = self._headers(s3_object)
+
+        not_modified = (s3_object['ETag'] in IfNoneMatch.split(', ') if IfNoneMatch is not None
+                        else IfModifiedSince is not None
+                        and s3_object['LastModified'].replace(microsecond=0) <= IfModifiedSince)
+        if not_modified:
+            raise client_error('304', 304, 'GetObject', {'etag': s3_object['ETag']})
+
+        data = s3_object['Data']
+        if Range is not None:
+            start, _, end = Range.removeprefix('bytes=').partition('-')
+            if not start:
+                start, end = max(0, len(data) - int(end)), len(data) - 1
+            start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+            if start >= len(data) or start > end:
+                raise client_error('InvalidRange', 416, 'GetObject')
+            headers['ContentRange'] = f'bytes {start}-{end}/{len(data)}'
+            headers['ContentLength'] = end - start + 1
+            data = data[start:end + 1]
+        return {'Body': io.BytesIO(data), **headers}
+
+
+class FakeSQS:
+    """
+    In-memory stand-in for the SQS client calls made by the upload lambda.
+
+    Sent messages are kept in `messages` in the shape SQS delivers them to an event source mapping,
+    with their SentTimestamp in milliseconds.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.messages = []
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    @staticmethod
+    def _message(message_id: str, body: str) -> dict:
+        return {'messageId': message_id, 'body': body,
+                'attributes': {'SentTimestamp': str(int(time.time() * 1000)), 'ApproximateReceiveCount': '1'}}
+
+    def receive(self, max_messages: int = 10) -> list:
+        # Takes messages off the queue, as the event source mapping does for one invocation
+        with self._lock:
+            batch, self.messages[:max_messages] = self.messages[:max_messages], []
+        return batch
+
+    def redeliver(self, message: dict) -> None:
+        # A failed batch item becomes visible again, with its receive count bumped
+        attributes = message['attributes']
+        attributes['ApproximateReceiveCount'] = str(int(attributes['ApproximateReceiveCount']) + 1)
+        with self._lock:
+            self.messages.append(message)
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self._next_id += 1
+            message_id = f'message-{self._next_id}'
+            self.messages.append(self._message(message_id, MessageBody))
+        return {'MessageId': message_id}
+
+    def send_message_batch(self, QueueUrl, Entries, **kwargs):
+        if len(Entries) > 10:
+            raise client_error('AWS.SimpleQueueService.TooManyEntriesInBatchRequest', 400, 'SendMessageBatch')
+        if self.latency:
+            time.sleep(self.latency)
+        successful = []
+        with self._lock:
+            for entry in Entries:
+                self._next_id += 1
+                message_id = f'message-{self._next_id}'
+                self.messages.append(self._message(message_id, entry['MessageBody']))
+                successful.append({'Id': entry['Id'], 'MessageId': message_id})
+        return {'Successful': successful, 'Failed': []}
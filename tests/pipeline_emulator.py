@@ -0,0 +1,289 @@
+import argparse
+import base64
+import hashlib
+import io
+import json
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fakes import Context, FakeS3, FakeSQS
+from PIL import Image
+from config import *
+from content_store import content_key
+from key_layout import original_key
+import metrics
+import lambda_download_image
+import lambda_download_thumbnail
+import lambda_generate_thumbnail
+import lambda_upload
+
+STAGES = ('upload', 'queue_wait', 'thumbnail', 'download_thumbnail', 'download', 'end_to_end')
+
+# Keys the s3-events bucket notification is filtered to, as configured by scripts/main.py
+NOTIFICATION_SUFFIXES = ('.png', '.jpg', '.jpeg', '.gif')
+
+
+class PipelineEmulator:
+    """
+    Runs the four handlers in-process against shared in-memory S3 and SQS fakes.
+
+    Every S3 and SQS call sleeps for `latency` seconds, which stands in for the network round-trip. In
+    the s3-events PIPELINE_MODE, writes to the fake bucket are turned into S3 event messages the way the
+    bucket notification would.
+    """
+
+    def __init__(self, latency: float = 0.0, function_timeout: float = 15.0):
+        self.s3 = FakeS3(latency)
+        self.sqs = FakeSQS(latency)
+        self.function_timeout = function_timeout
+        lambda_upload.s3_client = self.s3
+        lambda_upload.sqs_client = self.sqs
+        lambda_generate_thumbnail.s3 = self.s3
+        lambda_download_image.s3 = self.s3
+        lambda_download_thumbnail.s3 = self.s3
+        # A container runs one invocation at a time, the metrics of invocations run concurrently here would mix
+        metrics.enabled = False
+        if PIPELINE_MODE == 's3-events':
+            self.s3.on_object_created = self._notify
+
+    def _notify(self, bucket_name: str, s3_key: str) -> None:
+        if not s3_key.endswith(NOTIFICATION_SUFFIXES):
+            return
+        if KEY_LAYOUT == 'hashed' and not s3_key.startswith(ORIGINALS_PREFIX):
+            return
+        s3_event = {'Records': [{'eventSource': 'aws:s3', 'eventName': 'ObjectCreated:Put',
+                                 's3': {'bucket': {'name': bucket_name}, 'object': {'key': s3_key}}}]}
+        self.sqs.send_message(QueueUrl=SQS_QUEUE_NAME, MessageBody=json.dumps(s3_event))
+
+    def upload(self, file_name: str, image_data: bytes) -> dict:
+        body = {'file': {'filename': file_name, 'content': base64.b64encode(image_data).decode('utf-8')}}
+        return lambda_upload.lambda_handler({'body': json.dumps(body)}, Context(self.function_timeout))
+
+    def generate(self, records: list) -> dict:
+        return lambda_generate_thumbnail.lambda_handler({'Records': records}, Context(self.function_timeout))
+
+    def download(self, file_name: str) -> dict:
+        return lambda_download_image.lambda_handler({'queryStringParameters': {'file_name': file_name}},
+                                                    Context(self.function_timeout))
+
+    def download_thumbnail(self, file_name: str, size_name: str = None, accept: str = None) -> dict:
+        event = {'queryStringParameters': {'file_name': file_name, 'size': size_name},
+                 'headers': {'Accept': accept} if accept else {}}
+        return lambda_download_thumbnail.lambda_handler(event, Context(self.function_timeout))
+
+
+def source_key(file_name: str, image_data: bytes, image_format: str) -> str:
+    # The key the thumbnail job of an upload names, to follow it through the queue
+    if CONTENT_ADDRESSED_STORAGE:
+        return content_key(hashlib.sha256(image_data).hexdigest(), image_format)
+    return original_key(file_name)
+
+
+def message_keys(record: dict) -> list:
+    message_body = json.loads(record['body'])
+    if 'Records' in message_body:
+        return [s3_record['s3']['object']['key'] for s3_record in message_body['Records']]
+    return [message_body['key']]
+
+
+def build_corpus(count: int, seed: int = 0) -> list:
+    """
+    Generates distinct photo-like JPEGs and screenshot-like PNGs of mixed sizes.
+
+    Returns:
+        list: (extension, Pillow format, encoded bytes) tuples.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for index in range(count):
+        width = rng.choice((640, 1280, 2048))
+        height = width * 3 // 4
+        noise = Image.effect_noise((width // 8, height // 8), rng.uniform(20, 80)).resize((width, height))
+        image = Image.merge('RGB', (noise, noise.rotate(90, expand=False), noise.transpose(Image.FLIP_LEFT_RIGHT)))
+        buffer = io.BytesIO()
+        if index % 2:
+            image.save(buffer, 'PNG')
+            corpus.append(('png', 'PNG', buffer.getvalue()))
+        else:
+            image.save(buffer, 'JPEG', quality=90)
+            corpus.append(('jpg', 'JPEG', buffer.getvalue()))
+    return corpus
+
+
+def percentile(values: list, fraction: float) -> float:
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(fraction * len(ordered) + 0.5) - 1))]
+
+
+def run_load(emulator: PipelineEmulator, corpus: list, rate: float, duration: float, upload_workers: int = 16,
+             consumers: int = 4, batch_size: int = THUMBNAIL_QUEUE_BATCH_SIZE,
+             batching_window: float = THUMBNAIL_QUEUE_BATCHING_WINDOW) -> dict:
+    """
+    Drives upload -> queue -> thumbnail -> download at `rate` uploads per second for `duration` seconds.
+
+    Uploads are started on schedule by a pool of `upload_workers`, like concurrent API requests. Each of the
+    `consumers` threads stands in for one concurrent invocation of the thumbnail function: it takes up to
+    `batch_size` messages, waiting up to `batching_window` seconds to fill the batch like the event source
+    mapping, renders them, then downloads the new thumbnail and original of every image it finished. Failed
+    records are redelivered until THUMBNAIL_QUEUE_MAX_RECEIVE_COUNT, then counted as dead-lettered.
+
+    Returns:
+        dict: Per-stage latency percentiles in milliseconds, throughput, errors and peak memory.
+    """
+    latencies = {stage: [] for stage in STAGES}
+    counters = {'uploaded': 0, 'completed': 0, 'upload_errors': 0, 'download_errors': 0, 'record_failures': 0,
+                'dead_lettered': 0}
+    pending = {}
+    lock = threading.Lock()
+    uploads_done = threading.Event()
+    total = max(1, int(rate * duration))
+
+    def record(stage, seconds):
+        with lock:
+            latencies[stage].append(seconds * 1000)
+
+    def upload(index):
+        extension, image_format, image_data = corpus[index % len(corpus)]
+        file_name = f'load-{index}.{extension}'
+        started = time.perf_counter()
+        with lock:
+            pending[source_key(file_name, image_data, image_format)] = (file_name, started)
+        response = emulator.upload(file_name, image_data)
+        record('upload', time.perf_counter() - started)
+        with lock:
+            counters['uploaded' if response['statusCode'] == 200 else 'upload_errors'] += 1
+
+    def consume():
+        while True:
+            records = emulator.sqs.receive(batch_size)
+            window_end = time.monotonic() + batching_window
+            while records and len(records) < batch_size and time.monotonic() < window_end:
+                time.sleep(0.005)
+                records += emulator.sqs.receive(batch_size - len(records))
+            if not records:
+                if uploads_done.is_set() and not emulator.sqs.messages:
+                    return
+                time.sleep(0.005)
+                continue
+            now = time.time()
+            for message in records:
+                record('queue_wait', now - int(message['attributes']['SentTimestamp']) / 1000)
+
+            started = time.perf_counter()
+            response = emulator.generate(records)
+            record('thumbnail', time.perf_counter() - started)
+
+            failed_ids = {failure['itemIdentifier'] for failure in response['batchItemFailures']}
+            for message in records:
+                if message['messageId'] in failed_ids:
+                    with lock:
+                        counters['record_failures'] += 1
+                    if int(message['attributes']['ApproximateReceiveCount']) >= THUMBNAIL_QUEUE_MAX_RECEIVE_COUNT:
+                        with lock:
+                            counters['dead_lettered'] += 1
+                    else:
+                        emulator.sqs.redeliver(message)
+                    continue
+                for s3_key in message_keys(message):
+                    with lock:
+                        file_name, upload_started = pending.pop(s3_key, (None, None))
+                    if file_name is None:
+                        continue
+                    for stage, call in (('download_thumbnail', emulator.download_thumbnail),
+                                        ('download', emulator.download)):
+                        started = time.perf_counter()
+                        response = call(file_name)
+                        record(stage, time.perf_counter() - started)
+                        if response['statusCode'] != 200:
+                            with lock:
+                                counters['download_errors'] += 1
+                    record('end_to_end', time.perf_counter() - upload_started)
+                    with lock:
+                        counters['completed'] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=consumers) as consumer_pool:
+        consumer_futures = [consumer_pool.submit(consume) for _ in range(consumers)]
+        with ThreadPoolExecutor(max_workers=upload_workers) as upload_pool:
+            upload_futures = []
+            for index in range(total):
+                delay = start + index / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                upload_futures.append(upload_pool.submit(upload, index))
+        for future in upload_futures:
+            future.result()
+        uploads_done.set()
+        for future in consumer_futures:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'target_rate': rate,
+        'uploads': total,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(counters['completed'] / elapsed, 2),
+        **counters,
+        'stages_ms': {
+            stage: {'p50': round(percentile(values, 0.50), 1), 'p95': round(percentile(values, 0.95), 1),
+                    'p99': round(percentile(values, 0.99), 1), 'count': len(values)}
+            for stage, values in latencies.items() if values
+        },
+        # ru_maxrss is in KiB on Linux, the peak of the whole process including Pillow's buffers
+        'peak_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def check_gates(report: dict, max_p95: list, min_throughput: float) -> list:
+    # Release gate violations, e.g. max_p95=['end_to_end=2000']
+    violations = []
+    for gate in max_p95:
+        stage, _, limit = gate.partition('=')
+        p95 = report['stages_ms'].get(stage, {}).get('p95')
+        if p95 is None or p95 > float(limit):
+            violations.append(f'{stage} p95 {p95} ms exceeds {limit} ms')
+    if min_throughput and report['throughput_per_s'] < min_throughput:
+        violations.append(f"throughput {report['throughput_per_s']}/s is below {min_throughput}/s")
+    if report['upload_errors'] or report['download_errors'] or report['dead_lettered']:
+        violations.append(f"{report['upload_errors']} upload errors, {report['download_errors']} download errors, "
+                          f"{report['dead_lettered']} dead-lettered messages")
+    return violations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of the whole pipeline against in-memory S3 and SQS.')
+    parser.add_argument('--rate', type=float, default=10, help='Uploads started per second.')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds uploads are started for.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Injected latency of each S3/SQS call in seconds.')
+    parser.add_argument('--corpus', type=int, default=8, help='Distinct images uploaded in turn.')
+    parser.add_argument('--upload-workers', type=int, default=16, help='Concurrent upload requests.')
+    parser.add_argument('--consumers', type=int, default=4, help='Concurrent thumbnail function invocations.')
+    parser.add_argument('--batch-size', type=int, default=THUMBNAIL_QUEUE_BATCH_SIZE,
+                        help='Most SQS records per thumbnail invocation.')
+    parser.add_argument('--batching-window', type=float, default=THUMBNAIL_QUEUE_BATCHING_WINDOW,
+                        help='Most seconds a thumbnail invocation waits to fill its batch.')
+    parser.add_argument('--max-p95', nargs='*', default=[], metavar='STAGE=MS',
+                        help=f'Fail if the p95 of a stage exceeds MS. Stages: {", ".join(STAGES)}.')
+    parser.add_argument('--min-throughput', type=float, default=0, help='Fail below this many pipelines/second.')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON.')
+    args = parser.parse_args()
+
+    report = run_load(PipelineEmulator(args.latency), build_corpus(args.corpus), args.rate, args.duration,
+                      args.upload_workers, args.consumers, args.batch_size, args.batching_window)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{report['completed']}/{report['uploads']} pipelines in {report['elapsed_s']}s, "
+              f"{report['throughput_per_s']}/s, peak RSS {report['peak_rss_mib']} MiB")
+        print(f'{"stage":>20} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"count":>6}')
+        for stage, stats in report['stages_ms'].items():
+            print(f'{stage:>20} {stats["p50"]:>9} {stats["p95"]:>9} {stats["p99"]:>9} {stats["count"]:>6}')
+
+    violations = check_gates(report, args.max_p95, args.min_throughput)
+    for violation in violations:
+        print(f'GATE FAILED: {violation}', file=sys.stderr)
+    sys.exit(1 if violations else 0)
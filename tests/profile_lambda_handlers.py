@@ -0,0 +1,210 @@
+import argparse
+import base64
+import contextlib
+import importlib
+import io
+import json
+import math
+import multiprocessing
+import time
+from fakes import Context, FakeS3, FakeSQS
+from config import *
+
+HANDLERS = (UPLOAD_HANDLER, THUMBNAIL_GENERATE_HANDLER, DOWNLOAD_HANDLER, DOWNLOAD_THUMBNAIL_HANDLER)
+
+# Lambda gives a function a full vCPU at 1769 MB, and a proportional share of one below
+FULL_VCPU_MB = 1769
+MEMORY_STEP_MB = 64
+MIN_MEMORY_MB = 128
+MIN_TIMEOUT_S = 3
+
+# Margin over the measured peak RSS, and over the slowest estimated invocation
+MEMORY_HEADROOM = 1.5
+TIMEOUT_HEADROOM = 3
+
+
+def peak_rss_mib() -> float:
+    # VmHWM is the peak of this process only, spawned workers don't inherit their parent's like ru_maxrss
+    with open('/proc/self/status') as status_file:
+        for line in status_file:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def prepare_events(corpus_size: int, batch_size: int) -> dict:
+    """
+    Runs the pipeline once to build realistic events for every handler, and the bucket each one starts from.
+
+    Returns:
+        dict: Mapping of handler name to a (bucket objects, events) tuple.
+    """
+    # Only the parent renders the corpus, so the workers don't load Pillow unless their handler does
+    from pipeline_emulator import PipelineEmulator, build_corpus
+
+    emulator = PipelineEmulator()
+    upload_events, file_names = [], []
+    for index, (extension, _, image_data) in enumerate(build_corpus(corpus_size)):
+        file_name = f'profile-{index}.{extension}'
+        body = {'file': {'filename': file_name, 'content': base64.b64encode(image_data).decode('utf-8')}}
+        upload_events.append({'body': json.dumps(body)})
+        emulator.upload(file_name, image_data)
+        file_names.append(file_name)
+    uploaded = dict(emulator.s3.objects)
+
+    generate_events = []
+    while emulator.sqs.messages:
+        records = emulator.sqs.receive(batch_size)
+        generate_events.append({'Records': records})
+        emulator.generate(records)
+    rendered = dict(emulator.s3.objects)
+
+    download_events = [{'queryStringParameters': {'file_name': file_name}} for file_name in file_names]
+    thumbnail_events = [{'queryStringParameters': {'file_name': file_name, 'size': size_name},
+                         'headers': {'Accept': 'image/webp,*/*'} if index % 2 else {}}
+                        for index, file_name in enumerate(file_names) for size_name in THUMBNAIL_SIZES]
+    return {
+        UPLOAD_HANDLER: ({}, upload_events),
+        THUMBNAIL_GENERATE_HANDLER: (uploaded, generate_events),
+        DOWNLOAD_HANDLER: (rendered, download_events),
+        # With LAZY_THUMBNAILS the first request of each image renders its ladder, like a download racing the queue
+        DOWNLOAD_THUMBNAIL_HANDLER: (uploaded if LAZY_THUMBNAILS else rendered, thumbnail_events),
+    }
+
+
+def stage_means(metrics_lines: str) -> dict:
+    # Mean milliseconds per invocation of every stage timed by the handler's metrics lines
+    records = [json.loads(line) for line in metrics_lines.splitlines() if line.startswith('{"_aws"')]
+    totals = {}
+    for record in records:
+        for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']:
+            if metric['Unit'] == 'Milliseconds' and metric['Name'] != 'duration_ms':
+                stage = metric['Name'].removesuffix('_ms')
+                totals[stage] = totals.get(stage, 0) + record[metric['Name']]
+    return {stage: round(total / len(records), 1) for stage, total in totals.items()}
+
+
+def profile_handler(handler_name: str, objects: dict, events: list, latency: float) -> dict:
+    """
+    Invokes one handler on each event, in a fresh process so its imports and peak RSS are its own.
+
+    Returns:
+        dict: Import time, wall and CPU milliseconds of every invocation (the first one is cold), peak RSS
+        and the mean time per invocation of each stage the handler's metrics report.
+    """
+    started = time.perf_counter()
+    handler = importlib.import_module(handler_name)
+    import_ms = (time.perf_counter() - started) * 1000
+
+    s3, sqs = FakeS3(latency), FakeSQS(latency)
+    s3.objects = dict(objects)
+    for client_name, fake in (('s3', s3), ('s3_client', s3), ('sqs_client', sqs)):
+        if hasattr(handler, client_name):
+            setattr(handler, client_name, fake)
+
+    import metrics
+    metrics.enabled = True
+    metrics_output = io.StringIO()
+    wall_ms, cpu_ms = [], []
+    with contextlib.redirect_stdout(metrics_output):
+        for event in events:
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            handler.lambda_handler(event, Context(900))
+            wall_ms.append((time.perf_counter() - wall_start) * 1000)
+            cpu_ms.append((time.process_time() - cpu_start) * 1000)
+    return {'import_ms': import_ms, 'wall_ms': wall_ms, 'cpu_ms': cpu_ms, 'peak_rss_mib': peak_rss_mib(),
+            'stages_ms': stage_means(metrics_output.getvalue())}
+
+
+def estimated_ms(wall_ms: float, cpu_ms: float, memory_mb: int, cpu_scale: float) -> float:
+    # Waiting (S3/SQS round-trips) takes as long on Lambda, CPU work is stretched by the vCPU share
+    cpu_ms = min(cpu_ms, wall_ms)
+    return wall_ms - cpu_ms + cpu_ms * cpu_scale * max(1.0, FULL_VCPU_MB / memory_mb)
+
+
+def recommend(profile: dict, target_ms: float, cpu_scale: float) -> dict:
+    """
+    Picks the MemorySize and Timeout of a function from its profile.
+
+    Memory is the smallest size fitting the peak RSS with MEMORY_HEADROOM, raised while the estimated
+    p95 of warm invocations stays above `target_ms`, up to one full vCPU (two when the handler used more
+    CPU than wall time, i.e. several threads). Below one vCPU a CPU-bound function costs about the same
+    at any size, since its duration shrinks as its memory grows. The timeout covers the slowest estimated
+    invocation, cold start included, with TIMEOUT_HEADROOM.
+
+    Returns:
+        dict: 'memory_mb', 'timeout_s' and the estimated 'p95_ms' at that memory.
+    """
+    from pipeline_emulator import percentile
+
+    warm = list(zip(profile['wall_ms'][1:] or profile['wall_ms'], profile['cpu_ms'][1:] or profile['cpu_ms']))
+    multi_threaded = sum(profile['cpu_ms']) > sum(profile['wall_ms']) * 1.2
+    max_memory = FULL_VCPU_MB * (2 if multi_threaded else 1)
+
+    memory_mb = max(MIN_MEMORY_MB, math.ceil(profile['peak_rss_mib'] * MEMORY_HEADROOM / MEMORY_STEP_MB)
+                    * MEMORY_STEP_MB)
+    while memory_mb < max_memory:
+        p95 = percentile([estimated_ms(wall, cpu, memory_mb, cpu_scale) for wall, cpu in warm], 0.95)
+        if p95 <= target_ms:
+            break
+        memory_mb = min(max_memory, memory_mb + MEMORY_STEP_MB)
+
+    slowest = max(estimated_ms(wall, cpu, memory_mb, cpu_scale)
+                  for wall, cpu in zip(profile['wall_ms'], profile['cpu_ms']))
+    slowest += profile['import_ms'] * max(1.0, FULL_VCPU_MB / memory_mb)
+    return {
+        'memory_mb': memory_mb,
+        'timeout_s': max(MIN_TIMEOUT_S, math.ceil(slowest * TIMEOUT_HEADROOM / 1000)),
+        'p95_ms': round(percentile([estimated_ms(wall, cpu, memory_mb, cpu_scale) for wall, cpu in warm], 0.95), 1),
+    }
+
+
+def run_profiles(corpus_size: int, batch_size: int, latency: float) -> dict:
+    prepared = prepare_events(corpus_size, batch_size)
+    context = multiprocessing.get_context('spawn')
+    profiles = {}
+    for handler_name in HANDLERS:
+        objects, events = prepared[handler_name]
+        with context.Pool(1) as pool:
+            profiles[handler_name] = pool.apply(profile_handler, (handler_name, objects, events, latency))
+    return profiles
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Profiles each Lambda handler against in-memory S3/SQS and recommends its MemorySize and Timeout.')
+    parser.add_argument('--corpus', type=int, default=12, help='Distinct images the events are built from.')
+    parser.add_argument('--batch-size', type=int, default=10, help='SQS records per thumbnail invocation.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Injected latency of each S3/SQS call in seconds.')
+    parser.add_argument('--target-ms', type=float, default=1000,
+                        help='Estimated warm p95 duration memory is raised towards.')
+    parser.add_argument('--cpu-scale', type=float, default=1.0,
+                        help='How much slower a Lambda vCPU is than one local core.')
+    parser.add_argument('--json', action='store_true', help='Print the profiles and recommendations as JSON.')
+    args = parser.parse_args()
+
+    from pipeline_emulator import percentile
+
+    profiles = run_profiles(args.corpus, args.batch_size, args.latency)
+    recommendations = {handler_name: recommend(profile, args.target_ms, args.cpu_scale)
+                       for handler_name, profile in profiles.items()}
+
+    if args.json:
+        print(json.dumps({'profiles': profiles, 'recommendations': recommendations}, indent=2))
+    else:
+        print(f'{"handler":>26} {"calls":>6} {"rss MiB":>8} {"import ms":>10} {"p50 ms":>8} {"p95 ms":>8} '
+              f'{"cpu p95":>8} {"memory":>7} {"timeout":>8} {"est p95":>8}')
+        for handler_name, profile in profiles.items():
+            recommendation = recommendations[handler_name]
+            print(f'{handler_name:>26} {len(profile["wall_ms"]):>6} {profile["peak_rss_mib"]:>8.1f} '
+                  f'{profile["import_ms"]:>10.1f} {percentile(profile["wall_ms"], 0.5):>8.1f} '
+                  f'{percentile(profile["wall_ms"], 0.95):>8.1f} {percentile(profile["cpu_ms"], 0.95):>8.1f} '
+                  f'{recommendation["memory_mb"]:>7} {recommendation["timeout_s"]:>8} {recommendation["p95_ms"]:>8}')
+        print()
+        print('Mean ms per invocation by stage, threads of a batch add up:')
+        for handler_name, profile in profiles.items():
+            print(f'{handler_name:>26} ' + '  '.join(f'{stage} {value}' for stage, value
+                                                      in sorted(profile['stages_ms'].items(), key=lambda item: -item[1])))
+    print()
+    print('LAMBDA_MEMORY_SIZES=' + ','.join(f'{name}:{values["memory_mb"]}' for name, values in recommendations.items()))
+    print('LAMBDA_TIMEOUTS=' + ','.join(f'{name}:{values["timeout_s"]}' for name, values in recommendations.items()))
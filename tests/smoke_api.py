@@ -0,0 +1,51 @@
+import argparse
+import base64
+import os
+import sys
+import requests
+
+# Smoke test of a deployed API, run by hand after `python main.py`. It isn't collected by pytest.
+DEFAULT_IMAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_resources', 'img.jpg')
+
+
+def upload(api_url: str, image_path: str) -> bool:
+    # Read the image file and encode it to base64
+    with open(image_path, 'rb') as image_file:
+        file_content = base64.b64encode(image_file.read()).decode('utf-8')
+    payload = {'file': {'filename': os.path.basename(image_path), 'content': file_content}}
+
+    response = requests.post(f'{api_url}/upload', json=payload, headers={'Content-Type': 'application/json'})
+    if response.status_code == 200:
+        print('Upload successful:', response.json())
+        return True
+    print('Upload failed:', response.status_code, response.text)
+    return False
+
+
+def download(api_url: str, path: str, file_name: str, output_path: str) -> bool:
+    response = requests.get(f'{api_url}/{path}', params={'file_name': file_name})
+    if response.status_code == 200:
+        # Save the response to the local system
+        with open(output_path, 'wb') as file:
+            file.write(response.content)
+        print(f'/{path} of "{file_name}" saved to {output_path}.')
+        return True
+    print(f'/{path} of "{file_name}" failed: HTTP {response.status_code} {response.text}')
+    return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Uploads an image to a deployed API, then downloads it and its '
+                                                 'thumbnail.')
+    parser.add_argument('api_url', help='Stage URL, e.g. https://<api-id>.execute-api.<region>.amazonaws.com/dev')
+    parser.add_argument('--image', default=DEFAULT_IMAGE, help='Image to upload.')
+    parser.add_argument('--output-dir', default='.', help='Directory the downloads are saved to.')
+    args = parser.parse_args()
+
+    api_url = args.api_url.rstrip('/')
+    file_name = os.path.basename(args.image)
+    # The thumbnail is rendered asynchronously, /download-thumbnail renders it on demand when LAZY_THUMBNAILS is on
+    ok = upload(api_url, args.image) and \
+        download(api_url, 'download', file_name, os.path.join(args.output_dir, file_name)) and \
+        download(api_url, 'download-thumbnail', file_name, os.path.join(args.output_dir, f'thumbnail-{file_name}'))
+    sys.exit(0 if ok else 1)
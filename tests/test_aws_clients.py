@@ -0,0 +1,35 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+# Puts config/ and lambda/ on the path
+import fakes  # noqa: F401
+import aws_clients
+
+
+def test_clients_are_built_on_first_use(monkeypatch):
+    monkeypatch.setattr(aws_clients, 'AWS_CLIENT_PRELOAD', [])
+    s3 = aws_clients.client('s3')
+    assert s3._client is None
+    assert s3.meta.service_model.service_name == 's3'
+    assert s3._client is not None
+
+
+def test_clients_are_built_once_across_threads(monkeypatch):
+    monkeypatch.setattr(aws_clients, 'AWS_CLIENT_PRELOAD', [])
+    sqs = aws_clients.client('sqs')
+    start = threading.Barrier(8)
+
+    def build():
+        start.wait()
+        return sqs._get()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        built = list(pool.map(lambda _: build(), range(8)))
+    assert all(client is built[0] for client in built)
+    # The client carries the pooled, retrying config
+    assert built[0].meta.config.max_pool_connections == aws_clients.AWS_MAX_POOL_CONNECTIONS
+
+
+def test_preloaded_clients_are_built_at_import(monkeypatch):
+    monkeypatch.setattr(aws_clients, 'AWS_CLIENT_PRELOAD', ['s3'])
+    assert aws_clients.client('s3')._client is not None
+    assert aws_clients.client('sqs')._client is None
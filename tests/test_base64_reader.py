@@ -0,0 +1,50 @@
+import base64
+import binascii
+import io
+import pytest
+# Puts config/ and lambda/ on the path
+import fakes  # noqa: F401
+from lambda_upload import Base64Reader
+
+DATA = bytes(range(256)) * 40 + b'tail'
+
+
+def read_all(encoded, chunk_size, read_size=None):
+    reader = Base64Reader(encoded, chunk_size=chunk_size)
+    if read_size is None:
+        return io.BufferedReader(reader).read(), reader
+    parts = []
+    while True:
+        part = reader.read(read_size)
+        if not part:
+            return b''.join(parts), reader
+        parts.append(part)
+
+
+@pytest.mark.parametrize('chunk_size', [4, 5, 7, 64, 1000, 100000])
+def test_chunk_boundaries_anywhere(chunk_size):
+    # Chunk sizes that aren't a multiple of 4, and whitespace, split 4 character groups across chunks
+    for encoded in (base64.b64encode(DATA).decode(), base64.encodebytes(DATA).decode(),
+                    base64.encodebytes(DATA).decode().replace('\n', '\r\n'),
+                    ' \t'.join(base64.b64encode(DATA).decode()[i:i + 3] for i in range(0, 14000, 3))):
+        for read_size in (None, 1, 3, 4096):
+            decoded, reader = read_all(encoded, chunk_size, read_size)
+            assert decoded == DATA and reader.bytes_read == len(DATA)
+
+
+@pytest.mark.parametrize('length', [1, 2, 3, 10, 11])
+def test_missing_padding(length):
+    encoded = base64.b64encode(DATA[:length]).decode().rstrip('=')
+    assert read_all(encoded, 8)[0] == DATA[:length]
+    assert read_all(encoded + '\n', 8)[0] == DATA[:length]
+
+
+@pytest.mark.parametrize('encoded', ['Zm9v!YmFy', 'Zm9v-_xx', 'Zm9vY'])
+def test_invalid_input_is_rejected(encoded):
+    with pytest.raises(binascii.Error):
+        read_all(encoded, 8)
+
+
+def test_empty_content():
+    decoded, reader = read_all('', 8)
+    assert decoded == b'' and reader.bytes_read == 0
@@ -0,0 +1,60 @@
+import os
+import sys
+import threading
+import time
+import pytest
+from fakes import REPO_ROOT
+
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts'))
+from deploy_graph import Step, poll, run_steps
+
+
+def test_independent_steps_run_concurrently_and_dependents_wait():
+    # Three 0.2s roots in parallel, then a step using all their results
+    barrier = threading.Barrier(3, timeout=5)
+
+    def root(value):
+        def run(_):
+            barrier.wait()
+            time.sleep(0.2)
+            return value
+        return run
+
+    steps = [Step('join', lambda results: sum(results.values()), ['a', 'b', 'c']),
+             Step('a', root(1)), Step('b', root(2)), Step('c', root(3))]
+    started = time.perf_counter()
+    results, timings = run_steps(steps)
+    assert time.perf_counter() - started < 0.5
+    assert results['join'] == 6
+    assert timings['join']['start'] >= max(timings[name]['start'] + timings[name]['seconds'] for name in 'abc')
+
+
+def test_failure_skips_dependents_only():
+    def fail(_):
+        raise RuntimeError('boom')
+
+    steps = [Step('role', lambda _: None), Step('queue', fail), Step('bucket', lambda _: 'bucket'),
+             Step('function', lambda _: 'arn', ['role']), Step('trigger', lambda _: True, ['function', 'queue']),
+             Step('notification', lambda _: True, ['bucket'])]
+    results, timings = run_steps(steps)
+    assert {name: timing['status'] for name, timing in timings.items()} == {
+        'role': 'failed', 'queue': 'failed', 'bucket': 'ok', 'function': 'skipped', 'trigger': 'skipped',
+        'notification': 'ok'}
+    assert set(results) == {'bucket', 'notification'}
+
+
+def test_invalid_graphs_are_rejected():
+    with pytest.raises(ValueError):
+        run_steps([Step('a', lambda _: True, ['missing'])])
+    with pytest.raises(ValueError):
+        run_steps([Step('a', lambda _: True, ['b']), Step('b', lambda _: True, ['a'])])
+
+
+def test_poll_backs_off_until_ready():
+    attempts = []
+    result = poll(lambda: attempts.append(time.perf_counter()) or len(attempts) == 3 and 'ready', 'test', timeout=5,
+                  delay=0.05)
+    assert result == 'ready'
+    # The second wait is at least half of the doubled delay
+    assert attempts[2] - attempts[1] >= 0.05
+    assert poll(lambda: None, 'never', timeout=0.1, delay=0.05) is None
@@ -0,0 +1,87 @@
+import base64
+import pytest
+from fakes import FakeS3
+from byte_cache import ByteCache
+from download_responses import byte_range, cached_object, download_response, is_unchanged_for_client
+
+BUCKET_NAME = 'cache-bucket'
+
+
+def test_byte_range():
+    assert byte_range('bytes=0-9', 100) == (0, 9)
+    assert byte_range('bytes=90-', 100) == (90, 99)
+    assert byte_range('bytes=95-200', 100) == (95, 99)
+    # Suffix ranges count from the end, a suffix longer than the object is the whole object
+    assert byte_range('bytes=-10', 100) == (90, 99)
+    assert byte_range('bytes=-500', 100) == (0, 99)
+    # Unsatisfiable ranges
+    assert byte_range('bytes=100-', 100) is False
+    assert byte_range('bytes=-0', 100) is False
+    assert byte_range('bytes=20-10', 100) is False
+    # Ignored, served as a plain 200
+    assert byte_range('bytes=0-1,5-6', 100) is None
+    assert byte_range('items=0-1', 100) is None
+    assert byte_range('bytes=a-b', 100) is None
+
+
+def test_if_none_match_lists():
+    assert is_unchanged_for_client({'if-none-match': '"a", "b"'}, '"b"', None)
+    assert is_unchanged_for_client({'if-none-match': 'W/"b"'}, '"b"', None)
+    assert is_unchanged_for_client({'if-none-match': '*'}, '"b"', None)
+    assert not is_unchanged_for_client({'if-none-match': '"a", "c"'}, '"b"', None)
+
+
+def test_lru_eviction_by_byte_size():
+    cache = ByteCache(max_bytes=100, ttl=60, max_entry_bytes=60)
+    cache.put('a', b'a' * 40, 'image/png', '"a"', None)
+    cache.put('b', b'b' * 40, 'image/png', '"b"', None)
+    assert cache.get('a') is not None
+    # 'b' is now the least recently used, and goes to make room for 'c'
+    cache.put('c', b'c' * 40, 'image/png', '"c"', None)
+    assert cache.get('b') is None and cache.get('a') is not None and cache.get('c') is not None
+    assert cache.size == 80
+    # Objects over max_entry_bytes are returned but never cached
+    assert cache.put('d', b'd' * 61, 'image/png', '"d"', None).data == b'd' * 61
+    assert cache.get('d') is None and cache.size == 80
+    # Replacing an entry doesn't count its old body
+    cache.put('a', b'a' * 10, 'image/png', '"a2"', None)
+    assert cache.size == 50
+
+
+def test_expired_entries_are_revalidated():
+    s3 = FakeS3()
+    s3.put_object(Bucket=BUCKET_NAME, Key='cat.png', Body=b'first', ContentType='image/png')
+    cache = ByteCache(max_bytes=1000, ttl=60, max_entry_bytes=1000)
+    assert cached_object(s3, cache, BUCKET_NAME, 'cat.png').data == b'first'
+    assert cached_object(s3, cache, BUCKET_NAME, 'cat.png').data == b'first'
+    assert [operation for operation, _ in s3.calls] == ['PutObject', 'GetObject']
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Unchanged: a 304 refreshes the entry
+    cache.get('cat.png').expires_at = 0
+    entry = cached_object(s3, cache, BUCKET_NAME, 'cat.png')
+    assert entry.data == b'first' and cache.is_fresh(entry) and cache.revalidations == 1
+
+    # Changed: the new body replaces the entry
+    s3.put_object(Bucket=BUCKET_NAME, Key='cat.png', Body=b'second', ContentType='image/png')
+    cache.get('cat.png').expires_at = 0
+    entry = cached_object(s3, cache, BUCKET_NAME, 'cat.png')
+    assert entry.data == b'second' and entry.etag == s3.head_object(Bucket=BUCKET_NAME, Key='cat.png')['ETag']
+    assert (cache.misses, cache.size) == (2, len(b'second'))
+
+
+@pytest.mark.parametrize('range_header, status, body_size, content_range', [
+    ('bytes=-10', 206, 10, 'bytes 90-99/100'),
+    ('bytes=100-', 416, None, 'bytes */100'),
+    ('bytes=0-1,5-6', 200, 100, None),
+])
+def test_ranges_are_served_from_the_cache(range_header, status, body_size, content_range):
+    s3 = FakeS3()
+    s3.put_object(Bucket=BUCKET_NAME, Key='cat.png', Body=bytes(100), ContentType='image/png')
+    cache = ByteCache(max_bytes=1000, ttl=60, max_entry_bytes=1000)
+    response = download_response(s3, BUCKET_NAME, 'cat.png', {'headers': {'Range': range_header}}, mode='binary',
+                                 cache=cache)
+    assert response['statusCode'] == status
+    if body_size is not None:
+        assert len(base64.b64decode(response['body'])) == body_size
+    assert response['headers'].get('Content-Range') == content_range
@@ -0,0 +1,76 @@
+import io
+import json
+import threading
+import time
+import pytest
+from fakes import Context, FakeS3
+from PIL import Image
+from config import *
+import lambda_generate_thumbnail
+
+BUCKET_NAME = 'generate-bucket'
+
+
+def record(message_id, key='cat.jpg'):
+    return {'messageId': message_id, 'body': json.dumps({'bucket': BUCKET_NAME, 'key': key})}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    s3 = FakeS3()
+    buffer = io.BytesIO()
+    Image.new('RGB', (800, 600), (20, 120, 200)).save(buffer, 'JPEG')
+    s3.put_object(Bucket=BUCKET_NAME, Key='cat.jpg', Body=buffer.getvalue(), ContentType='image/jpeg')
+    monkeypatch.setattr(lambda_generate_thumbnail, 's3', s3)
+    return s3
+
+
+def puts(s3):
+    return [key for operation, key in s3.calls if operation == 'PutObject']
+
+
+def test_up_to_date_renditions_are_skipped(s3):
+    lambda_generate_thumbnail.process_object(BUCKET_NAME, 'cat.jpg')
+    assert len(puts(s3)) >= len(THUMBNAIL_SIZES)
+
+    s3.calls.clear()
+    lambda_generate_thumbnail.process_object(BUCKET_NAME, 'cat.jpg')
+    assert puts(s3) == []
+
+    # A new original has a new ETag, its renditions are rendered again
+    buffer = io.BytesIO()
+    Image.new('RGB', (800, 600), (200, 20, 20)).save(buffer, 'JPEG')
+    s3.put_object(Bucket=BUCKET_NAME, Key='cat.jpg', Body=buffer.getvalue(), ContentType='image/jpeg')
+    s3.calls.clear()
+    lambda_generate_thumbnail.process_object(BUCKET_NAME, 'cat.jpg')
+    assert len(puts(s3)) >= len(THUMBNAIL_SIZES)
+
+
+def test_only_failed_records_are_reported(s3):
+    records = [record('good'), record('missing', 'gone.jpg'), record('good-too')]
+    response = lambda_generate_thumbnail.lambda_handler({'Records': records}, Context(10))
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'missing'}]}
+
+
+def test_slow_records_time_out(monkeypatch):
+    release = threading.Event()
+
+    def process_record(message):
+        if message['messageId'].startswith('slow'):
+            release.wait(5)
+
+    monkeypatch.setattr(lambda_generate_thumbnail, 'process_record', process_record)
+    monkeypatch.setattr(lambda_generate_thumbnail, 'THUMBNAIL_RECORD_TIMEOUT', 0.2)
+    try:
+        started = time.monotonic()
+        failed = lambda_generate_thumbnail.process_batch([record('slow'), record('fast')], remaining_seconds=30)
+        assert failed == ['slow'] and time.monotonic() - started < 2
+
+        # Records still running THUMBNAIL_TIMEOUT_MARGIN seconds before the invocation ends fail too
+        monkeypatch.setattr(lambda_generate_thumbnail, 'THUMBNAIL_RECORD_TIMEOUT', 30)
+        started = time.monotonic()
+        failed = lambda_generate_thumbnail.process_batch([record('slow-1'), record('fast'), record('slow-2')],
+                                                         remaining_seconds=THUMBNAIL_TIMEOUT_MARGIN + 0.2)
+        assert sorted(failed) == ['slow-1', 'slow-2'] and time.monotonic() - started < 2
+    finally:
+        release.set()
@@ -0,0 +1,281 @@
+import base64
+import copy
+import hashlib
+import json
+import os
+import sys
+import pytest
+from fakes import REPO_ROOT, client_error
+
+import config
+
+# The deploy scripts import config/config.py as config.config, the handlers as config
+sys.modules.setdefault('config.config', config)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts'))
+# The deploy scripts build their boto3 clients at import
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+import apigateway_operations
+import iam_operations
+import lambda_operations
+import sqs_operations
+import utils
+
+
+class FakeWaiter:
+    def wait(self, **kwargs):
+        pass
+
+
+class FakeLambda:
+    """Functions by name, in the shape get_function_configuration returns them, and the write calls made."""
+
+    def __init__(self):
+        self.functions = {}
+        self.calls = []
+
+    def get_waiter(self, name):
+        return FakeWaiter()
+
+    def get_function_configuration(self, FunctionName):
+        if FunctionName not in self.functions:
+            raise client_error('ResourceNotFoundException', 404, 'GetFunctionConfiguration')
+        return dict(self.functions[FunctionName])
+
+    def create_function(self, FunctionName, Code, Layers, **configuration):
+        self.calls.append('create_function')
+        self.functions[FunctionName] = {'FunctionArn': f'arn:{FunctionName}', 'CodeSha256': sha256(Code['ZipFile']),
+                                        'Layers': [{'Arn': arn} for arn in Layers], **configuration}
+        return self.functions[FunctionName]
+
+    def update_function_code(self, FunctionName, ZipFile):
+        self.calls.append('update_function_code')
+        self.functions[FunctionName]['CodeSha256'] = sha256(ZipFile)
+
+    def update_function_configuration(self, FunctionName, **configuration):
+        self.calls.append(f'update_function_configuration {sorted(configuration)}')
+        if 'Layers' in configuration:
+            configuration['Layers'] = [{'Arn': arn} for arn in configuration['Layers']]
+        self.functions[FunctionName].update(configuration)
+
+
+def sha256(data):
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+class FakeApiGateway:
+    """One region's REST APIs with single-level resources, recording the write calls made."""
+
+    def __init__(self):
+        self.apis = {}
+        self.calls = []
+
+    def get_paginator(self, operation):
+        fake = self
+
+        class Paginator:
+            def paginate(self, restApiId=None, embed=None):
+                if operation == 'get_rest_apis':
+                    return [{'items': [dict(api, createdDate=index) for index, api in enumerate(fake.apis.values())]}]
+                return [{'items': copy.deepcopy(list(fake.apis[restApiId]['resources'].values()))}]
+        return Paginator()
+
+    def create_rest_api(self, name, description, binaryMediaTypes):
+        self.calls.append('create_rest_api')
+        api_id = f'api{len(self.apis)}'
+        self.apis[api_id] = {'id': api_id, 'name': name, 'binaryMediaTypes': binaryMediaTypes,
+                             'resources': {'root': {'id': 'root', 'path': '/'}}}
+        return {key: value for key, value in self.apis[api_id].items() if key != 'resources'}
+
+    def create_resource(self, restApiId, parentId, pathPart):
+        self.calls.append(f'create_resource {pathPart}')
+        self.apis[restApiId]['resources'][pathPart] = {'id': pathPart, 'pathPart': pathPart, 'resourceMethods': {}}
+        return {'id': pathPart}
+
+    def delete_resource(self, restApiId, resourceId):
+        self.calls.append(f'delete_resource {resourceId}')
+        del self.apis[restApiId]['resources'][resourceId]
+
+    def delete_method(self, restApiId, resourceId, httpMethod):
+        self.calls.append(f'delete_method {resourceId}')
+        del self.apis[restApiId]['resources'][resourceId]['resourceMethods'][httpMethod]
+
+    def put_method(self, restApiId, resourceId, httpMethod, authorizationType):
+        self.apis[restApiId]['resources'][resourceId]['resourceMethods'][httpMethod] = {}
+
+    def put_integration(self, restApiId, resourceId, httpMethod, type, uri, **kwargs):
+        self.apis[restApiId]['resources'][resourceId]['resourceMethods'][httpMethod] = {
+            'methodIntegration': {'type': type, 'uri': uri}}
+
+    def create_deployment(self, restApiId, stageName):
+        self.calls.append('create_deployment')
+
+    def tag_resource(self, resourceArn, tags):
+        self.apis[resourceArn.rsplit('/', 1)[1]].setdefault('tags', {}).update(tags)
+
+
+class FakeIAM:
+    """Roles by name with their inline policies, and the policy writes made."""
+
+    def __init__(self):
+        self.roles = {}
+        self.calls = []
+
+    def create_role(self, RoleName, AssumeRolePolicyDocument):
+        if RoleName in self.roles:
+            raise client_error('EntityAlreadyExists', 409, 'CreateRole')
+        self.roles[RoleName] = {}
+        return {'Role': {'Arn': f'arn:aws:iam::123:role/{RoleName}'}}
+
+    def get_role(self, RoleName):
+        if RoleName not in self.roles:
+            raise client_error('NoSuchEntity', 404, 'GetRole')
+        return {'Role': {'RoleName': RoleName}}
+
+    def get_role_policy(self, RoleName, PolicyName):
+        if PolicyName not in self.roles.get(RoleName, {}):
+            raise client_error('NoSuchEntity', 404, 'GetRolePolicy')
+        return {'PolicyDocument': json.loads(self.roles[RoleName][PolicyName])}
+
+    def put_role_policy(self, RoleName, PolicyName, PolicyDocument):
+        self.calls.append('put_role_policy')
+        self.roles[RoleName][PolicyName] = PolicyDocument
+
+
+class FakeSQSQueues:
+    """Queue attributes by name, create_queue fails on different attributes like SQS does."""
+
+    def __init__(self):
+        self.queues = {}
+
+    def create_queue(self, QueueName, Attributes):
+        if self.queues.get(QueueName, Attributes) != Attributes:
+            raise client_error('QueueAlreadyExists', 400, 'CreateQueue')
+        self.queues[QueueName] = dict(Attributes)
+        return {'QueueUrl': f'https://sqs/{QueueName}'}
+
+    def get_queue_url(self, QueueName):
+        return {'QueueUrl': f'https://sqs/{QueueName}'}
+
+    def set_queue_attributes(self, QueueUrl, Attributes):
+        self.queues[QueueUrl.rsplit('/', 1)[1]].update(Attributes)
+
+
+class FakeEventSourceMappings:
+    """The event source mappings of the Lambda client, by UUID."""
+
+    def __init__(self):
+        self.mappings = {}
+
+    def list_event_source_mappings(self, EventSourceArn, FunctionName):
+        return {'EventSourceMappings': [mapping for mapping in self.mappings.values()
+                                        if (mapping['EventSourceArn'], mapping['FunctionName']) ==
+                                        (EventSourceArn, FunctionName)]}
+
+    def create_event_source_mapping(self, **settings):
+        uuid = str(len(self.mappings))
+        self.mappings[uuid] = {'UUID': uuid, **settings}
+        return self.mappings[uuid]
+
+    def update_event_source_mapping(self, UUID, **settings):
+        self.mappings[UUID].update(settings)
+        return self.mappings[UUID]
+
+
+@pytest.fixture
+def fake_lambda(monkeypatch):
+    fake = FakeLambda()
+    monkeypatch.setattr(lambda_operations, 'lambda_client', fake)
+    return fake
+
+
+@pytest.fixture
+def fake_apigateway(monkeypatch):
+    fake = FakeApiGateway()
+    monkeypatch.setattr(apigateway_operations, 'apigateway_client', fake)
+    return fake
+
+
+def test_redeploy_only_updates_what_changed(fake_lambda, monkeypatch):
+    arn = lambda_operations.create_lambda_function('image-download', 'lambda_download_image', 'arn:role', [])
+    assert arn == 'arn:image-download' and fake_lambda.calls == ['create_function']
+
+    # Packages are reproducible, so the same code is recognised as deployed
+    assert lambda_operations.plan_lambda_function('image-download', 'lambda_download_image', 'arn:role', []) == []
+    lambda_operations.create_lambda_function('image-download', 'lambda_download_image', 'arn:role', [])
+    assert fake_lambda.calls == ['create_function']
+
+    lambda_operations.create_lambda_function('image-download', 'lambda_download_image', 'arn:role', ['arn:layer:1'])
+    assert fake_lambda.calls[1:] == ["update_function_configuration ['Layers']"]
+
+    # Shipping another shared module changes the package
+    monkeypatch.setattr(lambda_operations, 'LAMBDA_SHARED_MODULES', lambda_operations.LAMBDA_SHARED_MODULES[:-1])
+    changes = lambda_operations.plan_lambda_function('image-download', 'lambda_download_image', 'arn:role',
+                                                     ['arn:layer:1'])
+    assert len(changes) == 1 and changes[0].startswith('update code')
+    lambda_operations.create_lambda_function('image-download', 'lambda_download_image', 'arn:role', ['arn:layer:1'])
+    assert fake_lambda.calls[2:] == ['update_function_code']
+
+
+def test_api_is_reconciled_in_place(fake_apigateway):
+    functions = [('image-upload', 'lambda_upload', 'upload'), ('image-download', 'lambda_download_image', 'download'),
+                 ('image-thumbnail-generate', 'lambda_generate_thumbnail', None)]
+    url, api_id = apigateway_operations.create_api_gateway('images', functions, 'us-east-1', '123')
+    assert fake_apigateway.calls == ['create_rest_api', 'create_resource upload', 'create_resource download',
+                                     'create_deployment']
+
+    # Unchanged: one read, no deployment
+    assert apigateway_operations.create_api_gateway('images', functions, 'us-east-1', '123') == (url, api_id)
+    assert len(fake_apigateway.calls) == 4
+    assert apigateway_operations.plan_api_gateway('images', functions, 'us-east-1', '123') == []
+
+    # /download moves to another function and /upload goes away, on the same API
+    functions = [('image-download-v2', 'lambda_download_image', 'download')]
+    assert apigateway_operations.plan_api_gateway('images', functions, 'us-east-1', '123') == [
+        'update /download', 'delete /upload', "deploy stage 'dev'"]
+    assert apigateway_operations.create_api_gateway('images', functions, 'us-east-1', '123') == (url, api_id)
+    assert fake_apigateway.calls[4:] == ['delete_method download', 'delete_resource upload', 'create_deployment']
+    assert 'image-download-v2' in (fake_apigateway.apis[api_id]['resources']['download']['resourceMethods']['GET']
+                                   ['methodIntegration']['uri'])
+
+
+def test_queue_and_trigger_are_updated_in_place(monkeypatch):
+    queues, mappings = FakeSQSQueues(), FakeEventSourceMappings()
+    monkeypatch.setattr(sqs_operations, 'sqs_client', queues)
+    monkeypatch.setattr(utils, 'lambda_client', mappings)
+
+    # Six times the function timeout, plus the time a message may wait in a batch being filled
+    attributes = sqs_operations.queue_attributes(sqs_operations.visibility_timeout(30, 5), 'arn:dlq', 3)
+    assert attributes['VisibilityTimeout'] == '185'
+    assert sqs_operations.create_sqs_queue('jobs') == 'https://sqs/jobs'
+    assert sqs_operations.create_sqs_queue('jobs', attributes) == 'https://sqs/jobs'
+    assert json.loads(queues.queues['jobs']['RedrivePolicy']) == {'deadLetterTargetArn': 'arn:dlq',
+                                                                  'maxReceiveCount': '3'}
+
+    assert utils.add_sqs_trigger_to_lambda('thumbnails', 'arn:jobs')['BatchSize'] == 10
+    assert 'ScalingConfig' not in mappings.mappings['0']
+    utils.add_sqs_trigger_to_lambda('thumbnails', 'arn:jobs', batch_size=50, batching_window=2, max_concurrency=5)
+    assert len(mappings.mappings) == 1
+    assert mappings.mappings['0']['ScalingConfig'] == {'MaximumConcurrency': 5}
+    assert mappings.mappings['0']['MaximumBatchingWindowInSeconds'] == 2
+
+    # Lambda only accepts more than 10 records per batch with a batching window
+    assert utils.add_sqs_trigger_to_lambda('thumbnails', 'arn:jobs', batch_size=50) is None
+    assert mappings.mappings['0']['BatchSize'] == 50
+
+
+def test_role_policy_drift_is_planned_and_reconciled(monkeypatch):
+    iam = FakeIAM()
+    monkeypatch.setattr(iam_operations, 'iam_client', iam)
+    policy = {'Version': '2012-10-17', 'Statement': [{'Effect': 'Allow', 'Action': ['s3:GetObject'], 'Resource': '*'}]}
+    assert iam_operations.plan_iam_role('lambda-role', policy) == ['create role and permissions policy']
+    arn = iam_operations.create_iam_role('lambda-role', {}, policy, '123')
+    assert iam_operations.plan_iam_role('lambda-role', policy) == []
+    assert iam_operations.create_iam_role('lambda-role', {}, policy, '123') == arn
+    assert iam.calls == ['put_role_policy']
+
+    # A permission added to the policy reaches the existing role
+    policy = copy.deepcopy(policy)
+    policy['Statement'][0]['Action'].append('s3:DeleteObject')
+    assert iam_operations.plan_iam_role('lambda-role', policy) == ['update permissions policy']
+    assert iam_operations.create_iam_role('lambda-role', {}, policy, '123') == arn
+    assert iam_operations.get_role_policy('lambda-role') == policy
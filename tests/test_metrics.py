@@ -0,0 +1,41 @@
+import json
+import pytest
+from fakes import Context, FakeS3
+from config import *
+from key_layout import original_key
+import lambda_download_image
+import metrics
+
+
+@pytest.fixture
+def download(monkeypatch):
+    s3 = FakeS3()
+    s3.put_object(Bucket=S3_BUCKET_NAME, Key=original_key('cat.png'), Body=b'\x89PNG' + b'\0' * 100,
+                  ContentType='image/png')
+    monkeypatch.setattr(lambda_download_image, 's3', s3)
+    monkeypatch.setattr(metrics, 'enabled', True)
+    return lambda event: lambda_download_image.lambda_handler(event, Context(5))
+
+
+def test_one_emf_line_per_invocation(download, capsys):
+    download({'queryStringParameters': {'file_name': 'cat.png'}})
+    download({'queryStringParameters': {'file_name': 'cat.png'}})
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 2
+
+    record = json.loads(lines[1])
+    directive = record['_aws']['CloudWatchMetrics'][0]
+    assert directive['Namespace'] == METRICS_NAMESPACE and directive['Dimensions'] == [['FunctionName']]
+    units = {metric['Name']: metric['Unit'] for metric in directive['Metrics']}
+    assert units['s3_get_ms'] == units['resolve_ms'] == units['duration_ms'] == 'Milliseconds'
+    assert units['download_bytes'] == 'Bytes' and units['cold_start'] == 'Count'
+    # Every metric has its value in the record, the second invocation of a container is warm
+    assert all(name in record for name in units)
+    assert record['download_bytes'] == 104 and record['cold_start'] == 0
+    assert record['status_code'] == 200 and record['response_mode'] == DOWNLOAD_RESPONSE_MODE
+
+
+def test_disabled_metrics_write_nothing(download, capsys, monkeypatch):
+    monkeypatch.setattr(metrics, 'enabled', False)
+    assert download({'queryStringParameters': {'file_name': 'cat.png'}})['statusCode'] == 200
+    assert capsys.readouterr().out == ''
@@ -0,0 +1,62 @@
+import os
+import sys
+import pytest
+from fakes import REPO_ROOT, FakeS3
+from config import *
+from key_layout import original_key, parse_key, thumbnail_key
+
+# The migration script builds its boto3 client at import
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts'))
+import migrate_key_layout
+
+BUCKET_NAME = 'migration-bucket'
+
+
+class CopyingS3(FakeS3):
+    """FakeS3 with the listing and server-side copy the migration uses. Copies get a single-part ETag."""
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective='COPY', ContentType=None, Metadata=None):
+        source = self.objects[(CopySource['Bucket'], CopySource['Key'])]
+        if MetadataDirective != 'REPLACE':
+            ContentType, Metadata = source['ContentType'], source['Metadata']
+        etag = self.put_object(Bucket=Bucket, Key=Key, Body=source['Data'], ContentType=ContentType,
+                               Metadata=Metadata)['ETag']
+        return {'CopyObjectResult': {'ETag': etag}}
+
+    def get_paginator(self, operation):
+        fake = self
+
+        class Paginator:
+            def paginate(self, Bucket):
+                yield {'Contents': [{'Key': key} for bucket, key in list(fake.objects) if bucket == Bucket]}
+        return Paginator()
+
+
+def test_keys_without_a_shard_are_rejected():
+    with pytest.raises(ValueError, match='no shard'):
+        parse_key(f'{ORIGINALS_PREFIX}cat.png', 'hashed')
+    assert parse_key(f'{ORIGINALS_PREFIX}3f/cat.png', 'hashed') == ('cat.png', None)
+
+
+def test_migration_skips_malformed_keys_and_keeps_renditions_up_to_date(monkeypatch):
+    s3 = CopyingS3()
+    monkeypatch.setattr(migrate_key_layout, 's3_client', s3)
+    source_key = original_key('cat.png', 'hashed')
+    s3.put_object(Bucket=BUCKET_NAME, Key=source_key, Body=b'original', ContentType='image/png')
+    # Uploaded in parts, so its ETag isn't the one a copy gets
+    multipart_etag = '"0123456789abcdef0123456789abcdef-2"'
+    s3.objects[(BUCKET_NAME, source_key)]['ETag'] = multipart_etag
+    rendition_key = thumbnail_key(source_key, DEFAULT_THUMBNAIL_SIZE, 'hashed')
+    s3.put_object(Bucket=BUCKET_NAME, Key=rendition_key, Body=b'thumbnail', ContentType='image/png',
+                  Metadata={'source-etag': multipart_etag, 'variants': ''})
+    s3.put_object(Bucket=BUCKET_NAME, Key=f'{ORIGINALS_PREFIX}stray.png', Body=b'stray')
+
+    counts = migrate_key_layout.migrate_bucket(BUCKET_NAME, 'hashed', 'flat')
+    assert counts == {'migrated': 2, 'skipped': 1, 'failed': 0}
+
+    new_original = s3.head_object(Bucket=BUCKET_NAME, Key='cat.png')
+    new_rendition = s3.head_object(Bucket=BUCKET_NAME, Key=thumbnail_key('cat.png', DEFAULT_THUMBNAIL_SIZE, 'flat'))
+    assert new_original['ETag'] != multipart_etag
+    assert new_rendition['Metadata'] == {'source-etag': new_original['ETag'], 'variants': ''}
+    assert new_rendition['ContentType'] == 'image/png'
@@ -0,0 +1,36 @@
+from pipeline_emulator import PipelineEmulator, build_corpus, check_gates, run_load, source_key
+from config import *
+
+
+def test_every_upload_reaches_download():
+    # A short offline run of the whole pipeline, every upload must come out as a downloadable thumbnail
+    report = run_load(PipelineEmulator(latency=0.005), build_corpus(4), rate=20, duration=1, consumers=2)
+    assert report['completed'] == report['uploads'] == 20
+    assert not check_gates(report, ['end_to_end=60000'], 0)
+    assert set(report['stages_ms']) == {'upload', 'queue_wait', 'thumbnail', 'download_thumbnail', 'download',
+                                        'end_to_end'}
+
+
+def failing_emulator(corpus, times):
+    # The first upload is the first corpus image, its thumbnail job can't read it `times` times
+    emulator = PipelineEmulator()
+    extension, image_format, image_data = corpus[0]
+    emulator.s3.failures[source_key(f'load-0.{extension}', image_data, image_format)] = times
+    return emulator
+
+
+def test_failed_records_are_redelivered():
+    corpus = build_corpus(2)
+    times = THUMBNAIL_QUEUE_MAX_RECEIVE_COUNT - 1
+    report = run_load(failing_emulator(corpus, times), corpus, rate=20, duration=0.2, consumers=2)
+    assert report['completed'] == report['uploads'] == 4
+    assert report['record_failures'] == times and report['dead_lettered'] == 0
+    assert not check_gates(report, [], 0)
+
+
+def test_records_failing_every_receive_are_dead_lettered():
+    corpus = build_corpus(2)
+    report = run_load(failing_emulator(corpus, 100), corpus, rate=20, duration=0.2, consumers=2)
+    assert report['completed'] == report['uploads'] - 1 == 3
+    assert report['record_failures'] == THUMBNAIL_QUEUE_MAX_RECEIVE_COUNT and report['dead_lettered'] == 1
+    assert any('1 dead-lettered' in violation for violation in check_gates(report, [], 0))
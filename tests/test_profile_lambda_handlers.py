@@ -0,0 +1,13 @@
+from profile_lambda_handlers import MIN_MEMORY_MB, recommend
+
+
+def test_cpu_bound_handlers_get_more_memory_than_waiting_ones():
+    # 800 ms of CPU is 11s at 128 MB, a 1000 ms p95 needs 100 + 800 * 1769 / memory <= 1000, i.e. 1573 MB
+    cpu_bound = {'import_ms': 20, 'peak_rss_mib': 90, 'wall_ms': [900] * 20, 'cpu_ms': [800] * 20}
+    waiting = {'import_ms': 20, 'peak_rss_mib': 60, 'wall_ms': [100] * 20, 'cpu_ms': [5] * 20}
+
+    renderer = recommend(cpu_bound, target_ms=1000, cpu_scale=1)
+    assert renderer['memory_mb'] == 1600 and renderer['p95_ms'] <= 1000
+    download = recommend(waiting, target_ms=1000, cpu_scale=1)
+    assert download['memory_mb'] == MIN_MEMORY_MB
+    assert download['timeout_s'] < renderer['timeout_s']
@@ -0,0 +1,53 @@
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from fakes import FakeS3
+from config import *
+import lambda_download_thumbnail
+
+LOCK_KEY = 'cat.png.rendering'
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(lambda_download_thumbnail, 's3', s3)
+    return s3
+
+
+def make_stale(s3):
+    lock = s3.objects[(S3_BUCKET_NAME, LOCK_KEY)]
+    lock['LastModified'] -= datetime.timedelta(seconds=LAZY_RENDER_LOCK_TTL + 1)
+
+
+def test_only_one_waiter_takes_over_a_stale_lock(s3):
+    assert lambda_download_thumbnail.acquire_render_lock(LOCK_KEY) is not None
+    assert lambda_download_thumbnail.acquire_render_lock(LOCK_KEY) is None
+    make_stale(s3)
+
+    # Both waiters find the same stale lock before either of them takes it over
+    both_headed = threading.Barrier(2)
+    head_object = s3.head_object
+
+    def head_then_wait(**kwargs):
+        lock = head_object(**kwargs)
+        both_headed.wait(5)
+        return lock
+
+    s3.head_object = head_then_wait
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        etags = list(pool.map(lambda _: lambda_download_thumbnail.acquire_render_lock(LOCK_KEY), range(2)))
+    assert len([etag for etag in etags if etag is not None]) == 1
+
+
+def test_a_lock_taken_over_is_not_released_by_its_first_holder(s3):
+    first = lambda_download_thumbnail.acquire_render_lock(LOCK_KEY)
+    make_stale(s3)
+    second = lambda_download_thumbnail.acquire_render_lock(LOCK_KEY)
+    assert second is not None and second != first
+
+    lambda_download_thumbnail.release_render_lock(LOCK_KEY, first)
+    assert s3.head_object(Bucket=S3_BUCKET_NAME, Key=LOCK_KEY)['ETag'] == second
+    lambda_download_thumbnail.release_render_lock(LOCK_KEY, second)
+    assert (S3_BUCKET_NAME, LOCK_KEY) not in s3.objects
@@ -0,0 +1,23 @@
+import os
+import sys
+from fakes import REPO_ROOT, client_error
+
+import config
+
+# The deploy scripts import config/config.py as config.config, the handlers as config
+sys.modules.setdefault('config.config', config)
+sys.path.insert(0, os.path.join(REPO_ROOT, 'scripts'))
+# The deploy scripts build their boto3 clients at import
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+import replay_dead_letters
+
+
+class MissingQueueSQS:
+    def get_queue_url(self, QueueName):
+        raise client_error('AWS.SimpleQueueService.NonExistentQueue', 400, 'GetQueueUrl')
+
+
+def test_missing_dead_letter_queue_is_reported(monkeypatch, caplog):
+    monkeypatch.setattr(replay_dead_letters, 'sqs_client', MissingQueueSQS())
+    assert replay_dead_letters.replay_dead_letters('thumbnails-dlq') is False
+    assert "Error finding SQS queue 'thumbnails-dlq'" in caplog.text
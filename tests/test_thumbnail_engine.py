@@ -0,0 +1,37 @@
+import io
+import warnings
+# Puts config/ and lambda/ on the path
+import fakes  # noqa: F401
+from PIL import Image
+from thumbnail_engine import REDUCING_GAP, fit_size, open_image, render_renditions
+
+
+def encode(image, image_format):
+    buffer = io.BytesIO()
+    with warnings.catch_warnings():
+        # Pillow deprecates saving I mode as PNG, decoders still hand 16-bit PNGs back as I;16
+        warnings.simplefilter('ignore', DeprecationWarning)
+        image.save(buffer, image_format)
+    return buffer.getvalue()
+
+
+def test_large_sources_are_decoded_reduced():
+    for image_format in ('JPEG', 'PNG'):
+        source = Image.effect_noise((2400, 1800), 40).convert('RGB')
+        image = open_image(encode(source, image_format), 256)
+        target = fit_size(source.size, 256)
+        # Never below REDUCING_GAP times the target, so the final resample still has pixels to work with
+        assert image.width >= target[0] * REDUCING_GAP and image.height >= target[1] * REDUCING_GAP
+        assert image.width <= source.width // 2 and image.format == image_format
+
+
+def test_16_bit_greyscale_keeps_its_tones():
+    gradient = Image.linear_gradient('L').resize((512, 512)).point(lambda value: value * 235, 'I')
+    data = encode(gradient, 'PNG')
+    assert Image.open(io.BytesIO(data)).mode.startswith('I')
+
+    thumbnail, content_type = render_renditions(data, {'thumbnail': 128})['thumbnail'][:2]
+    low, high = Image.open(io.BytesIO(thumbnail)).convert('L').getextrema()
+    assert content_type == 'image/png'
+    # 0..59925 scaled to 8 bits is 0..234, clipping would put most of it at 255
+    assert low < 10 and 220 < high < 240
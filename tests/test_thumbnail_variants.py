@@ -0,0 +1,115 @@
+import io
+import json
+import pytest
+from fakes import Context, FakeS3
+from PIL import Image
+from config import *
+from key_layout import VARIANT_CONTENT_TYPES, original_key, thumbnail_key, variant_key
+from renditions import rendition_metadata, store_renditions, stored_variants
+from byte_cache import ByteCache
+import lambda_download_thumbnail
+import thumbnail_engine
+
+WEBP_CLIENT = {'Accept': 'image/webp,*/*'}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(lambda_download_thumbnail, 's3', s3)
+    monkeypatch.setattr(lambda_download_thumbnail, 'missing_variants', {})
+    monkeypatch.setattr(lambda_download_thumbnail, 'thumbnail_cache', ByteCache(1024 * 1024, 60, 1024 * 1024))
+    return s3
+
+
+def download(file_name, headers):
+    event = {'queryStringParameters': {'file_name': file_name}, 'headers': headers}
+    return lambda_download_thumbnail.lambda_handler(event, Context(5))
+
+
+def variant_gets(s3):
+    return [key for operation, key in s3.calls if operation == 'GetObject' and key.endswith('.webp')]
+
+
+def put_rendition(s3, file_name, metadata):
+    s3.put_object(Bucket=S3_BUCKET_NAME, Key=original_key(file_name), Body=b'original')
+    s3.put_object(Bucket=S3_BUCKET_NAME, Key=thumbnail_key(original_key(file_name), DEFAULT_THUMBNAIL_SIZE),
+                  Body=b'jpeg rendition', ContentType='image/jpeg', Metadata=metadata)
+
+
+@pytest.mark.skipif('webp' not in THUMBNAIL_VARIANT_FORMATS, reason='WebP variants are not enabled')
+def test_variants_a_rendition_doesnt_list_are_never_requested(s3):
+    put_rendition(s3, 'plain.jpg', {'source-etag': '"1"', 'variants': ''})
+    for _ in range(3):
+        assert download('plain.jpg', WEBP_CLIENT)['statusCode'] == 200
+    assert variant_gets(s3) == []
+
+    put_rendition(s3, 'listed.jpg', {'source-etag': '"1"', 'variants': 'webp'})
+    rendition_key = thumbnail_key(original_key('listed.jpg'), DEFAULT_THUMBNAIL_SIZE)
+    s3.put_object(Bucket=S3_BUCKET_NAME, Key=variant_key(rendition_key, 'webp'), Body=b'webp', ContentType='image/webp')
+    assert json.loads(download('listed.jpg', WEBP_CLIENT)['body'])['content_type'] == 'image/webp'
+
+
+@pytest.mark.skipif('webp' not in THUMBNAIL_VARIANT_FORMATS, reason='WebP variants are not enabled')
+def test_missing_variants_of_older_renditions_are_remembered(s3, monkeypatch):
+    # Rendered before variants were listed, and without a cache to read the list from
+    monkeypatch.setattr(lambda_download_thumbnail, 'thumbnail_cache', None)
+    put_rendition(s3, 'old.jpg', {'source-etag': '"1"'})
+    for _ in range(3):
+        assert download('old.jpg', WEBP_CLIENT)['statusCode'] == 200
+    assert len(variant_gets(s3)) == 1
+
+
+def test_rerender_only_deletes_variants_it_replaces():
+    s3 = FakeS3()
+    buffer = io.BytesIO()
+    Image.effect_noise((600, 400), 40).convert('RGB').save(buffer, 'JPEG')
+    store_renditions(s3, S3_BUCKET_NAME, 'noise.jpg', buffer.getvalue(), '"1"')
+    assert not [key for operation, key in s3.calls if operation == 'DeleteObject']
+
+    renditions = rendition_metadata(s3, S3_BUCKET_NAME, 'noise.jpg')
+    for size_name, metadata in renditions.items():
+        rendition_key = thumbnail_key('noise.jpg', size_name)
+        stored = {variant_format for variant_format in THUMBNAIL_VARIANT_FORMATS
+                  if (S3_BUCKET_NAME, variant_key(rendition_key, variant_format)) in s3.objects}
+        assert set(stored_variants(metadata)) == stored
+
+    # A variant listed by the replaced rendition but not kept this time is deleted
+    for metadata in renditions.values():
+        metadata['variants'] = 'webp,avif'
+    s3.calls.clear()
+    store_renditions(s3, S3_BUCKET_NAME, 'noise.jpg', buffer.getvalue(), '"2"', replaced=renditions)
+    deleted = {key for operation, key in s3.calls if operation == 'DeleteObject'}
+    assert deleted and all(key.endswith(('.webp', '.avif')) for key in deleted)
+    assert all((S3_BUCKET_NAME, key) not in s3.objects for key in deleted)
+    # Each stale variant is only deleted once the rendition that no longer lists it is written
+    for index, (operation, key) in enumerate(s3.calls):
+        if operation == 'DeleteObject':
+            rendition_key = key.rsplit('.', 1)[0]
+            assert ('PutObject', rendition_key) in s3.calls[:index]
+
+
+def test_every_variant_smaller_than_the_rendition_is_kept(monkeypatch):
+    # AVIF larger than WebP is still worth it for a client that accepts only AVIF
+    sizes = {'WEBP': 50, 'AVIF': 80, 'PNG': 100}
+    monkeypatch.setattr(thumbnail_engine, 'encode_image', lambda image, image_format: bytes(sizes[image_format]))
+    variants = thumbnail_engine.encode_variants(None, 100, ['avif', 'webp'])
+    assert list(variants) == ['webp', 'avif']
+    sizes['AVIF'] = 120
+    assert list(thumbnail_engine.encode_variants(None, 100, ['avif', 'webp'])) == ['webp']
+
+
+def test_the_smallest_accepted_variant_is_served(s3, monkeypatch):
+    monkeypatch.setattr(lambda_download_thumbnail, 'THUMBNAIL_VARIANT_FORMATS', ['avif', 'webp'])
+    put_rendition(s3, 'cat.jpg', {'source-etag': '"1"', 'variants': 'webp,avif'})
+    rendition_key = thumbnail_key(original_key('cat.jpg'), DEFAULT_THUMBNAIL_SIZE)
+    for variant_format in ('webp', 'avif'):
+        s3.put_object(Bucket=S3_BUCKET_NAME, Key=variant_key(rendition_key, variant_format),
+                      Body=variant_format.encode(), ContentType=VARIANT_CONTENT_TYPES[variant_format])
+
+    def content_type(accept):
+        return json.loads(download('cat.jpg', {'Accept': accept})['body'])['content_type']
+
+    assert content_type('image/avif,image/webp,*/*') == 'image/webp'
+    assert content_type('image/avif,*/*') == 'image/avif'
+    assert content_type('image/*') == 'image/jpeg'
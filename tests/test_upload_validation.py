@@ -0,0 +1,108 @@
+import base64
+import io
+import struct
+import pytest
+# Puts config/ and lambda/ on the path
+import fakes  # noqa: F401
+from PIL import Image
+from image_sniff import sniff_image
+from key_layout import is_reserved_name
+from lambda_upload import decode_trailer, inspect_content
+import lambda_upload
+import thumbnail_engine
+
+
+def encode(image, image_format, **params):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, **params)
+    return buffer.getvalue()
+
+
+def jpeg(size=(64, 48)):
+    return encode(Image.new('RGB', size, (200, 30, 30)), 'JPEG')
+
+
+def with_app_segments(jpeg_data, total_size):
+    # APP2 segments (ICC profile chunks) right after SOI, 65533 bytes of content at most each
+    segments = b''
+    while total_size > 0:
+        content = b'ICC_PROFILE\0' + b'\x7f' * min(total_size, 65000)
+        segments += b'\xff\xe2' + struct.pack('>H', len(content) + 2) + content
+        total_size -= 65000
+    return jpeg_data[:2] + segments + jpeg_data[2:]
+
+
+def to_base64(data, line_breaks=False):
+    return (base64.encodebytes(data) if line_breaks else base64.b64encode(data)).decode('ascii')
+
+
+def test_jpeg_size_is_found_behind_large_app_segments():
+    data = with_app_segments(jpeg((640, 480)), 300 * 1024)
+    Image.open(io.BytesIO(data)).load()
+    info = inspect_content(to_base64(data))
+    assert (info.format, info.width, info.height) == ('JPEG', 640, 480)
+
+
+def test_jpeg_with_trailing_data_is_accepted():
+    # Padded camera files and Samsung SEFT trailers both follow the EOI marker
+    for trailer in (b'\0' * 200 * 1024, b'\x11' * 5000 + b'SEFH' + b'\x22' * 300 + b'SEFT'):
+        data = jpeg() + trailer
+        Image.open(io.BytesIO(data)).load()
+        assert inspect_content(to_base64(data, line_breaks=True)).format == 'JPEG'
+
+
+def test_png_and_gif_are_sniffed():
+    png = encode(Image.new('RGBA', (300, 200)), 'PNG')
+    gif = encode(Image.new('P', (30, 20)), 'GIF')
+    assert (inspect_content(to_base64(png)).width, sniff_image(png).height) == (300, 200)
+    assert (inspect_content(to_base64(gif, line_breaks=True)).format, sniff_image(gif).width) == ('GIF', 30)
+
+
+def test_other_formats_are_rejected():
+    webp = encode(Image.new('RGB', (30, 20)), 'WEBP')
+    with pytest.raises(ValueError, match='not a png, jpg or gif'):
+        inspect_content(to_base64(webp))
+
+
+def test_truncated_files_are_rejected():
+    png = encode(Image.effect_noise((256, 256), 64).convert('RGB'), 'PNG')
+    with pytest.raises(ValueError, match='truncated'):
+        inspect_content(to_base64(png[:len(png) // 2]))
+    # Cut inside the metadata segments, before the frame header
+    data = with_app_segments(jpeg(), 100 * 1024)
+    with pytest.raises(ValueError, match='header is truncated'):
+        inspect_content(to_base64(data[:50 * 1024]))
+    assert sniff_image(data[:50 * 1024]) is None
+
+
+def test_trailer_is_aligned_whatever_the_whitespace_and_padding():
+    data = bytes(range(256)) * 700
+    for encoded in (to_base64(data), to_base64(data, line_breaks=True), to_base64(data[:-1]).rstrip('='),
+                    to_base64(data[:-2], line_breaks=True)):
+        decoded = base64.b64decode(''.join(encoded.split()) + '==')
+        trailer = decode_trailer(encoded, size=1000)
+        assert len(trailer) >= 1000 and decoded.endswith(trailer)
+
+
+def test_formats_decoded_at_full_size_have_their_own_pixel_limit(monkeypatch):
+    monkeypatch.setattr(lambda_upload, 'MAX_FULL_DECODE_PIXELS', 200 * 200)
+    monkeypatch.setattr(thumbnail_engine, 'MAX_FULL_DECODE_PIXELS', 200 * 200)
+    png = encode(Image.new('RGBA', (300, 200)), 'PNG')
+    with pytest.raises(ValueError, match='limit is 40000 pixels'):
+        inspect_content(to_base64(png))
+    with pytest.raises(thumbnail_engine.ImageTooLargeError):
+        thumbnail_engine.open_image(png, 128)
+    # JPEGs are decoded at a reduced scale, only MAX_IMAGE_PIXELS applies to them
+    assert inspect_content(to_base64(jpeg((300, 200)))).width == 300
+    assert thumbnail_engine.open_image(jpeg((300, 200)), 128).format == 'JPEG'
+
+
+def test_rendition_names_are_reserved():
+    content = to_base64(jpeg())
+    for filename in ('cat-thumbnail.jpg', 'cat-thumbnail-tile.png'):
+        with pytest.raises(ValueError, match='may not end in -thumbnail'):
+            lambda_upload.store_file({'filename': filename, 'content': content})
+        with pytest.raises(ValueError, match='may not end in -thumbnail'):
+            lambda_upload.presign_upload({'filename': filename})
+    # Only the suffix is reserved
+    assert not is_reserved_name('thumbnail-cat.jpg') and not is_reserved_name('cat-thumbnails.jpg')